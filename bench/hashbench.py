@@ -0,0 +1,72 @@
+"""
+Micro-benchmark of the hashing done for every uploaded part: the three
+passes over the data of the original GlacierWriter.write versus the
+single pass of glaciercorecalls.part_hashes.
+
+Usage: python bench/hashbench.py [part size in MB] [rounds]
+
+Not a test: the figures depend on the machine, the Python build and the
+part size; compare the two lines of one run only.
+"""
+
+import hashlib
+import math
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(sys.path[0]), 'glacier'))
+
+import glaciercorecalls
+
+MB = 1024 * 1024
+
+
+def original_part_hashes(data):
+    """
+    The hashing of GlacierWriter.write before the single pass version:
+    tree hash of 1 MB slice copies, plus the linear hash taken twice.
+    """
+    chunk_count = int(math.ceil(len(data) / float(MB)))
+    hashes = [hashlib.sha256(data[i*MB:(i+1)*MB]).digest()
+              for i in range(chunk_count)]
+    while len(hashes) > 1:
+        new_hashes = []
+        while hashes:
+            if len(hashes) > 1:
+                new_hashes.append(hashlib.sha256(hashes.pop(0) + hashes.pop(0)).digest())
+            else:
+                new_hashes.append(hashes.pop(0))
+
+        hashes = new_hashes
+
+    hashlib.sha256(data).hexdigest()
+    return hashlib.sha256(data).hexdigest(), hashes[0]
+
+
+def bench(func, data, rounds):
+    best = None
+    for i in range(rounds):
+        start = time.time()
+        result = func(data)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return result, len(data) / best
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    data = os.urandom(size * MB)
+
+    old, old_rate = bench(original_part_hashes, data, rounds)
+    new, new_rate = bench(glaciercorecalls.part_hashes, data, rounds)
+    assert old == new, 'Hash mismatch.'
+
+    print 'Part size %s MB, best of %s rounds.' % (size, rounds)
+    print 'original:     %8.1f MB/s' % (old_rate / MB)
+    print 'part_hashes:  %8.1f MB/s (%.2fx)' % (new_rate / MB, new_rate / old_rate)
+
+if __name__ == '__main__':
+    main()
@@ -16,22 +16,46 @@ import time
 import sys
 import traceback
 import glaciercorecalls
+import packer
+import compression as glacier_compression
 import select
 import hashlib
 import fcntl
 import termios
 import struct
+import binascii
+import itertools
+import collections
+import threading
+import Queue
+import copy
+import tempfile
+import StringIO
 
 import boto
 import boto.sdb
 from boto import sns
 
 from functools import wraps
+from multiprocessing.pool import ThreadPool
 from dateutil.parser import parse as dtparse
 from datetime import datetime
 from pprint import pformat
 
-from glaciercorecalls import GlacierConnection, GlacierWriter
+from glaciercorecalls import GlacierConnection, GlacierWriter, ConcurrentGlacierWriter, \
+     RetryPolicy, UploadBudget
+from hashcache import TreeHashCache, file_identity
+from journal import UploadJournal
+from spool import UploadSpool
+from follow import FollowedFile
+from rangedownload import RangedDownload, archive_description
+from checkpoint import DownloadCheckpoint
+from shaping import BandwidthSchedule, TokenBucket, parse_rate, parse_windows, \
+                    read_shaped
+from archiveindex import ArchiveIndex
+from dedup import DedupStore, DedupReader, parse_recipe, CHUNKS_TAG, RECIPE_TAG
+from partreader import map_file, BlockReader
+from pipeline import UploadPipeline
 
 from glacierexception import *
 
@@ -84,24 +108,6 @@ class log_class_call(object):
         return wrapper
 
 
-class mmap(object):
-    """
-    Not really a mmap, just a simple read-only substitute that
-    does not require having a lot of RAM to upload large files.
-    """
-    def __init__(self, file):
-        self.file = file
-        self.size = os.fstat(self.file.fileno()).st_size
-
-    def __getitem__(self, key):
-        self.file.seek(key.start)
-        if key.stop is None:
-            stop = self.size
-        else:
-            stop = key.stop
-        return self.file.read(stop - key.start)
-
-
 class GlacierWrapper(object):
     """
     Wrapper for accessing Amazon Glacier, with Amazon SimpleDB support
@@ -259,9 +265,7 @@ us-gov-west-1   AWS GovCloud (US-West)\
                                       self.aws_access_key,
                                       self.aws_secret_key,
                                       self.region)
-                    self.glacierconn = GlacierConnection(self.aws_access_key,
-                                                         self.aws_secret_key,
-                                                         region_name=self.region)
+                    self.glacierconn = self._glacier_connection()
                 except boto.exception.AWSConnectionError as e:
                     raise ConnectionException(
                         "Cannot connect to Amazon Glacier.",
@@ -271,6 +275,18 @@ us-gov-west-1   AWS GovCloud (US-West)\
             return func(*args, **kwargs)
         return glacier_connect_wrap
 
+    def _glacier_connection(self):
+        """
+        Opens a new connection to Amazon Glacier. Used for the shared
+        connection, and by upload threads that need one of their own.
+
+        :returns: connection to Amazon Glacier.
+        :rtype: :py:class:`glaciercorecalls.GlacierConnection`
+        """
+        return GlacierConnection(self.aws_access_key,
+                                 self.aws_secret_key,
+                                 region_name=self.region)
+
     def sdb_connect(func):
         """
         Decorator which connects to Amazon SimpleDB.
@@ -570,7 +586,7 @@ using %s MB parts to upload." % part_size)
         :type msg: str
         """
 
-        if sys.stdout.isatty():
+        if self.progress and sys.stdout.isatty():
 
             # Get the current screen width.
             cols = struct.unpack('hh',  fcntl.ioctl(sys.stdout, termios.TIOCGWINSZ, '1234'))[1]
@@ -610,6 +626,190 @@ using %s MB parts to upload." % part_size)
 
         return fmt % (num, 'TB')
 
+    def _download_progress(self, downloaded_size, total_size, part_size,
+                           start_time, previous_time, start_size=0):
+        """
+        Reports the progress of a download, after a part of part_size
+        bytes was fetched. start_size is the number of bytes there were
+        already at start_time. Returns the current time, the
+        previous_time of the next report.
+        """
+
+        # Calculate progress statistics.
+        current_time = time.time()
+        overall_rate = int((downloaded_size - start_size)/max(current_time - start_time, 0.001))
+        current_rate = int(part_size/max(current_time - previous_time, 0.001))
+
+        # Estimate finish time, based on overall transfer rate.
+        if overall_rate > 0:
+            time_left = self._time_left(total_size - downloaded_size,
+                                        overall_rate)
+            eta_seconds = current_time + time_left
+            if datetime.fromtimestamp(eta_seconds).day is not\
+                    datetime.now().day:
+                eta_template = "%a, %d %b, %H:%M:%S"
+            else:
+                eta_template = "%H:%M:%S"
+
+            eta = time.strftime(eta_template, time.localtime(eta_seconds))
+        else:
+            eta = "Unknown"
+
+        msg = 'Read %s of %s (%s%%). Rate %s/s, average %s/s, ETA %s.' \
+              % (self._size_fmt(downloaded_size),
+                 self._size_fmt(total_size),
+                 self._bold(str(int(100 * downloaded_size/total_size))),
+                 self._size_fmt(current_rate, 2),
+                 self._size_fmt(overall_rate, 2),
+                 eta)
+        self._progress(msg)
+        self.logger.debug(msg)
+        return current_time
+
+    def _ranged_download(self, vault_name, download_job, part_size,
+                         concurrency, checkpoint=None):
+        # A single part at a time goes over the shared connection.
+        if concurrency > 1:
+            connection_factory = self._glacier_connection
+        else:
+            connection_factory = lambda: self.glacierconn
+
+        return RangedDownload(connection_factory, vault_name,
+                              download_job['JobId'],
+                              download_job['ArchiveSizeInBytes'], part_size,
+                              concurrency=concurrency, bucket=self.bandwidth,
+                              retry_policy=self.retry_policy,
+                              logger=self.logger, checkpoint=checkpoint)
+
+    def _stream_ranges(self, vault_name, download_job, part_size,
+                       concurrency, memory_budget, decompress, start_time):
+        """
+        Fetches the output of download_job, up to concurrency parts of
+        part_size bytes at a time, and writes it to stdout in order,
+        decompressed if the archive was compressed on upload and
+        decompress is set. Parts that come in ahead of their turn are
+        held up to memory_budget bytes. Returns the tree hash of the
+        data.
+        """
+
+        total_size = download_job['ArchiveSizeInBytes']
+        download = self._ranged_download(vault_name, download_job, part_size,
+                                         concurrency)
+        state = {'size': 0, 'time': start_time}
+        def progress(downloaded_size):
+            state['time'] = self._download_progress(
+                downloaded_size, total_size, downloaded_size - state['size'],
+                start_time, state['time'])
+            state['size'] = downloaded_size
+
+        decompressor = None
+        blocks = download.stream(memory_budget, progress)
+        try:
+            for data in blocks:
+                # The description comes with the first part, before its
+                # data.
+                if decompress and decompressor is None:
+                    codec = self._archive_compression(
+                        download_job['ArchiveId'],
+                        description=download.description)
+                    if codec:
+                        self.logger.info('Archive is compressed with %s; decompressing.'% codec)
+                        decompressor = glacier_compression.Decompressor(codec)
+                    else:
+                        decompress = False
+
+                if decompressor:
+                    data = decompressor.decompress(data)
+
+                sys.stdout.write(data)
+
+            sys.stdout.flush()
+        except boto.glacier.exceptions.UnexpectedHTTPResponseError as e:
+            raise ResponseException(
+                'Failed to download archive %s.'% download_job['ArchiveId'],
+                cause=self._decode_error_message(e.body),
+                code=e.code)
+        finally:
+            blocks.close()
+
+        if download.retries:
+            self.logger.info('%s parts of the download were fetched again.'% download.retries)
+
+        return download.tree_hash
+
+    def _download_ranges(self, vault_name, download_job, out_file,
+                         part_size, concurrency, start_time, checkpoint):
+        """
+        Fetches the output of download_job, up to concurrency parts of
+        part_size bytes at a time, into out_file, which is closed
+        afterwards. The parts listed in checkpoint are skipped, the
+        others are recorded in it. Returns the tree hash of the data and
+        the archive description sent with it.
+        """
+
+        total_size = download_job['ArchiveSizeInBytes']
+        download = self._ranged_download(vault_name, download_job, part_size,
+                                         concurrency, checkpoint)
+        start_size = checkpoint.size_done
+        state = {'size': start_size, 'time': start_time}
+        def progress(downloaded_size):
+            state['time'] = self._download_progress(
+                downloaded_size, total_size, downloaded_size - state['size'],
+                start_time, state['time'], start_size)
+            state['size'] = downloaded_size
+
+        try:
+            tree_hash = download.download(out_file.fileno(), progress)
+        except boto.glacier.exceptions.UnexpectedHTTPResponseError as e:
+            raise ResponseException(
+                'Failed to download archive %s.'% download_job['ArchiveId'],
+                cause=self._decode_error_message(e.body),
+                code=e.code)
+        finally:
+            out_file.close()
+            checkpoint.close()
+
+        if download.retries:
+            self.logger.info('%s parts of the download were fetched again.'% download.retries)
+
+        return tree_hash, download.description
+
+    def _decompress_file(self, file_name, codec):
+        """
+        Decompresses the file file_name, compressed with codec, in place.
+        """
+
+        decompressor = glacier_compression.Decompressor(codec)
+        directory = os.path.dirname(os.path.abspath(file_name))
+        fd, temp_name = tempfile.mkstemp(dir=directory, prefix='.glacier-cmd-')
+        try:
+            with os.fdopen(fd, 'wb') as out_file:
+                with open(file_name, 'rb') as in_file:
+                    for data in iter(lambda: in_file.read(1024 * 1024), ''):
+                        out_file.write(decompressor.decompress(data))
+
+            os.chmod(temp_name, os.stat(file_name).st_mode & 0777)
+            os.rename(temp_name, file_name)
+        except (IOError, OSError) as e:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+
+            raise InputException(
+                "Cannot decompress the downloaded file.",
+                cause=e,
+                code='FileError')
+
+    def _time_left(self, size, rate):
+        """
+        Estimates the seconds needed to transfer size more bytes, going at
+        rate bytes per second, within the bandwidth limits of the coming
+        hours.
+        """
+        if self.bandwidth:
+            return self.bandwidth.schedule.transfer_time(size, rate)
+
+        return size / rate
+
     def _decode_error_message(self, e):
         try:
             e = json.loads(e)['message']
@@ -974,7 +1174,11 @@ using %s MB parts to upload." % part_size)
     @log_class_call("Uploading archive.",
                     "Upload of archive finished.")
     def upload(self, vault_name, file_name, description, region,
-               stdin, alternative_name, part_size, uploadid, resume):
+               stdin, alternative_name, part_size, uploadid, resume,
+               jobs=1, concurrency=1, readahead=1, paranoid=False,
+               budget=None, reader=None, compression=None,
+               compression_level=None, spool=False, spool_parts=0,
+               follow=False, follow_timeout=60, follow_sentinel=None):
         """
         Uploads a file to Amazon Glacier.
 
@@ -990,6 +1194,48 @@ using %s MB parts to upload." % part_size)
         :type stdin: boolan
         :param part_size: the size (in MB) of the blocks to upload.
         :type part_size: int
+        :param jobs: number of threads to calculate tree hashes with,
+            0 to use all available cores.
+        :type jobs: int
+        :param concurrency: number of parts to upload at the same time,
+            each over its own connection.
+        :type concurrency: int
+        :param readahead: number of parts to read and hash while the
+            current part is being sent.
+        :type readahead: int
+        :param paranoid: when resuming, check all uploaded parts against
+            the file, even if the upload journal says they match.
+        :type paranoid: boolean
+        :param budget: limits on the parts in flight shared with other
+            uploads; if given, it replaces concurrency.
+        :type budget: :py:class:`glaciercorecalls.UploadBudget`
+        :param reader: file-like object to read the data from, instead
+            of a file or stdin. Its size attribute, if any, is taken as
+            the size of the data.
+        :type reader: file
+        :param compression: codec to compress the data with, see
+            :py:data:`compression.CODECS`; data that does not compress
+            is uploaded as it is.
+        :type compression: str
+        :param compression_level: compression level; the default of the
+            codec if None.
+        :type compression_level: int
+        :param spool: whether to spool data from stdin to disk, so parts
+            are sent from there and the upload can be resumed from the
+            spool, see :py:mod:`spool`.
+        :type spool: boolean
+        :param spool_parts: maximum number of parts in the spool; by
+            default one more than are uploaded or read ahead at a time.
+        :type spool_parts: int
+        :param follow: whether to upload the file while it is still
+            being written, see :py:mod:`follow`.
+        :type follow: boolean
+        :param follow_timeout: seconds a followed file must not grow
+            before it is taken to be complete.
+        :type follow_timeout: float
+        :param follow_sentinel: name of a file that appears when the
+            followed file is complete.
+        :type follow_sentinel: str
 
         :returns: Tupple of (archive_id, sha256hash)
         :rtype: tupple
@@ -997,6 +1243,30 @@ using %s MB parts to upload." % part_size)
                  :py:exc:`glacier.glacierexception.ResponseException`
         """
 
+        # Release the file, hasher and writer threads also when the upload
+        # fails half way.
+        cleanup = []
+        try:
+            return self._upload(cleanup, vault_name, file_name, description,
+                                region, stdin, alternative_name, part_size,
+                                uploadid, resume, jobs, concurrency, readahead,
+                                paranoid, budget, reader, compression,
+                                compression_level, spool, spool_parts,
+                                follow, follow_timeout, follow_sentinel)
+        finally:
+            for func in reversed(cleanup):
+                func()
+
+    def _upload(self, cleanup, vault_name, file_name, description, region,
+                stdin, alternative_name, part_size, uploadid, resume,
+                jobs, concurrency, readahead, paranoid, budget, reader,
+                compression, compression_level, spool, spool_parts,
+                follow, follow_timeout, follow_sentinel):
+        """
+        Does the work of :py:meth:`upload`. Functions that release the
+        resources taken are appended to cleanup.
+        """
+
         # Switch off debug logging for boto, as otherwise it's
         # filling up the log with the data sent!
         if self.logger.getEffectiveLevel() == 10:
@@ -1014,40 +1284,156 @@ using %s MB parts to upload." % part_size)
         if uploadid:
             self._check_id(uploadid, 'UploadId')
 
+        # An interrupted upload from stdin is resumed from its spool.
+        spooled = None
+        spool_parts = spool_parts or concurrency + readahead + 1
+        if spool and stdin and (resume or uploadid):
+            if uploadid:
+                spooled = UploadSpool.open(self.spool_dir, uploadid, spool_parts)
+            else:
+                spooled = UploadSpool.find(self.spool_dir, vault_name, region, spool_parts)
+                if not spooled:
+                    raise InputException(
+                        'No spool of an interrupted upload from stdin to %s found.' % vault_name,
+                        code='ResumeError')
+
+            if spooled:
+                uploadid = spooled.uploadid
+                resume = False
+                self.logger.info('Found spool of interrupted upload %s; %s spooled parts, %s.'
+                                 % (uploadid, len(spooled.parts),
+                                    'complete' if spooled.complete else
+                                    'continuing with data from stdin at byte %s' % spooled.size))
+                if spooled.header['Compression'] and not spooled.complete:
+                    raise InputException(
+                        'Can not resume a compressed upload from stdin before the end of the data was spooled.',
+                        code='ResumeError')
+
+        if follow and (resume or uploadid or compression or stdin or reader):
+            raise InputException(
+                'A file that is still being written can only be uploaded as it is, from the start.',
+                code='CommandError')
+
         if resume and stdin:
             raise InputException(
                 'You must provide the UploadId to resume upload of streams from stdin.\nUse glacier-cmd listmultiparts <vault> to find the UploadId.',
                 code='CommandError')
 
+        if compression:
+            glacier_compression.check_codec(compression)
+
         # If file_name is given, try to use this file(s).
         # Otherwise try to read data from stdin.
         total_size = 0
-        reader = None
         mmapped_file = None
-        if not stdin:
+        followed = None
+        if reader:
+            total_size = getattr(reader, 'size', 0)
+        elif follow:
             if not file_name:
                 raise InputException(
                     "No file name given for upload.",
                     code='CommandError')
 
             try:
+                followed = FollowedFile(file_name, follow_timeout, follow_sentinel)
+                cleanup.append(followed.close)
+            except (IOError, OSError) as e:
+                raise InputException(
+                    "Could not access file: %s."% file_name,
+                    cause=e,
+                    code='FileError')
+
+        elif not stdin:
+            if not file_name:
+                raise InputException(
+                    "No file name given for upload.",
+                    code='CommandError')
+
+            try:
+                identity = file_identity(file_name)
                 f = open(file_name, 'rb')
-                mmapped_file = mmap(f)
+                cleanup.append(f.close)
+                mmapped_file = map_file(f, self.page_cache)
+                if hasattr(mmapped_file, 'close'):
+                    cleanup.append(mmapped_file.close)
                 total_size = os.path.getsize(file_name)
-            except IOError as e:
+            except (IOError, OSError) as e:
                 raise InputException(
                     "Could not access file: %s."% file_name,
                     cause=e,
                     code='FileError')
 
+        elif spooled and spooled.complete:
+            # All data that is not uploaded yet is in the spool.
+            pass
         elif select.select([sys.stdin,],[],[],2.0)[0]:
             reader = sys.stdin
             total_size = 0
+        elif spooled:
+            raise InputException(
+                "There is nothing to upload.",
+                cause='The spool holds the data up to byte %s; pipe in the rest of the data from there on.' % spooled.size,
+                code='CommandError')
         else:
             raise InputException(
                 "There is nothing to upload.",
                 code='CommandError')
 
+        # Compress the data on the way, unless a sample of it shows that
+        # it hardly compresses; then it is sent as it is.
+        codec = None
+        original_size = total_size
+        if spooled:
+            codec = spooled.header['Compression']
+        elif compression:
+            if mmapped_file:
+                head = ''
+                sampled = mmapped_file[0:total_size]
+                ratio = glacier_compression.sample_ratio(
+                    glacier_compression.file_samples(sampled, total_size))
+                sampled.close()
+            else:
+                head = reader.read(glacier_compression.BLOCK_SIZE)
+                ratio = glacier_compression.sample_ratio([head])
+
+            if ratio < glacier_compression.MAX_RATIO:
+                self.logger.info('Data compresses to about %d%%; compressing with %s.'
+                                 % (100 * ratio, compression))
+                codec = compression
+                # The file is read like its parts would be, so
+                # --page-cache holds for compressed uploads too.
+                if mmapped_file:
+                    reader = BlockReader(file_name, 0, total_size,
+                                         glacier_compression.BLOCK_SIZE,
+                                         self.page_cache)
+                    cleanup.append(reader.close)
+
+                reader = glacier_compression.CompressedReader(
+                    reader, codec, compression_level, jobs, head)
+                cleanup.append(reader.close)
+                description = glacier_compression.tag_description(
+                    description, codec, total_size if mmapped_file else None)
+                self._check_vault_description(description)
+                mmapped_file = None
+                total_size = 0
+            else:
+                self.logger.info('Data compresses to about %d%%; uploading it uncompressed.'
+                                 % (100 * ratio))
+                if head:
+                    reader = glacier_compression.CompressedReader(reader, None, head=head)
+
+        # Find the upload to resume in the journals of unfinished uploads.
+        journal = None
+        if resume and not uploadid:
+            journal = self._find_journal(vault_name, file_name)
+            if journal:
+                uploadid = journal.uploadid
+                self.logger.info('Found interrupted upload %s of %s.'% (uploadid, file_name))
+            else:
+                self.logger.info('No interrupted upload of %s found; starting a new upload.'% file_name)
+                resume = False
+
         # Log the kind of upload we're going to do.
         if uploadid:
             self.logger.info('Attempting resumption of upload of %s to %s.'% (file_name if file_name else 'data from stdin', vault_name))
@@ -1058,7 +1444,7 @@ using %s MB parts to upload." % part_size)
 
         # If user did not specify part_size, compute the optimal (i.e. lowest
         # value to stay within the self.MAX_PARTS (10,000) block limit).
-        part_size = self._check_part_size(part_size, total_size)
+        part_size = self._check_part_size(part_size, total_size or original_size)
         part_size_in_bytes = part_size * 1024 * 1024
 
         # If we have an UploadId, check whether it is linked to a current
@@ -1074,64 +1460,154 @@ using %s MB parts to upload." % part_size)
                     part_size_in_bytes = upload['PartSizeInBytes']
                     break
             else:
-                raise InputException(
-                    'Can not resume upload of this data as no existing job with this uploadid could be found.',
-                    code='IdError')
+                if not journal:
+                    raise InputException(
+                        'Can not resume upload of this data as no existing job with this uploadid could be found.',
+                        code='IdError')
+
+                # Uploads expire about 24 hours after the last activity.
+                self.logger.warning('Interrupted upload %s of %s has expired; starting a new upload.'% (uploadid, file_name))
+                journal.remove()
+                journal = uploadid = upload = None
 
         # Initialise the writer task.
-        writer = GlacierWriter(self.glacierconn, vault_name, description=description,
-                               part_size_in_bytes=part_size_in_bytes, uploadid=uploadid, logger=self.logger)
+        hasher = glaciercorecalls.ParallelTreeHasher(jobs, self.page_cache)
+        cleanup.append(hasher.close)
+        if budget or concurrency > 1:
+            writer = ConcurrentGlacierWriter(self.glacierconn, vault_name,
+                                             concurrency=budget.concurrency if budget else concurrency,
+                                             budget=budget,
+                                             connection_factory=self._glacier_connection,
+                                             description=description,
+                                             part_size_in_bytes=part_size_in_bytes,
+                                             uploadid=uploadid, logger=self.logger,
+                                             hasher=hasher, retry_policy=self.retry_policy,
+                                             bucket=self.bandwidth)
+        else:
+            writer = GlacierWriter(self.glacierconn, vault_name, description=description,
+                                   part_size_in_bytes=part_size_in_bytes, uploadid=uploadid,
+                                   logger=self.logger, hasher=hasher,
+                                   retry_policy=self.retry_policy, bucket=self.bandwidth)
+
+        cleanup.append(writer.stop)
+
+        # Use the tree hash cache for files, so that the hashes of
+        # unchanged data do not have to be calculated again.
+        cache = self._get_hash_cache() if mmapped_file else None
+        if cache:
+            cache_key = cache.key(file_name)
+            cache_entry = cache.get(cache_key)
+            cache_leaves = bytearray(cache_entry.leaves if cache_entry else '')
+
+        # The journal of an earlier attempt tells which parts were uploaded
+        # from the file, so as long as the file did not change they need
+        # not be read and hashed again.
+        trusted_journal = None
+        verified_parts = []
+        if upload and mmapped_file and not paranoid:
+            journal = journal or UploadJournal.open(self.journal_dir, uploadid)
+            if journal and journal.header['Identity'] == list(identity):
+                trusted_journal = journal
+            elif journal:
+                self.logger.warning('%s changed since the upload was interrupted; checking all uploaded parts.'% file_name)
+
+        if upload and spooled:
+
+            # The parts acknowledged before the interruption are listed
+            # with the upload, the others are in the spool. Together they
+            # must cover the data up to the end of the spool; parts that
+            # are in both were acknowledged just before the interruption.
+            # The parts sent again leave the spool when acknowledged, to
+            # make room for the rest of the data.
+            writer.journal = spooled
+            cleanup.append(spooled.close)
+            listed_parts = dict(
+                (tuple(int(p) + i for i, p in enumerate(part['RangeInBytes'].split('-'))),
+                 part['SHA256TreeHash'])
+                for part in self._list_parts_ahead(vault_name, uploadid))
+            resent = 0
+            for start, stop in sorted(set(listed_parts) | spooled.parts):
+                if start != writer.uploaded_size:
+                    raise InputException(
+                        'The spool does not hold all data that is not uploaded yet.',
+                        cause='No data for bytes %s-%s.' % (writer.uploaded_size, start - 1),
+                        code='ResumeError')
+
+                if (start, stop) in listed_parts:
+                    writer.tree_hashes.append(binascii.unhexlify(listed_parts[(start, stop)]))
+                    writer.uploaded_size = stop
+                    spooled.record(start, stop, listed_parts[(start, stop)])
+                else:
+                    writer.write(spooled.part(start, stop))
+                    resent += 1
+
+            self.logger.info('Sent %s part%s again from the spool; continuing from %s.'
+                             % (resent, '' if resent == 1 else 's',
+                                self._size_fmt(writer.uploaded_size)))
+
+        elif upload:
+
+            # Take the hash of the data of every uploaded part. Parts of
+            # files are checked on a pool of worker threads, while the
+            # next pages of the parts list are fetched in the background;
+            # the results come back in the order of the list.
+            # If recieving data over stdin, the parts must be sequential
+            # and the first must start at 0.
+            listed_parts = self._list_parts_ahead(vault_name, uploadid)
+            pool = None
+            if reader:
+                checked_parts = itertools.imap(
+                    lambda part: self._check_stdin_part(reader, part),
+                    listed_parts)
+            else:
+                def check_file_part(part):
+                    start, stop = (int(p) for p in part['RangeInBytes'].split('-'))
+                    stop += 1
+                    if stop > mmapped_file.size:
+                        raise InputException(
+                            'File does not match uploaded data; please check your uploadid and try again.',
+                            cause='File is smaller than uploaded data.',
+                            code='ResumeError')
 
-        if upload:
-            marker = None
-            while True:
+                    if trusted_journal and \
+                            trusted_journal.tree_hash(start, stop) == part['SHA256TreeHash']:
+                        self.logger.debug('Part %s hash taken from the journal.'% part['RangeInBytes'])
+                        return part, stop - start, binascii.unhexlify(part['SHA256TreeHash']), None
 
-                # Fetch a list of already uploaded parts and their SHA hashes.
-                try:
-                    response = self.glacierconn.list_parts(vault_name, uploadid, marker=marker)
-                except boto.glacier.exceptions.UnexpectedHTTPResponseError as e:
-                    raise ResponseException(
-                        'Failed to get a list already uploaded parts for interrupted upload %s.'% uploadid,
-                        cause=self._decode_error_message(e.body),
-                        code=e.code)
+                    if cache and cache_entry and not paranoid:
+                        data_hash = cache_entry.range_tree_hash(start, stop)
+                        if data_hash:
+                            self.logger.debug('Part %s hash taken from the cache.'% part['RangeInBytes'])
+                            return part, stop - start, data_hash, None
+
+                    leaves, data_hash = self._leaf_hashes(hasher, file_name, start, stop)
+                    return part, stop - start, data_hash, leaves
+
+                if hasher.jobs > 1:
+                    pool = ThreadPool(hasher.jobs)
+                    checked_parts = self._imap_ahead(pool, check_file_part,
+                                                     listed_parts, 2 * hasher.jobs)
+                else:
+                    checked_parts = itertools.imap(check_file_part, listed_parts)
 
-                list_parts_response = response.copy()
-                current_position = 0
-                stop = 0
-                # Process the parts list.
-                # For each part of data, take the matching data range from
-                # the local file, and compare hashes.
-                # If recieving data over stdin, the parts must be sequential
-                # and the first must start at 0. For file, we can use the seek()
-                # function to handle non-sequential parts.
-                for part in list_parts_response['Parts']:
+            # If no data or hash mismatch, stop checking raise an
+            # exception.
+            current_position = 0
+            stop = 0
+            try:
+                for part, data_size, data_hash, leaves in checked_parts:
                     start, stop = (int(p) for p in part['RangeInBytes'].split('-'))
                     stop += 1
-                    if not start == current_position:
-                        if stdin:
-                            raise InputException(
-                                'Cannot verify non-sequential upload data from stdin.',
-                                code='ResumeError')
-                        if reader:
-                            reader.seek(start)
-
-                    if mmapped_file and stop > mmapped_file.size:
+                    if not start == current_position and stdin:
                         raise InputException(
-                            'File does not match uploaded data; please check your uploadid and try again.',
-                            cause='File is smaller than uploaded data.',
+                            'Cannot verify non-sequential upload data from stdin.',
                             code='ResumeError')
 
-                    # Try to read the chunk of data, and take the hash if we
-                    # have received anything.
-                    # If no data or hash mismatch, stop checking raise an
-                    # exception.
-                    data = None
-                    data = reader.read(stop-start) if reader else mmapped_file[start:stop]
-                    if data:
-                        data_hash = glaciercorecalls.tree_hash(glaciercorecalls.chunk_hashes(data))
+                    if data_size:
                         if glaciercorecalls.bytes_to_hex(data_hash) == part['SHA256TreeHash']:
                             self.logger.debug('Part %s hash matches.'% part['RangeInBytes'])
                             writer.tree_hashes.append(data_hash)
+                            verified_parts.append((start, stop, part['SHA256TreeHash']))
                         else:
                             raise InputException(
                                 'Received data does not match uploaded data; please check your uploadid and try again.',
@@ -1144,25 +1620,32 @@ using %s MB parts to upload." % part_size)
                             cause='No or not enough data to match.',
                             code='ResumeError')
 
-                    current_position += stop - start
+                    if leaves and cache and \
+                            start == len(cache_leaves) // TreeHashCache.HASH_SIZE * \
+                                     glaciercorecalls.TreeHasher.CHUNK_SIZE \
+                            and cache.wants_leaves(total_size):
+                        cache_leaves += leaves
+
+                    current_position = stop
+                    writer.uploaded_size = stop
+                    if total_size > 0:
+                        msg = 'Checked %s of %s (%s%%).' \
+                              % (self._size_fmt(writer.uploaded_size),
+                                 self._size_fmt(total_size),
+                                 self._bold(str(int(100 * writer.uploaded_size/total_size))))
+                    else:
+                        msg = 'Checked %s.' \
+                              % (self._size_fmt(writer.uploaded_size))
 
-                # If a marker is present, this means there are more pages
-                # of parts available. If no marker, we have the last page.
-                marker = list_parts_response['Marker']
-                writer.uploaded_size = stop
-                if not marker:
-                    break
+                    self._progress(msg)
 
-                if total_size > 0:
-                    msg = 'Checked %s of %s (%s%%).' \
-                          % (self._size_fmt(writer.uploaded_size),
-                             self._size_fmt(total_size),
-                             self._bold(str(int(100 * writer.uploaded_size/total_size))))
-                else:
-                    msg = 'Checked %s.' \
-                          % (self._size_fmt(writer.uploaded_size))
+            finally:
+                if pool:
+                    pool.terminate()
 
-                self._progress(msg)
+            # Remember the hashes of the checked data, for the next attempt.
+            if cache and len(cache_leaves) > (len(cache_entry.leaves) if cache_entry else 0):
+                cache.put(cache_key, leaves=cache_leaves)
 
             # Finished checking; log this and print the final status update
             # before resuming the upload.
@@ -1178,32 +1661,68 @@ using %s MB parts to upload." % part_size)
 
             self._progress(msg)
 
-        # Read file in parts so we don't fill the whole memory.
-        start_time = current_time = previous_time = time.time()
-        start_bytes = writer.uploaded_size
-        while True:
-            if reader:
-                part = reader.read(part_size_in_bytes)
-            else:
-                if mmapped_file.size > writer.uploaded_size+part_size_in_bytes:
-                    part = mmapped_file[writer.uploaded_size:writer.uploaded_size+part_size_in_bytes]
+        # Keep a journal of the parts of files that are uploaded, for
+        # resuming the upload if it is interrupted.
+        if mmapped_file:
+            journal = trusted_journal or self._create_journal(
+                writer.uploadid, vault_name, file_name, part_size_in_bytes,
+                identity, verified_parts)
+            writer.journal = journal
+
+        # Spool the data from stdin to disk, and send the parts from there.
+        elif spool and stdin and not spooled:
+            try:
+                spooled = UploadSpool.create(self.spool_dir, writer.uploadid,
+                                             vault_name, region, part_size_in_bytes,
+                                             codec, writer.uploaded_size, spool_parts)
+            except EnvironmentError as e:
+                raise InputException(
+                    "Could not create the spool in %s." % (self.spool_dir or UploadSpool.DEFAULT_DIR),
+                    cause=e,
+                    code='FileError')
+
+            writer.journal = spooled
+            cleanup.append(spooled.close)
+
+        # Read file in parts so we don't fill the whole memory. The next
+        # parts are read and hashed while the current one is sent.
+        def parts(position):
+            while True:
+                if reader:
+                    part = reader.read(part_size_in_bytes)
                 else:
-                    part = mmapped_file[writer.uploaded_size:]
+                    part = mmapped_file[position:position+part_size_in_bytes]
 
-            if not part:
-                break
+                if not part:
+                    break
 
-            writer.write(part)
+                position += len(part)
+                yield part
+
+        start_time = current_time = previous_time = time.time()
+        start_bytes = writer.uploaded_size
+        if spooled:
+            part_iterator = spooled.spool(reader) if reader else iter([])
+        elif followed:
+            self.logger.info('Following %s until it is complete.' % file_name)
+            part_iterator = followed.parts(part_size_in_bytes)
+        else:
+            part_iterator = parts(writer.uploaded_size)
+
+        pipeline = UploadPipeline(part_iterator, writer,
+                                  hasher=hasher, readahead=readahead)
+        for written in pipeline:
             current_time = time.time()
             overall_rate = int((writer.uploaded_size-start_bytes)/(current_time - start_time))
             if total_size > 0:
 
                 # Calculate transfer rates in bytes per second.
-                current_rate = int(part_size_in_bytes/(current_time - previous_time))
+                current_rate = int(written/(current_time - previous_time))
 
                 # Estimate finish time, based on overall transfer rate.
                 if overall_rate > 0:
-                    time_left = (total_size - writer.uploaded_size)/overall_rate
+                    time_left = self._time_left(total_size - writer.uploaded_size,
+                                                overall_rate)
                     eta_seconds = current_time + time_left
                     if datetime.fromtimestamp(eta_seconds).day is not\
                             datetime.now().day:
@@ -1232,20 +1751,45 @@ using %s MB parts to upload." % part_size)
             self._progress(msg)
             previous_time = current_time
             self.logger.debug(msg)
+            self.logger.debug('Upload pipeline: %s'% pipeline.report())
 
         writer.close()
-        if not stdin:
+        hasher.close()
+        self.logger.info('Upload pipeline: %s Bottleneck: %s.'
+                         % (pipeline.report(), pipeline.bottleneck()))
+        if mmapped_file:
             f.close()
         current_time = time.time()
         overall_rate = int(writer.uploaded_size/(current_time - start_time))
-        msg = 'Wrote %s. Rate %s/s.\n' % (self._size_fmt(writer.uploaded_size),
-                                            self._size_fmt(overall_rate, 2))
+        msg = 'Wrote %s. Rate %s/s.' % (self._size_fmt(writer.uploaded_size),
+                                          self._size_fmt(overall_rate, 2))
+        if writer.retries:
+            msg += ' Retried %s part%s (%s retr%s).' \
+                   % (writer.retried_parts, '' if writer.retried_parts == 1 else 's',
+                      writer.retries, 'y' if writer.retries == 1 else 'ies')
+
+        if codec and reader:
+            msg += ' Compressed %s to %s with %s.' \
+                   % (self._size_fmt(reader.size_in),
+                      self._size_fmt(writer.uploaded_size), codec)
+
+        msg += '\n'
         self._progress(msg)
         self.logger.info(msg)
 
         archive_id = writer.get_archive_id()
         sha256hash = writer.get_hash()
         location = writer.get_location()
+        if writer.journal:
+            writer.journal.remove()
+
+        if cache and cache.key(file_name) == cache_key:
+            cache.put(cache_key, tree_hash=sha256hash)
+
+        index = self._get_archive_index()
+        if index:
+            index.add(region, vault_name, archive_id, sha256hash,
+                      writer.uploaded_size, description)
 
         if self.bookkeeping:
             self.logger.info('Writing upload information into the bookkeeping database.')
@@ -1266,6 +1810,11 @@ using %s MB parts to upload." % part_size)
                 'hash': sha256hash,
                 'size': writer.uploaded_size
             }
+            if codec:
+                file_attrs['compression'] = codec
+
+            if codec and reader:
+                file_attrs['original_size'] = reader.size_in
 
 ##            if file_name:
 ##                file_attrs['filename'] = file_name
@@ -1276,6 +1825,278 @@ using %s MB parts to upload." % part_size)
 
         return (archive_id, sha256hash)
 
+    def _worker_clone(self):
+        """
+        Returns a copy of this wrapper for use in another thread. The copy
+        opens its own connections and tree hash cache, as these can not be
+        shared between threads, and does not print progress.
+        """
+
+        clone = copy.copy(self)
+        clone.glacierconn = None
+        clone.tree_hash_cache = None
+        clone.archive_index = None
+        clone.progress = False
+        for attr in ('sdb_conn', 'sdb_domain'):
+            clone.__dict__.pop(attr, None)
+
+        return clone
+
+    @log_class_call("Uploading files.",
+                    "Upload of files finished.")
+    def upload_files(self, vault_name, file_names, description, region,
+                     alternative_name, part_size, resume, jobs=1,
+                     concurrency=1, readahead=1, paranoid=False,
+                     memory_budget=None, compression=None,
+                     compression_level=None):
+        """
+        Uploads several files to Amazon Glacier, each as an archive of
+        its own. Up to concurrency files are uploaded at the same time,
+        the largest first, so a big file does not start last and hold up
+        the end of the batch. Together the uploads keep no more than
+        concurrency parts in flight, and no more than memory_budget MB of
+        parts. A file that fails to upload does not stop the others.
+
+        :param file_names: names of the files to upload.
+        :type file_names: list of str
+        :param memory_budget: maximum size (in MB) of the parts in flight
+            of all uploads together; None for no limit.
+        :type memory_budget: int
+
+        See :py:meth:`upload` for the other parameters.
+
+        :returns: list of (file_name, archive_id, sha256hash, exc_info),
+            in the order of file_names. exc_info is the
+            :py:func:`sys.exc_info` of the failure, or None if the file
+            was uploaded.
+        :rtype: list
+        """
+
+        sizes = {}
+        for file_name in file_names:
+            try:
+                sizes[file_name] = os.path.getsize(file_name)
+            except OSError:
+                sizes[file_name] = 0
+
+        budget = UploadBudget(concurrency,
+                              memory_budget * 1024 * 1024 if memory_budget else None)
+        results = {}
+        lock = threading.Lock()
+
+        def upload_file(file_name):
+            try:
+                archive_id, sha256hash = self._worker_clone().upload(
+                    vault_name, file_name, description, region, False,
+                    alternative_name, part_size, None, resume,
+                    jobs=jobs, readahead=readahead, paranoid=paranoid,
+                    budget=budget, compression=compression,
+                    compression_level=compression_level)
+                result = (file_name, archive_id, sha256hash, None)
+            except Exception:
+                self.logger.warning('Upload of %s failed: %s'% (file_name, sys.exc_info()[1]))
+                result = (file_name, None, None, sys.exc_info())
+
+            with lock:
+                results[file_name] = result
+                uploaded = sum(sizes[name] for name in results)
+                msg = 'Uploaded %s of %s files, %s of %s.' \
+                      % (len(results), len(file_names),
+                         self._size_fmt(uploaded),
+                         self._size_fmt(sum(sizes.values())))
+                self._progress(msg)
+                self.logger.debug(msg)
+
+        pool = ThreadPool(max(1, min(concurrency, len(file_names))))
+        try:
+            pool.map(upload_file, sorted(set(file_names), key=sizes.get, reverse=True), 1)
+        finally:
+            pool.terminate()
+
+        self._progress('\n')
+        return [results[file_name] for file_name in file_names]
+
+    @sdb_connect
+    @log_class_call("Looking for the file in the vault.",
+                    "Looking for the file in the vault done.")
+    def find_archive(self, vault_name, file_name, region, jobs=1):
+        """
+        Looks for an archive in the vault with the same SHA256 tree hash
+        and size as a file, in the archive index (filled from the vault
+        inventory and by uploads) and, if bookkeeping is enabled, in the
+        bookkeeping database. The tree hash of the file is taken from the
+        tree hash cache, or calculated with jobs threads.
+
+        :param jobs: number of threads to hash with, 0 to use all
+            available cores.
+        :type jobs: int
+
+        :returns: Tuple of (archive_id or None, tree hash, size).
+        :rtype: tuple
+        """
+
+        self._check_vault_name(vault_name)
+        tree_hash = self.get_tree_hash(file_name, jobs=jobs)
+        size = os.path.getsize(file_name)
+        index = self._get_archive_index()
+        archive_id = index.find(region, vault_name, tree_hash, size) if index else None
+        if not archive_id and self.bookkeeping:
+            query = "select * from `%s` where vault='%s' and hash='%s'" \
+                    % (self.bookkeeping_domain_name, vault_name, tree_hash)
+            for item in self.sdb_domain.select(query):
+                # Files packed in a bundle are not archives of their own.
+                if int(item.get('size', -1)) == size and not item.get('bundle'):
+                    archive_id = item.get('archive_id')
+                    break
+
+        if archive_id:
+            self.logger.info('%s is already in vault %s as archive %s.'
+                             % (file_name, vault_name, archive_id))
+
+        return archive_id, tree_hash, size
+
+    @glacier_connect
+    @sdb_connect
+    @log_class_call("Uploading with deduplication.",
+                    "Upload with deduplication finished.")
+    def upload_dedup(self, vault_name, file_name, description, region,
+                     stdin, alternative_name, part_size, jobs=1,
+                     concurrency=1, readahead=1):
+        """
+        Uploads a file, or data from stdin, with deduplication: only the
+        chunks of the data that are not yet stored in the vault are
+        uploaded, packed in one archive. A recipe to put the data
+        together again is uploaded as an archive of its own; see
+        :py:mod:`glacier.dedup`.
+
+        See :py:meth:`upload` for the parameters.
+
+        :returns: Tuple of (recipe archive_id, sha256hash of the data,
+            size of the data, size of the new chunks).
+        :rtype: tuple
+        :raises: :py:exc:`glacier.glacierexception.InputException`,
+                 :py:exc:`glacier.glacierexception.ResponseException`
+        """
+
+        self._check_vault_name(vault_name)
+        self._check_region(region)
+        if stdin:
+            source = sys.stdin
+        else:
+            if not file_name:
+                raise InputException(
+                    "No file name given for upload.",
+                    code='CommandError')
+
+            try:
+                source = open(file_name, 'rb')
+            except IOError as e:
+                raise InputException(
+                    "Could not access file: %s."% file_name,
+                    cause=e,
+                    code='FileError')
+
+        name = alternative_name or file_name or 'Data from stdin.'
+        description = description or name
+        self._check_vault_description(description + RECIPE_TAG)
+        store = self._get_dedup_store()
+        reader = DedupReader(source, store.lookup(vault_name, region))
+        try:
+            # Everything may be stored already; then there is no chunk
+            # archive to upload.
+            pack_id = None
+            if reader.has_data():
+                pack_id, pack_hash = self.upload(
+                    vault_name, None, description + CHUNKS_TAG, region, False,
+                    name + CHUNKS_TAG, part_size, None, False, jobs=jobs,
+                    concurrency=concurrency, readahead=readahead, reader=reader)
+                store.add(vault_name, region, pack_id, reader.new_chunks)
+        finally:
+            if not stdin:
+                source.close()
+
+        recipe = reader.recipe(pack_id, name)
+        self.logger.info('%s chunks, %s new: uploaded %s of %s.'
+                         % (len(recipe['Chunks']), len(reader.new_chunks),
+                            self._size_fmt(reader.pack_size),
+                            self._size_fmt(recipe['Size'])))
+        recipe_id, recipe_hash = self.upload(
+            vault_name, None, description + RECIPE_TAG, region, False, name,
+            part_size, None, False, reader=StringIO.StringIO(json.dumps(recipe)))
+        store.save_recipe(recipe_id, recipe)
+        return (recipe_id, recipe['SHA256TreeHash'], recipe['Size'], reader.pack_size)
+
+    @glacier_connect
+    @sdb_connect
+    @log_class_call("Uploading files packed in tar bundles.",
+                    "Upload of tar bundles finished.")
+    def upload_packed(self, vault_name, file_names, description, region,
+                      bundle_size, part_size, jobs=1, concurrency=1,
+                      readahead=1):
+        """
+        Packs files into tar bundles of about bundle_size MB, and uploads
+        every bundle as an archive. The bundles are made while they are
+        uploaded, without temporary files. If bookkeeping is enabled, the
+        archive, offset and size within the bundle of every file are
+        stored, so a file can be retrieved on its own with a ranged
+        retrieval.
+
+        :param file_names: names of the files to pack.
+        :type file_names: list of str
+        :param bundle_size: target size (in MB) of the bundles.
+        :type bundle_size: int
+
+        See :py:meth:`upload` for the other parameters.
+
+        :returns: list of (member, archive_id, sha256hash), one for every
+            file, with member the :py:class:`packer.TarMember` of the
+            file and the archive and hash those of its bundle.
+        :rtype: list
+        :raises: :py:exc:`glacier.glacierexception.InputException`,
+                 :py:exc:`glacier.glacierexception.ResponseException`
+        """
+
+        results = []
+        started = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+        for number, bundle in enumerate(packer.bundles(file_names, bundle_size * 1024 * 1024)):
+            bundle_name = 'bundle-%s-%s.tar' % (started, number + 1)
+            self.logger.info('Packing %s files in %s (%s).'
+                             % (len(bundle.members), bundle_name, self._size_fmt(bundle.size)))
+            archive_id, sha256hash = self.upload(
+                vault_name, None,
+                description or 'Tar bundle of %s files.' % len(bundle.members),
+                region, False, bundle_name, part_size, None, False,
+                jobs=jobs, concurrency=concurrency, readahead=readahead,
+                reader=bundle)
+
+            if self.bookkeeping:
+                self.logger.info('Writing the index of %s into the bookkeeping database.' % bundle_name)
+                date = '%s' % datetime.utcnow().replace(tzinfo=pytz.utc)
+
+                # Keyed by bundle and name, as different bundles may hold
+                # files of the same name.
+                items = dict(('%s/%s' % (archive_id, member.name),
+                              {'region': region,
+                               'vault': vault_name,
+                               'filename': member.name,
+                               'archive_id': archive_id,
+                               'bundle': bundle_name,
+                               'offset': member.offset,
+                               'size': member.size,
+                               'hash': member.tree_hash,
+                               'date': date})
+                             for member in bundle.members)
+
+                # SimpleDB takes at most 25 items per batch.
+                names = sorted(items)
+                for i in range(0, len(names), 25):
+                    self.sdb_domain.batch_put_attributes(
+                        dict((name, items[name]) for name in names[i:i+25]))
+
+            results += [(member, archive_id, sha256hash) for member in bundle.members]
+
+        return results
+
 
     @glacier_connect
     @log_class_call("Processing archive retrieval job.",
@@ -1342,10 +2163,25 @@ using %s MB parts to upload." % part_size)
     @log_class_call("Download an archive.",
                     "Download archive done.")
     def download(self, vault_name, archive_id, part_size,
-                 out_file_name=None, overwrite=False):
+                 out_file_name=None, overwrite=False, decompress=True,
+                 concurrency=1, resume=False, memory_budget=None):
         """
         Download a file from Glacier, and store it in out_file.
         If no out_file is given, the file will be dumped on stdout.
+        Archives that were compressed on upload are decompressed on the
+        fly, unless decompress is False.
+
+        Up to concurrency parts are fetched at the same time, and
+        written at their place in out_file; see :py:mod:`rangedownload`.
+        Compressed archives are then decompressed once all parts are
+        there. A checkpoint next to out_file records the parts written
+        (see :py:mod:`checkpoint`); with resume, the parts the checkpoint
+        of an earlier, interrupted download lists are not fetched again.
+
+        To stdout, the parts are written in order, also with concurrency
+        1. Parts are held in memory until they are checked and it is
+        their turn, up to memory_budget MB (default 256 MB); when that is
+        full, fetching waits for stdout.
         """
 
         # Sanity checking on the input.
@@ -1372,15 +2208,34 @@ your archive ID is correct, and start a retrieval job using \
 'getarchive' if necessary.",
                 code='IdError')
 
+        # The checkpoint of an earlier attempt tells which parts of the
+        # file are there already.
+        total_size = download_job['ArchiveSizeInBytes']
+        checkpoint = None
+        if out_file_name and resume:
+            checkpoint = DownloadCheckpoint.open(out_file_name)
+            if checkpoint and not (checkpoint.matches(archive_id, total_size,
+                                                      download_job['SHA256TreeHash'])
+                                   and os.path.isfile(out_file_name)
+                                   and os.path.getsize(out_file_name) == total_size):
+                self.logger.warning('Checkpoint %s is not of this archive; downloading all of it.'% checkpoint.path)
+                checkpoint = None
+            elif checkpoint:
+                self.logger.info('Resuming download; %s of %s are there already.'
+                                 % (self._size_fmt(checkpoint.size_done),
+                                    self._size_fmt(total_size)))
+            else:
+                self.logger.warning('No checkpoint found for %s; downloading all of it.'% out_file_name)
+
         # Check whether we can access the file the archive has to be written to.
         out_file = None
         if out_file_name:
-            if os.path.isfile(out_file_name) and not overwrite:
+            if os.path.isfile(out_file_name) and not overwrite and not checkpoint:
                 raise InputException(
                     "File exists already, aborting. Use the overwrite flag to overwrite existing file.",
                     code="FileError")
             try:
-                out_file = open(out_file_name, 'w')
+                out_file = open(out_file_name, 'r+b' if checkpoint else 'w')
             except IOError as e:
                 raise InputException(
                     "Cannot access the ouput file.",
@@ -1388,11 +2243,12 @@ your archive ID is correct, and start a retrieval job using \
                     code='FileError')
 
         # Sanity checking done; start downloading the file, part by part.
-        total_size = download_job['ArchiveSizeInBytes']
-        part_size_in_bytes = self._check_part_size(part_size, total_size) * 1024 * 1024
-        start_bytes = downloaded_size = 0
-        hash_list = []
-        start_time = current_time = previous_time = time.time()
+        if checkpoint:
+            part_size_in_bytes = checkpoint.part_size
+        else:
+            part_size_in_bytes = self._check_part_size(part_size, total_size) * 1024 * 1024
+
+        start_time = time.time()
 
         # Log our pending action.
         if out_file:
@@ -1400,79 +2256,223 @@ your archive ID is correct, and start a retrieval job using \
         else:
             self.logger.debug('Starting download of archive to stdout.')
 
-        # Download the data, one part at a time.
-        while downloaded_size < total_size:
+        if out_file:
+            # Fetch up to concurrency parts at a time, each written at its
+            # place, and keep a checkpoint of the parts written.
+            if not checkpoint:
+                checkpoint = DownloadCheckpoint.create(
+                    out_file_name, vault_name, archive_id, total_size,
+                    download_job['SHA256TreeHash'], part_size_in_bytes)
+
+            tree_hash, description = self._download_ranges(
+                vault_name, download_job, out_file, part_size_in_bytes,
+                concurrency, start_time, checkpoint)
+
+            # Done, or the data is no good to resume from.
+            checkpoint.remove()
+            downloaded_size = total_size
+        else:
+            # Fetch up to concurrency parts at a time, and put them in
+            # order again for stdout. Every part is checked as it comes
+            # in, and fetched again if it is bad and none of it has been
+            # written yet.
+            tree_hash = self._stream_ranges(
+                vault_name, download_job, part_size_in_bytes, concurrency,
+                memory_budget * 1024 * 1024 if memory_budget else None,
+                decompress, start_time)
+            downloaded_size = total_size
+
+        if tree_hash != download_job['SHA256TreeHash']:
+            raise CommunicationException(
+                "Downloaded data hash mismatch",
+                code="DownloadError",
+                cause=None)
+
+        # Parts written at their place can only be decompressed once they
+        # are all there.
+        if out_file and decompress:
+            codec = self._archive_compression(archive_id, description=description)
+            if codec:
+                self.logger.info('Archive is compressed with %s; decompressing.'% codec)
+                self._decompress_file(out_file_name, codec)
+
+        self.logger.debug('Download of archive finished successfully.')
+        current_time = time.time()
+        overall_rate = int(downloaded_size/(current_time - start_time))
+        msg = 'Wrote %s. Rate %s/s.\n' % (self._size_fmt(downloaded_size),
+                                            self._size_fmt(overall_rate, 2))
+        self._progress(msg)
+        self.logger.info(msg)
+
+    @glacier_connect
+    @sdb_connect
+    @log_class_call("Download a deduplicated upload.",
+                    "Download of deduplicated upload done.")
+    def download_dedup(self, vault_name, archive_id, out_file_name=None,
+                       overwrite=False):
+        """
+        Puts the data of a deduplicated upload together again from its
+        recipe, archive_id, and the chunk archives it refers to, and
+        stores it in out_file. If no out_file is given, the data is
+        written to stdout.
+
+        The recipe is taken from the local store if it is there; else it
+        has to be retrieved like any archive. Retrieval jobs are started
+        for the chunk archives that are not available yet.
+
+        :raises: :py:exc:`glacier.glacierexception.CommunicationException`,
+                 :py:exc:`glacier.glacierexception.InputException`,
+                 :py:exc:`glacier.glacierexception.ResponseException`
+        """
+
+        self._check_vault_name(vault_name)
+        self._check_id(archive_id, 'ArchiveId')
+
+        # Completed retrieval jobs, by archive.
+        jobs = {}
+        running = set()
+        for job in self.list_jobs(vault_name):
+            if job.get('ArchiveId'):
+                if job['Completed']:
+                    jobs[job['ArchiveId']] = job
+                else:
+                    running.add(job['ArchiveId'])
+
+        recipe = self._get_dedup_store().load_recipe(archive_id)
+        if not recipe:
+            if archive_id not in jobs:
+                raise CommunicationException(
+                    "Recipe not available. Please start a retrieval job for it using 'getarchive' and try again later.",
+                    code='NotReady')
 
-            # Read a part of data.
-            from_bytes = downloaded_size
-            to_bytes = min(downloaded_size + part_size_in_bytes, total_size)
+            recipe = parse_recipe(self._job_output(vault_name, archive_id, jobs[archive_id]['JobId']))
+
+        # All chunk archives must be available before anything is written.
+        missing = sorted(set(chunk[0] for chunk in recipe['Chunks']) - set(jobs))
+        if missing:
+            for chunk_archive_id in missing:
+                if chunk_archive_id not in running:
+                    self.getarchive(vault_name, chunk_archive_id)
+
+            raise CommunicationException(
+                'Retrieval of %s chunk archive%s not completed yet: %s. Please try again later.'
+                % (len(missing), '' if len(missing) == 1 else 's', ', '.join(missing)),
+                code='NotReady')
+
+        out_file = sys.stdout
+        if out_file_name:
+            if os.path.isfile(out_file_name) and not overwrite:
+                raise InputException(
+                    "File exists already, aborting. Use the overwrite flag to overwrite existing file.",
+                    code="FileError")
             try:
-                response = self.glacierconn.get_job_output(vault_name,
-                                                            download_job['JobId'],
-                                                            byte_range=(from_bytes, to_bytes-1))
-                data = response.read()
-            except boto.glacier.exceptions.UnexpectedHTTPResponseError as e:
-                raise ResponseException(
-                    'Failed to download archive %s.'% archive_id,
-                    cause=self._decode_error_message(e.body),
-                    code=e.code)
+                out_file = open(out_file_name, 'wb')
+            except IOError as e:
+                raise InputException(
+                    "Cannot access the ouput file.",
+                    cause=e,
+                    code='FileError')
 
-            hash_list.append(glaciercorecalls.chunk_hashes(data)[0])
-            downloaded_size = to_bytes
-            if out_file:
-                try:
-                    out_file.write(response.read())
-                except IOError as e:
-                    raise InputException(
-                        "Cannot write data to the specified file.",
-                        cause=e,
-                        code='FileError')
-            else:
-                sys.stdout.write(response.read())
-                sys.stdout.flush()
+        # Chunks that follow each other in the same archive are fetched
+        # with one request.
+        def ranges(chunks, max_size=64 * 1024 * 1024):
+            group = []
+            for chunk in chunks:
+                if group and (chunk[0] != group[-1][0] or
+                              chunk[1] != group[-1][1] + group[-1][2] or
+                              chunk[1] + chunk[2] - group[0][1] > max_size):
+                    yield group
+                    group = []
 
-            # Calculate progress statistics.
-            current_time = time.time()
-            overall_rate = int((downloaded_size-start_bytes)/(current_time - start_time))
-            current_rate = int(part_size_in_bytes/(current_time - previous_time))
+                group.append(chunk)
 
-            # Estimate finish time, based on overall transfer rate.
-            time_left = (total_size - downloaded_size)/overall_rate
-            eta_seconds = current_time + time_left
-            if datetime.fromtimestamp(eta_seconds).day is not\
-                    datetime.now().day:
-                eta_template = "%a, %d %b, %H:%M:%S"
-            else:
-                eta_template = "%H:%M:%S"
+            if group:
+                yield group
 
-            eta = time.strftime(eta_template, time.localtime(eta_seconds))
-            msg = 'Read %s of %s (%s%%). Rate %s/s, average %s/s, ETA %s.' \
-                  % (self._size_fmt(downloaded_size),
-                     self._size_fmt(total_size),
-                     self._bold(str(int(100 * downloaded_size/total_size))),
-                     self._size_fmt(current_rate, 2),
-                     self._size_fmt(overall_rate, 2),
-                     eta)
-            self._progress(msg)
-            previous_time = current_time
-            self.logger.debug(msg)
+        hasher = glaciercorecalls.TreeHasher()
+        start_time = time.time()
+        try:
+            for group in ranges(recipe['Chunks']):
+                chunk_archive_id, start = group[0][0], group[0][1]
+                data = self._job_output(vault_name, chunk_archive_id,
+                                        jobs[chunk_archive_id]['JobId'],
+                                        (start, group[-1][1] + group[-1][2] - 1))
+                for chunk_archive_id, offset, size, digest in group:
+                    chunk = data[offset - start:offset - start + size]
+                    if hashlib.sha256(chunk).hexdigest() != digest:
+                        raise CommunicationException(
+                            "Downloaded chunk hash mismatch",
+                            code="DownloadError",
+                            cause='Chunk at %s in archive %s.' % (offset, chunk_archive_id))
+
+                    hasher.update(chunk)
+                    try:
+                        out_file.write(chunk)
+                    except IOError as e:
+                        raise InputException(
+                            "Cannot write data to the specified file.",
+                            cause=e,
+                            code='FileError')
+
+                self._progress('Read %s of %s (%s%%).'
+                               % (self._size_fmt(hasher.size),
+                                  self._size_fmt(recipe['Size']),
+                                  self._bold(str(int(100 * hasher.size / max(1, recipe['Size']))))))
+        finally:
+            if out_file_name:
+                out_file.close()
+            else:
+                out_file.flush()
 
-        if out_file:
-            out_file.close()
-        if glaciercorecalls.bytes_to_hex(glaciercorecalls.tree_hash(hash_list)) != download_job['SHA256TreeHash']:
+        if hasher.hexdigest() != recipe['SHA256TreeHash']:
             raise CommunicationException(
                 "Downloaded data hash mismatch",
                 code="DownloadError",
                 cause=None)
 
-        self.logger.debug('Download of archive finished successfully.')
-        current_time = time.time()
-        overall_rate = int(downloaded_size/(current_time - start_time))
-        msg = 'Wrote %s. Rate %s/s.\n' % (self._size_fmt(downloaded_size),
-                                            self._size_fmt(overall_rate, 2))
+        overall_rate = int(hasher.size/max(time.time() - start_time, 0.001))
+        msg = 'Wrote %s. Rate %s/s.\n' % (self._size_fmt(hasher.size),
+                                          self._size_fmt(overall_rate, 2))
         self._progress(msg)
         self.logger.info(msg)
 
+    def _job_output(self, vault_name, archive_id, job_id, byte_range=None):
+        """
+        Returns the data of a completed archive retrieval job, or a byte
+        range (first, last) of it.
+        """
+
+        try:
+            response = self.glacierconn.get_job_output(vault_name, job_id,
+                                                       byte_range=byte_range)
+            return read_shaped(response, self.bandwidth)
+        except boto.glacier.exceptions.UnexpectedHTTPResponseError as e:
+            raise ResponseException(
+                'Failed to download archive %s.'% archive_id,
+                cause=self._decode_error_message(e.body),
+                code=e.code)
+
+    def _archive_compression(self, archive_id, response=None, description=None):
+        """
+        Returns the codec an archive was compressed with on upload, or
+        None. Taken from the archive description that Amazon Glacier
+        sends with the archive data (in response, or as description),
+        else from the bookkeeping database.
+        """
+
+        description = description or archive_description(response)
+        if description:
+            codec, size = glacier_compression.parse_description(description)
+            if codec:
+                return codec
+
+        if self.bookkeeping:
+            query = "select * from `%s` where archive_id='%s'" % (self.bookkeeping_domain_name, archive_id)
+            for item in self.sdb_domain.select(query):
+                return item.get('compression')
+
+        return None
+
     @glacier_connect
     @sdb_connect
     @log_class_call("Searching for archive.",
@@ -1589,6 +2589,14 @@ your archive ID is correct, and start a retrieval job using \
                 cause=self._decode_error_message(e.body),
                 code=e.code)
 
+        index = self._get_archive_index()
+        if index:
+            index.forget(archive_id)
+
+        # Chunks in the archive can not be used for deduplication anymore.
+        if os.path.isdir(os.path.expanduser(self.dedup_dir or DedupStore.DEFAULT_DIR)):
+            self._get_dedup_store().forget(archive_id)
+
         # Remove the listing from the bookkeeping database.
         if self.bookkeeping:
             try:
@@ -1676,6 +2684,11 @@ your archive ID is correct, and start a retrieval job using \
                 inventory = response.copy()
                 archives = []
 
+                # Keep the archive index up to date, for --skip-existing.
+                index = self._get_archive_index()
+                if index:
+                    index.update_inventory(self.region, vault_name, inventory)
+
                 # If bookkeeping is enabled, update cache.
                 # Add all inventory information to the database, then check
                 # for any archives listed in the database for that vault and
@@ -1720,12 +2733,14 @@ your archive ID is correct, and start a retrieval job using \
                                 code="SdbWriteError")
 
                     # Get the inventory from the database for this vault,
-                    # and delete any orphaned items.
+                    # and delete any orphaned items. The files in a tar
+                    # bundle are kept as long as their bundle exists.
                     query = "select * from `%s` where vault='%s'" % (self.bookkeeping_domain_name, vault_name)
                     result = self.sdb_domain.select(query)
                     try:
                         for item in result:
-                            if not item.name in archives:
+                            archive_id = item.get('archive_id') if item.get('bundle') else item.name
+                            if not archive_id in archives:
                                 self.sdb_domain.delete_item(item)
                                 self.logger.debug('Deleted orphaned archive from the database: %s.'% item.name)
 
@@ -1753,12 +2768,207 @@ your archive ID is correct, and start a retrieval job using \
 
         return (inventory_job, inventory)
 
-    def get_tree_hash(self, file_name):
+    def _get_hash_cache(self):
+        """
+        Returns the tree hash cache, opening it on first use. Returns None
+        if the cache is disabled or can not be opened.
+
+        :returns: the cache.
+        :rtype: :py:class:`glacier.hashcache.TreeHashCache`
         """
-        Calculate the tree hash of a file.
+
+        if self.hash_cache and not self.tree_hash_cache:
+            try:
+                self.tree_hash_cache = TreeHashCache(self.hash_cache_path,
+                                                     self.hash_cache_size,
+                                                     logger=self.logger)
+            except Exception as e:
+                self.logger.warning('Can not open the tree hash cache, continuing without: %s' % e)
+                self.hash_cache = False
+
+        return self.tree_hash_cache
+
+    def _leaf_hashes(self, hasher, file_name, start=0, stop=None):
+        """
+        Hashes the byte range [start, stop) of a file. Returns the hashes
+        of its 1 MB chunks one after the other in a bytearray, for the
+        tree hash cache, and its tree hash as binary string.
+        """
+
+        leaves = bytearray()
+        tree = glaciercorecalls.TreeHasher()
+        for leaf in hasher.file_leaf_hashes(file_name, start, stop):
+            leaves += leaf
+            tree.add_hash(leaf)
+
+        return leaves, tree.digest()
+
+    def _get_archive_index(self):
+        """
+        Returns the archive index, opening it on first use. Returns None
+        if it can not be opened.
+
+        :returns: the index.
+        :rtype: :py:class:`glacier.archiveindex.ArchiveIndex`
+        """
+
+        if not self.archive_index:
+            try:
+                self.archive_index = ArchiveIndex(self.archive_index_path)
+            except Exception as e:
+                self.logger.warning('Can not open the archive index, continuing without: %s' % e)
+
+        return self.archive_index
+
+    def _get_dedup_store(self):
+        """
+        Returns the deduplication store, opening it on first use.
+
+        :returns: the store.
+        :rtype: :py:class:`glacier.dedup.DedupStore`
+        """
+
+        if not self.dedup_store:
+            self.dedup_store = DedupStore(self.dedup_dir)
+
+        return self.dedup_store
+
+    def _list_parts_ahead(self, vault_name, uploadid):
+        """
+        Iterates over the parts of a multipart upload, as listed by
+        Amazon Glacier. The next page of the list is fetched in the
+        background while the parts of the current page are processed.
+
+        :raises: :py:exc:`glacier.glacierexception.ResponseException`
+        """
+
+        pages = Queue.Queue(2)
+        stopped = threading.Event()
+        def fetch_pages():
+            marker = None
+            try:
+                while not stopped.is_set():
+                    response = self.glacierconn.list_parts(vault_name, uploadid, marker=marker).copy()
+                    pages.put((response['Parts'], None))
+                    marker = response['Marker']
+                    if not marker:
+                        break
+
+            except Exception:
+                pages.put((None, sys.exc_info()))
+                return
+
+            pages.put((None, None))
+
+        fetcher = threading.Thread(target=fetch_pages, name='list_parts')
+        fetcher.daemon = True
+        fetcher.start()
+        try:
+            while True:
+                parts, exc_info = pages.get()
+                if exc_info:
+                    if isinstance(exc_info[1], boto.glacier.exceptions.UnexpectedHTTPResponseError):
+                        raise ResponseException(
+                            'Failed to get a list already uploaded parts for interrupted upload %s.'% uploadid,
+                            cause=self._decode_error_message(exc_info[1].body),
+                            code=exc_info[1].code)
+
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                if parts is None:
+                    break
+
+                for part in parts:
+                    yield part
+
+        finally:
+            # Stopped early: let the fetcher finish its current page.
+            stopped.set()
+            while not pages.empty():
+                pages.get()
+
+    def _imap_ahead(self, pool, func, iterable, depth):
+        """
+        Like pool.imap, but keeps at most depth items in progress, and
+        errors raised by iterable surface in the calling thread.
+        """
+
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= depth:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+    def _check_stdin_part(self, reader, part):
+        """
+        Reads the data of an uploaded part from stdin, 1 MB at a time,
+        and takes its tree hash. Returns the part, the size of the data
+        read and its tree hash; no chunk hashes.
+        """
+
+        start, stop = (int(p) for p in part['RangeInBytes'].split('-'))
+        part_hasher = glaciercorecalls.TreeHasher()
+        while part_hasher.size < stop + 1 - start:
+            data = reader.read(min(part_hasher.CHUNK_SIZE,
+                                   stop + 1 - start - part_hasher.size))
+            if not data:
+                break
+
+            part_hasher.update(data)
+
+        return part, part_hasher.size, part_hasher.digest(), None
+
+    def _find_journal(self, vault_name, file_name):
+        """
+        Returns the journal of an unfinished upload of the file to the
+        vault, or None.
+
+        :returns: the journal.
+        :rtype: :py:class:`glacier.journal.UploadJournal`
+        """
+
+        try:
+            return UploadJournal.find(self.journal_dir, vault_name,
+                                      self.region, file_name)
+        except EnvironmentError as e:
+            self.logger.warning('Can not read the upload journals: %s' % e)
+            return None
+
+    def _create_journal(self, uploadid, vault_name, file_name, part_size,
+                        identity, parts):
+        """
+        Starts the journal of an upload, with the parts that are already
+        uploaded. Returns None if the journal can not be written; the
+        upload goes on without.
+
+        :returns: the journal.
+        :rtype: :py:class:`glacier.journal.UploadJournal`
+        """
+
+        try:
+            journal = UploadJournal.create(self.journal_dir, uploadid,
+                                           vault_name, self.region,
+                                           file_name, part_size, identity)
+            journal.record_parts(parts)
+            return journal
+        except EnvironmentError as e:
+            self.logger.warning('Can not write the upload journal, continuing without: %s' % e)
+            return None
+
+    def get_tree_hash(self, file_name, jobs=1):
+        """
+        Calculate the tree hash of a file. If the file did not change
+        since it was hashed last, the hash is taken from the tree hash
+        cache.
 
         :param file_name: the file name to calculate a hash of.
         :type file_name: str
+        :param jobs: number of threads to hash with, 0 to use all
+            available cores.
+        :type jobs: int
 
         :returns: the tree hash of the file.
         :rtype: str
@@ -1772,8 +2982,32 @@ your archive ID is correct, and start a retrieval job using \
                 cause=e,
                 code='FileError')
 
-        hashes = [hashlib.sha256(part).digest() for part in iter((lambda:reader.read(1024 * 1024)), '')]
-        return glaciercorecalls.bytes_to_hex(glaciercorecalls.tree_hash(hashes))
+        reader.close()
+        cache = self._get_hash_cache()
+        if cache:
+            key = cache.key(file_name)
+            entry = cache.get(key)
+            if entry:
+                data_hash = entry.range_tree_hash(0, key[2])
+                if entry.tree_hash or data_hash:
+                    self.logger.info('Tree hash of %s taken from the cache.' % file_name)
+                    return entry.tree_hash or glaciercorecalls.bytes_to_hex(data_hash)
+
+        leaves = None
+        hasher = glaciercorecalls.ParallelTreeHasher(jobs, self.page_cache)
+        try:
+            if cache and cache.wants_leaves(key[2]):
+                leaves, data_hash = self._leaf_hashes(hasher, file_name)
+            else:
+                data_hash = hasher.file_tree_hash(file_name)
+        finally:
+            hasher.close()
+
+        tree_hash = glaciercorecalls.bytes_to_hex(data_hash)
+        if cache:
+            cache.put(key, tree_hash=tree_hash, leaves=leaves)
+
+        return tree_hash
 
     def _init_events_for_vault(self, vault_name, topic):
         config = {
@@ -1976,7 +3210,17 @@ your archive ID is correct, and start a retrieval job using \
     def __init__(self, aws_access_key, aws_secret_key, region,
                  bookkeeping=False, no_bookkeeping=None, bookkeeping_domain_name=None,
                  sdb_access_key=None, sdb_secret_key=None, sdb_region=None,
-                 logfile=None, loglevel='WARNING', logtostdout=True):
+                 logfile=None, loglevel='WARNING', logtostdout=True,
+                 hash_cache=True, hash_cache_path=None,
+                 hash_cache_size=TreeHashCache.DEFAULT_MAX_SIZE,
+                 max_attempts=RetryPolicy.DEFAULT_MAX_ATTEMPTS,
+                 backoff=RetryPolicy.DEFAULT_BACKOFF,
+                 max_backoff=RetryPolicy.DEFAULT_MAX_BACKOFF,
+                 jitter=RetryPolicy.DEFAULT_JITTER,
+                 retry_on=RetryPolicy.DEFAULT_RETRY_ON,
+                 journal_dir=None, dedup_dir=None, archive_index=None,
+                 spool_dir=None, page_cache='keep', bandwidth=None,
+                 bandwidth_windows=None):
         """
         Constructor, sets up important variables and so for GlacierWrapper.
 
@@ -2002,6 +3246,44 @@ your archive ID is correct, and start a retrieval job using \
         :type loglevel: str
         :param logtostdout: whether to log messages to stdout instead of to file.
         :type logtostdout: boolean
+        :param hash_cache: whether to use the local tree hash cache.
+        :type hash_cache: boolean
+        :param hash_cache_path: file name of the tree hash cache database.
+        :type hash_cache_path: str
+        :param hash_cache_size: maximum size of the tree hash cache in MB.
+        :type hash_cache_size: int
+        :param max_attempts: maximum number of attempts to upload a part.
+        :type max_attempts: int
+        :param backoff: seconds to wait before the first retry; doubles
+            with every retry.
+        :type backoff: float
+        :param max_backoff: maximum number of seconds between retries.
+        :type max_backoff: float
+        :param jitter: fraction of the wait between retries that is
+            randomised.
+        :type jitter: float
+        :param retry_on: error codes on which to retry, see
+            :py:attr:`GlacierException.ERRORCODE`.
+        :type retry_on: list of str
+        :param journal_dir: directory for the journals of uploads.
+        :type journal_dir: str
+        :param dedup_dir: directory for the index of deduplicated chunks
+            and the recipes of deduplicated uploads.
+        :type dedup_dir: str
+        :param archive_index: file name of the index of the archives in
+            the vaults, used to skip files that are uploaded already.
+        :type archive_index: str
+        :param spool_dir: directory to spool uploads from stdin to.
+        :type spool_dir: str
+        :param page_cache: how to read files with regard to the page
+            cache: 'keep', 'drop' or 'direct', see :py:mod:`partreader`.
+        :type page_cache: str
+        :param bandwidth: maximum transfer rate in MB/s of all uploads
+            and downloads together; None or 0 for no limit.
+        :type bandwidth: float
+        :param bandwidth_windows: time windows with another maximum
+            rate, like '01:00-06:00=0', see :py:func:`shaping.parse_windows`.
+        :type bandwidth_windows: list of str
         """
 
         self.aws_access_key = aws_access_key
@@ -2019,10 +3301,33 @@ your archive ID is correct, and start a retrieval job using \
         self.sdb_secret_key = sdb_secret_key if sdb_secret_key else aws_secret_key
         self.sdb_region = sdb_region if sdb_region else region
 
+        self.hash_cache = hash_cache
+        self.hash_cache_path = hash_cache_path
+        self.hash_cache_size = hash_cache_size
+        self.tree_hash_cache = None
+        self.journal_dir = journal_dir
+        self.spool_dir = spool_dir
+        self.page_cache = page_cache
+
+        # One token bucket for all transfers of the process.
+        schedule = BandwidthSchedule(parse_rate(bandwidth),
+                                     parse_windows(bandwidth_windows or []))
+        self.bandwidth = TokenBucket(schedule) if schedule.limited() else None
+        self.dedup_dir = dedup_dir
+        self.dedup_store = None
+        self.archive_index_path = archive_index
+        self.archive_index = None
+        self.progress = True
+
         self.setuplogging(logfile, loglevel, logtostdout)
         self.logger = logging.getLogger(self.__class__.__name__)
 
         self._check_region(region)
+        self.retry_policy = RetryPolicy(max_attempts=max_attempts,
+                                        backoff=backoff,
+                                        max_backoff=max_backoff,
+                                        jitter=jitter,
+                                        retry_on=retry_on)
 
         self.logger.debug("""\
 Creating GlacierWrapper instance with
@@ -2037,9 +3342,15 @@ Creating GlacierWrapper instance with
     sdb_region=%s,
     logfile %s,
     loglevel %s,
-    logging to stdout %s.""",
+    logging to stdout %s,
+    hash_cache=%s,
+    hash_cache_path=%s,
+    retry_policy=%s attempts, backoff %s-%ss, jitter %s, on %s.""",
                           aws_access_key, aws_secret_key, bookkeeping,
                           no_bookkeeping,
                           bookkeeping_domain_name, region,
                           sdb_access_key, sdb_secret_key, sdb_region,
-                          logfile, loglevel, logtostdout)
+                          logfile, loglevel, logtostdout,
+                          hash_cache, hash_cache_path,
+                          max_attempts, backoff, max_backoff, jitter,
+                          ', '.join(retry_on))
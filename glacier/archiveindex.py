@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: archiveindex
+   :platform: Unix, Windows
+   :synopsis: Local index of the archives in the vaults.
+
+Nothing stops the same file from being uploaded to a vault over and
+over. The archive index keeps, per vault, the SHA256 tree hash and size
+of every archive, from the vault inventory and from the uploads done
+since, so that a file can be checked against the vault before it is
+uploaded::
+
+    index = ArchiveIndex()
+    index.update_inventory(region, vault_name, inventory)  # After 'inventory'.
+    index.add(region, vault_name, archive_id, tree_hash, size)  # After upload.
+    archive_id = index.find(region, vault_name, tree_hash, size)
+"""
+
+import os
+import time
+import calendar
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from dateutil.parser import parse as dtparse
+
+class ArchiveIndex(object):
+    """
+    SQLite backed archive index, see the module documentation.
+    """
+
+    DEFAULT_PATH = '~/.cache/glacier-cmd/archives.sqlite'
+
+    def __init__(self, path=None):
+        """
+        :param path: file name of the index database.
+        :type path: str
+        """
+        self.path = os.path.expanduser(path or self.DEFAULT_PATH)
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, 0700)
+
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("""\
+CREATE TABLE IF NOT EXISTS archives (
+    region TEXT, vault TEXT, archive_id TEXT,
+    tree_hash TEXT, size INTEGER, description TEXT, created REAL,
+    PRIMARY KEY (region, vault, archive_id))""")
+        self.db.execute("""\
+CREATE INDEX IF NOT EXISTS archives_hash ON archives (region, vault, tree_hash, size)""")
+        self.db.commit()
+
+    @staticmethod
+    def _timestamp(date):
+        return calendar.timegm(dtparse(date).utctimetuple())
+
+    def update_inventory(self, region, vault_name, inventory):
+        """
+        Replaces the archives of a vault by those in its inventory, as
+        returned by Amazon Glacier. Archives uploaded after the
+        inventory was taken are kept.
+        """
+        self.db.execute('DELETE FROM archives WHERE region=? AND vault=? AND created<=?',
+                        (region, vault_name, self._timestamp(inventory['InventoryDate'])))
+        self.db.executemany('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            [(region, vault_name, item['ArchiveId'],
+                              item['SHA256TreeHash'], int(item['Size']),
+                              item['ArchiveDescription'],
+                              self._timestamp(item['CreationDate']))
+                             for item in inventory['ArchiveList']])
+        self.db.commit()
+
+    def add(self, region, vault_name, archive_id, tree_hash, size, description=None):
+        """
+        Adds an uploaded archive.
+        """
+        self.db.execute('INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (region, vault_name, archive_id, tree_hash, size,
+                         description, time.time()))
+        self.db.commit()
+
+    def find(self, region, vault_name, tree_hash, size):
+        """
+        Returns the ID of an archive in the vault with the tree hash (hex
+        string) and size, or None.
+        """
+        row = self.db.execute("""\
+SELECT archive_id FROM archives
+WHERE region=? AND vault=? AND tree_hash=? AND size=?
+ORDER BY created DESC""", (region, vault_name, tree_hash, size)).fetchone()
+        return row[0] if row else None
+
+    def forget(self, archive_id):
+        """
+        Removes a deleted archive.
+        """
+        self.db.execute('DELETE FROM archives WHERE archive_id=?', (archive_id,))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
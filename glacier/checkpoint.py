@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: checkpoint
+   :platform: Unix, Windows
+   :synopsis: Checkpoint of the ranges of a download that are on disk.
+
+A download that dies near the end had to start again from the first
+byte, and the output of the retrieval job may expire before it is done.
+While an archive is downloaded to a file, a checkpoint next to the file
+records every range that is written, and its tree hash::
+
+    checkpoint = DownloadCheckpoint.create(out_file_name, vault_name,
+                                           archive_id, size, tree_hash,
+                                           part_size)
+    checkpoint.record(start, stop, tree_hash)   # After every range.
+    ...
+    checkpoint.remove()                         # Download completed.
+
+``download --resume`` fetches only the ranges the checkpoint does not
+list, also with a new retrieval job of the same archive, and puts the
+tree hash of the archive together from the recorded hashes, without
+reading the file again.
+
+Like an upload journal (see :py:mod:`journal`), a checkpoint is a file
+of JSON lines: a header with the archive details, then one line per
+range. The data of a range is synced to disk before its line is
+written, and a line cut short by a crash is ignored, so the checkpoint
+is never ahead of what is on disk.
+"""
+
+import os
+import json
+import threading
+
+class DownloadCheckpoint(object):
+    """
+    Checkpoint of one download, see the module documentation.
+    """
+
+    SUFFIX = '.glacier-checkpoint'
+    VERSION = 1
+
+    def __init__(self, path, header, parts, description=None):
+        self.path = path
+        self.header = header
+        self.parts = parts
+        self.description = description
+        self.fd = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def _path(cls, file_name):
+        return os.path.abspath(file_name) + cls.SUFFIX
+
+    @classmethod
+    def create(cls, file_name, vault_name, archive_id, size, tree_hash,
+               part_size):
+        """
+        Starts a new, empty checkpoint for the download of an archive to
+        file_name, replacing an existing checkpoint of it.
+
+        :param size: size of the archive in bytes.
+        :type size: int
+        :param tree_hash: tree hash of the archive as hex string.
+        :type tree_hash: str
+        :param part_size: size of the ranges in bytes.
+        :type part_size: int
+
+        :returns: the checkpoint.
+        :rtype: :py:class:`DownloadCheckpoint`
+        """
+        path = cls._path(file_name)
+        header = {'Version': cls.VERSION,
+                  'VaultName': vault_name,
+                  'ArchiveId': archive_id,
+                  'Size': size,
+                  'SHA256TreeHash': tree_hash,
+                  'PartSize': part_size}
+
+        # Write the header to a temporary file and rename it, so there is
+        # never a checkpoint without header.
+        temp_path = path + '.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            os.write(fd, json.dumps(header) + '\n')
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.rename(temp_path, path)
+        return cls(path, header, {})
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a checkpoint file. Returns None if it is not a valid
+        checkpoint.
+        """
+        try:
+            with open(path, 'rb') as f:
+                lines = f.read().split('\n')
+        except EnvironmentError:
+            return None
+
+        # The last line is empty, or was cut short by a crash.
+        try:
+            header = json.loads(lines[0])
+            if header.get('Version') != cls.VERSION:
+                return None
+        except ValueError:
+            return None
+
+        parts = {}
+        description = None
+        for line in lines[1:-1]:
+            try:
+                part = json.loads(line)
+                parts[(part['Start'], part['Stop'])] = part['SHA256TreeHash']
+                description = part.get('ArchiveDescription', description)
+            except (ValueError, KeyError):
+                continue
+
+        return cls(path, header, parts, description)
+
+    @classmethod
+    def open(cls, file_name):
+        """
+        Returns the checkpoint of a download to file_name, or None if
+        there is none.
+        """
+        return cls.load(cls._path(file_name))
+
+    def matches(self, archive_id, size, tree_hash):
+        """
+        Whether the checkpoint is of a download of this archive.
+        """
+        return self.header['ArchiveId'] == archive_id and \
+               self.header['Size'] == size and \
+               self.header['SHA256TreeHash'] == tree_hash
+
+    @property
+    def part_size(self):
+        return self.header['PartSize']
+
+    @property
+    def size_done(self):
+        """
+        Number of bytes recorded as on disk.
+        """
+        return sum(stop - start for start, stop in self.parts)
+
+    def tree_hash(self, start, stop):
+        """
+        Returns the recorded tree hash (hex string) of the range
+        [start, stop), or None.
+        """
+        return self.parts.get((start, stop))
+
+    def record(self, start, stop, tree_hash, description=None):
+        """
+        Records that the range [start, stop) with tree hash (hex string)
+        is on disk. description is the archive description Amazon
+        Glacier sent with the data, kept to know the archive was
+        compressed when the first range is not fetched again. Returns
+        when the record is on disk.
+        """
+        line = {'Start': start, 'Stop': stop, 'SHA256TreeHash': tree_hash}
+        if description:
+            line['ArchiveDescription'] = description
+
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+        # A single write on an O_APPEND descriptor, so records written by
+        # parallel download threads do not get mixed.
+        os.write(self.fd, json.dumps(line) + '\n')
+        os.fsync(self.fd)
+        with self.lock:
+            self.parts[(start, stop)] = tree_hash
+            if description:
+                self.description = description
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def remove(self):
+        """
+        Removes the checkpoint, once the download is completed.
+        """
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
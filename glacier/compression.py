@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: compression
+   :platform: Unix, Windows
+   :synopsis: Compress data on the way to Amazon Glacier.
+
+When the network is the bottleneck, compressing the data before it is
+sent shortens the upload. :py:class:`CompressedReader` reads a file or
+stream in blocks, compresses the blocks on a pool of worker threads (zlib
+and bz2 release the GIL while compressing) and reads as the compressed
+data, in order::
+
+    if sample_ratio(file_samples(f, size)) < MAX_RATIO:
+        reader = CompressedReader(f, 'gzip', jobs=4)
+        glacier.upload(..., reader=reader)
+
+Every block is compressed on its own, into a complete gzip member, bzip2
+or xz stream. The concatenation of these is still a valid .gz, .bz2 or
+.xz file, so a downloaded archive can be decompressed by the usual
+tools as well as by :py:class:`Decompressor`.
+
+The codec and the original size are added to the archive description,
+where :py:func:`parse_description` finds them again on download.
+"""
+
+import re
+import zlib
+import bz2
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from glacierexception import *
+
+BLOCK_SIZE = 4 * 1024 * 1024
+SAMPLE_SIZE = 64 * 1024
+SAMPLES = 16
+
+# Data that does not compress to less than this fraction of its size
+# (already compressed files, media, encrypted data) is sent as it is.
+MAX_RATIO = 0.9
+
+def _compress_gzip(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def _compress_bz2(data, level):
+    return bz2.compress(data, level)
+
+def _compress_xz(data, level):
+    return lzma.compress(data, preset=level)
+
+CODECS = {'gzip': (_compress_gzip, 6),
+          'bz2': (_compress_bz2, 9)}
+
+if lzma:
+    CODECS['xz'] = (_compress_xz, 6)
+
+def check_codec(codec):
+    """
+    Raises an InputException if codec is not available.
+    """
+    if codec not in CODECS:
+        raise InputException(
+            'Unknown or unavailable compression: %s. Use one of %s.'
+            % (codec, ', '.join(sorted(CODECS))),
+            code='CommandError')
+
+def sample_ratio(samples):
+    """
+    Returns the fraction of their size the samples compress to with fast
+    zlib compression; 1.0 for no samples.
+    """
+    size = compressed = 0
+    for sample in samples:
+        size += len(sample)
+        compressed += len(zlib.compress(sample, 1))
+
+    return float(compressed) / size if size else 1.0
+
+def file_samples(f, size):
+    """
+    Reads samples of SAMPLE_SIZE bytes, spread evenly over a file of size
+    bytes. Leaves the file positioned at the start.
+    """
+    samples = []
+    count = min(SAMPLES, max(1, size // SAMPLE_SIZE))
+    for i in range(count):
+        f.seek(i * (size - SAMPLE_SIZE) // max(1, count - 1) if count > 1 else 0)
+        samples.append(f.read(SAMPLE_SIZE))
+
+    f.seek(0)
+    return samples
+
+class CompressedReader(object):
+    """
+    File-like object that reads as the compressed data of the file-like
+    object source. source is read in blocks of BLOCK_SIZE bytes, which
+    are compressed on jobs worker threads; at most 2 * jobs blocks are
+    held in memory. head is data already read from source, that comes
+    before the rest of it.
+
+    With codec None the data is passed through as it is. size_in is the
+    number of bytes read from source so far.
+    """
+
+    def __init__(self, source, codec, level=None, jobs=1, head=''):
+        self.source = source
+        self.codec = codec
+        self.jobs = jobs if jobs > 0 else multiprocessing.cpu_count()
+        self.size_in = 0
+        self.head = head
+        self.buffer = ''
+        if codec:
+            check_codec(codec)
+            self.compress, default_level = CODECS[codec]
+            self.level = default_level if level is None else level
+            self.pool = ThreadPool(self.jobs) if self.jobs > 1 else None
+        else:
+            self.pool = None
+
+        self.blocks = self._blocks()
+
+    def _read_block(self):
+        if self.head:
+            data, self.head = self.head, ''
+        else:
+            data = self.source.read(BLOCK_SIZE)
+
+        self.size_in += len(data)
+        return data
+
+    def _blocks(self):
+        if not self.codec:
+            while True:
+                data = self._read_block()
+                if not data:
+                    break
+
+                yield data
+
+        elif not self.pool:
+            while True:
+                data = self._read_block()
+                if not data:
+                    break
+
+                yield self.compress(data, self.level)
+
+        else:
+            pending = collections.deque()
+            while True:
+                data = self._read_block()
+                if not data:
+                    break
+
+                pending.append(self.pool.apply_async(self.compress, (data, self.level)))
+                del data
+                if len(pending) >= 2 * self.jobs:
+                    yield pending.popleft().get()
+
+            while pending:
+                yield pending.popleft().get()
+
+    def read(self, size=-1):
+        """
+        Reads up to size bytes of compressed data; all of it if size is
+        negative. Returns '' at the end.
+        """
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            chunk = next(self.blocks, None)
+            if chunk is None:
+                break
+
+            chunks.append(chunk)
+            length += len(chunk)
+
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+
+        self.buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+
+class Decompressor(object):
+    """
+    Decompresses the concatenated streams written by
+    :py:class:`CompressedReader`, fed in pieces of any size.
+    """
+
+    def __init__(self, codec):
+        check_codec(codec)
+        self.codec = codec
+        self.decompressor = None
+
+    def _new(self):
+        if self.codec == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.codec == 'bz2':
+            return bz2.BZ2Decompressor()
+        else:
+            return lzma.LZMADecompressor()
+
+    def decompress(self, data):
+        """
+        Returns the decompressed data of the next piece, data.
+        """
+        out = []
+        while data:
+            if self.decompressor is None:
+                self.decompressor = self._new()
+
+            try:
+                out.append(self.decompressor.decompress(data))
+            except EOFError:
+                # The stream ended with the previous piece; data starts
+                # the next one.
+                self.decompressor = None
+                continue
+
+            data = self.decompressor.unused_data
+            if data:
+                self.decompressor = None
+
+        return ''.join(out)
+
+DESCRIPTION_TAG = re.compile(r' \[compressed: (\w+)(?:, (\d+) bytes)?\]$')
+
+def tag_description(description, codec, size=None):
+    """
+    Adds the codec and, if known, the original size of the data to an
+    archive description.
+    """
+    if size is None:
+        return '%s [compressed: %s]' % (description, codec)
+
+    return '%s [compressed: %s, %s bytes]' % (description, codec, size)
+
+def parse_description(description):
+    """
+    Returns (codec, original size) from an archive description made by
+    :py:func:`tag_description`, or (None, None). The size is None if it
+    was not known at the start of the upload.
+    """
+    match = DESCRIPTION_TAG.search(description or '')
+    if not match:
+        return None, None
+
+    codec, size = match.groups()
+    return codec, int(size) if size else None
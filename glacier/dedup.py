@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: dedup
+   :platform: Unix, Windows
+   :synopsis: Deduplication of uploads with content-defined chunks.
+
+Successive full backups of the same data are mostly identical. To
+upload only what changed, the data is cut into chunks at positions that
+depend on the content around them, not on the offset, so an insert or
+delete moves only the chunks around it. Chunks already stored in the
+vault are looked up in a local index by their SHA256 hash; the new
+chunks are packed into one archive, and a recipe lists, for every chunk
+of the data, the archive, offset and size where it is stored::
+
+    store = DedupStore(directory)
+    reader = DedupReader(f, store.lookup(vault_name, region))
+    pack_id, tree_hash = glacier.upload(..., reader=reader)
+    store.add(vault_name, region, pack_id, reader.new_chunks)
+    recipe = reader.recipe(pack_id, name)
+
+The recipe is uploaded as an archive of its own, and kept in the store,
+so the data can be put together again from the chunk archives.
+
+Cut points are found without a per-byte loop in Python: every byte is
+mapped to a 0 or 1 with str.translate, and a chunk ends after the first
+run of :py:attr:`Chunker.RUN` ones, found with str.find. Whether a
+position is a cut point depends only on the RUN bytes before it.
+"""
+
+import os
+import json
+import random
+import string
+import hashlib
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from glaciercorecalls import TreeHasher
+from glacierexception import *
+
+CHUNKS_TAG = ' [dedup chunks]'
+RECIPE_TAG = ' [dedup recipe]'
+
+def _mark_table():
+    # A fixed, random half of the byte values is marked. The seed must
+    # never change, or chunks stop matching those of earlier uploads.
+    marks = ['\0'] * 128 + ['\1'] * 128
+    random.Random(0x676c6163).shuffle(marks)
+    return string.maketrans(''.join(chr(i) for i in range(256)), ''.join(marks))
+
+class Chunker(object):
+    """
+    Cuts a stream into content-defined chunks of MIN_SIZE to MAX_SIZE
+    bytes, about 1 MB on average.
+    """
+
+    MIN_SIZE = 256 * 1024
+    MAX_SIZE = 8 * 1024 * 1024
+    RUN = 18
+    READ_SIZE = 16 * 1024 * 1024
+    MARKS = _mark_table()
+
+    def chunks(self, source):
+        """
+        Iterates over the chunks of the data read from the file-like
+        object source.
+        """
+        run = '\1' * self.RUN
+        data = marks = ''
+        start = 0
+        eof = False
+        while True:
+            if not eof and len(data) - start < self.MAX_SIZE:
+                block = source.read(self.READ_SIZE)
+                if block:
+                    data = data[start:] + block
+                    marks = marks[start:] + block.translate(self.MARKS)
+                    start = 0
+                    continue
+
+                eof = True
+
+            if start >= len(data):
+                break
+
+            end = min(len(data), start + self.MAX_SIZE)
+            found = marks.find(run, start + self.MIN_SIZE - self.RUN, end)
+            stop = found + self.RUN if found >= 0 else end
+            yield data[start:stop]
+            start = stop
+
+class DedupStore(object):
+    """
+    Local index of the chunks stored in Amazon Glacier, per vault, and
+    the recipes of the deduplicated uploads. SQLite backed; the index
+    may be used from another thread than the one that opened it, one
+    thread at a time.
+    """
+
+    DEFAULT_DIR = '~/.cache/glacier-cmd/dedup'
+
+    def __init__(self, directory=None):
+        self.directory = os.path.expanduser(directory or self.DEFAULT_DIR)
+        self.recipe_dir = os.path.join(self.directory, 'recipes')
+        if not os.path.isdir(self.recipe_dir):
+            os.makedirs(self.recipe_dir, 0700)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'),
+                                  check_same_thread=False)
+        self.db.execute("""\
+CREATE TABLE IF NOT EXISTS chunks (
+    region TEXT, vault TEXT, digest TEXT,
+    archive_id TEXT, offset INTEGER, size INTEGER,
+    PRIMARY KEY (region, vault, digest))""")
+        self.db.execute('CREATE INDEX IF NOT EXISTS chunks_archive ON chunks (archive_id)')
+        self.db.commit()
+
+    def lookup(self, vault_name, region):
+        """
+        Returns a function that takes the hex SHA256 digest of a chunk
+        and returns (archive_id, offset, size) of where the chunk is
+        stored in the vault, or None.
+        """
+        def lookup(digest):
+            with self.lock:
+                return self.db.execute("""\
+SELECT archive_id, offset, size FROM chunks
+WHERE region=? AND vault=? AND digest=?""", (region, vault_name, digest)).fetchone()
+
+        return lookup
+
+    def add(self, vault_name, region, archive_id, chunks):
+        """
+        Adds the chunks, a list of (digest, offset, size), stored in the
+        archive archive_id to the index.
+        """
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?)',
+                                [(region, vault_name, digest, archive_id, offset, size)
+                                 for digest, offset, size in chunks])
+            self.db.commit()
+
+    def forget(self, archive_id):
+        """
+        Removes the chunks of a deleted archive from the index.
+        """
+        with self.lock:
+            self.db.execute('DELETE FROM chunks WHERE archive_id=?', (archive_id,))
+            self.db.commit()
+
+    def _recipe_path(self, archive_id):
+        return os.path.join(self.recipe_dir, '%s.json' % archive_id)
+
+    def save_recipe(self, archive_id, recipe):
+        """
+        Keeps a copy of the recipe uploaded as archive archive_id.
+        """
+        with open(self._recipe_path(archive_id), 'wb') as f:
+            json.dump(recipe, f)
+
+    def load_recipe(self, archive_id):
+        """
+        Returns the kept copy of the recipe in archive archive_id, or
+        None.
+        """
+        try:
+            with open(self._recipe_path(archive_id), 'rb') as f:
+                return parse_recipe(f.read())
+        except (IOError, InputException):
+            return None
+
+    def close(self):
+        self.db.close()
+
+def parse_recipe(data):
+    """
+    Returns the recipe in the JSON string data.
+
+    :raises: :py:exc:`glacier.glacierexception.InputException`
+    """
+    try:
+        recipe = json.loads(data)
+        if recipe.get('Version') == DedupReader.VERSION and 'Chunks' in recipe:
+            return recipe
+    except (ValueError, AttributeError):
+        pass
+
+    raise InputException(
+        'Archive is not a deduplication recipe.',
+        code='IdError')
+
+class DedupReader(object):
+    """
+    File-like object that reads as the chunks of the data in source that
+    lookup (see :py:meth:`DedupStore.lookup`) does not know and that did
+    not occur earlier in the data; the chunk archive to upload.
+    """
+
+    VERSION = 1
+
+    def __init__(self, source, lookup, chunker=None):
+        self.lookup = lookup
+        self.chunks = (chunker or Chunker()).chunks(source)
+        self.hasher = TreeHasher()
+        self.entries = []
+        self.new_chunks = []
+        self.seen = {}
+        self.pack_size = 0
+        self.buffer = ''
+        self.done = False
+
+    def _next(self):
+        """
+        Reads chunks until a new one is found; returns it, or None at
+        the end of the data.
+        """
+        for chunk in self.chunks:
+            self.hasher.update(chunk)
+            digest = hashlib.sha256(chunk).hexdigest()
+            stored = self.seen.get(digest) or self.lookup(digest)
+            if stored:
+                archive_id, offset, size = stored
+                self.entries.append([archive_id, offset, size, digest])
+                continue
+
+            offset = self.pack_size
+            self.seen[digest] = (None, offset, len(chunk))
+            self.new_chunks.append((digest, offset, len(chunk)))
+            self.entries.append([None, offset, len(chunk), digest])
+            self.pack_size += len(chunk)
+            return chunk
+
+        self.done = True
+        return None
+
+    def has_data(self):
+        """
+        Whether there are new chunks to upload; reads up to the first.
+        """
+        if not self.buffer and not self.done:
+            self.buffer = self._next() or ''
+
+        return bool(self.buffer)
+
+    def read(self, size=-1):
+        """
+        Reads up to size bytes of new chunks; all of them if size is
+        negative. Returns '' at the end.
+        """
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while (size < 0 or length < size) and not self.done:
+            chunk = self._next()
+            if chunk is None:
+                break
+
+            chunks.append(chunk)
+            length += len(chunk)
+
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+
+        self.buffer = data[size:]
+        return data[:size]
+
+    def recipe(self, archive_id, name):
+        """
+        Returns the recipe of the data, once all of it has been read,
+        with the new chunks stored in archive archive_id.
+        """
+        return {'Version': self.VERSION,
+                'Name': name,
+                'Size': self.hasher.size,
+                'SHA256TreeHash': self.hasher.hexdigest(),
+                'Chunks': [[entry[0] or archive_id] + entry[1:]
+                           for entry in self.entries]}
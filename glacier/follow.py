@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: follow
+   :platform: Unix
+   :synopsis: Upload a file while it is still being written.
+
+Backup volumes and database dumps are written for hours. Instead of
+waiting until the file is complete, :py:class:`FollowedFile` follows the
+file as it grows, like ``tail -f``, and hands out every part as soon as
+all of it is on disk::
+
+    followed = FollowedFile(file_name, timeout=60)
+    for part in followed.parts(part_size):
+        writer.write(part, *part.hashes)
+
+The data is hashed as it lands, so the hashes of a part are known the
+moment the part is complete. The file is taken to be complete when the
+writer closes it (seen with inotify, on Linux), when a sentinel file
+appears, or when the file has not grown for timeout seconds.
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import hashlib
+import threading
+import ctypes
+import ctypes.util
+
+from glaciercorecalls import TreeHasher
+from partreader import FileSegment
+from glacierexception import *
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_NONBLOCK = 04000
+IN_CLOEXEC = 02000000
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch
+except (OSError, AttributeError, TypeError):
+    _libc = None
+
+class FileWatch(object):
+    """
+    Waits for a file to be written to, with inotify where available, or
+    by polling.
+    """
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, file_name):
+        self.fd = None
+        if not _libc:
+            return
+
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return
+
+        if _libc.inotify_add_watch(fd, file_name, IN_MODIFY | IN_CLOSE_WRITE) < 0:
+            os.close(fd)
+            return
+
+        self.fd = fd
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for the file to be written to.
+        Returns the inotify events that occurred, or 0 when polling.
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+            return 0
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return 0
+
+        try:
+            data = os.read(self.fd, 4096)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return 0
+
+            raise
+
+        mask = 0
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            wd, event_mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            mask |= event_mask
+            offset += self.EVENT.size + length
+
+        return mask
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class FollowedPart(FileSegment):
+    """
+    A complete part of a :py:class:`FollowedFile`, with its hashes:
+    (linear hash as hex string, tree hash as binary string).
+    """
+
+    def __init__(self, fd, offset, length, lock, hashes):
+        FileSegment.__init__(self, fd, offset, length, lock)
+        self.hashes = hashes
+
+class FollowedFile(object):
+    """
+    A file that is still being written, see the module documentation.
+    """
+
+    READ_SIZE = TreeHasher.CHUNK_SIZE
+    POLL = 1.0
+
+    def __init__(self, file_name, timeout=60, sentinel=None):
+        """
+        :param file_name: name of the file to follow.
+        :type file_name: str
+        :param timeout: seconds the file must not grow before it is
+            taken to be complete.
+        :type timeout: float
+        :param sentinel: name of a file that appears when the file is
+            complete.
+        :type sentinel: str
+        """
+        self.file_name = file_name
+        self.timeout = timeout
+        self.sentinel = sentinel
+        self.file = open(file_name, 'rb')
+        self.lock = threading.Lock()
+        self.watch = FileWatch(file_name)
+        self.size = 0
+
+    def _complete(self, events, last_change):
+        if events & IN_CLOSE_WRITE:
+            return True
+
+        if self.sentinel and os.path.exists(self.sentinel):
+            return True
+
+        return time.time() - last_change >= self.timeout
+
+    def parts(self, part_size):
+        """
+        Iterates over the parts of part_size bytes of the file as they
+        are written, and the last, shorter part once the file is
+        complete; as :py:class:`FollowedPart` objects.
+
+        :raises: :py:exc:`glacier.glacierexception.InputException`
+        """
+        fd = self.file.fileno()
+        start = 0
+        linear = hashlib.sha256()
+        tree = TreeHasher()
+        last_change = time.time()
+        complete = False
+        while True:
+            size = os.fstat(fd).st_size
+            if size < self.size:
+                raise InputException(
+                    "File shrunk while being uploaded: %s." % self.file_name,
+                    cause='File is %s bytes, %s bytes were read already.' % (size, self.size),
+                    code='FileError')
+
+            if size > self.size:
+                last_change = time.time()
+
+            # Hash the data that landed, a part at a time.
+            while self.size < size:
+                length = min(self.READ_SIZE, size - self.size,
+                             start + part_size - self.size)
+                try:
+                    data = FileSegment(fd, self.size, length, self.lock).read()
+                except IOError as e:
+                    raise InputException(
+                        "File shrunk while being uploaded: %s." % self.file_name,
+                        cause=e,
+                        code='FileError')
+
+                linear.update(data)
+                tree.update(data)
+                self.size += length
+                if self.size == start + part_size:
+                    yield FollowedPart(fd, start, part_size, self.lock,
+                                       (linear.hexdigest(), tree.digest()))
+                    start = self.size
+                    linear = hashlib.sha256()
+                    tree = TreeHasher()
+
+            if complete:
+                break
+
+            # Once complete, take what landed last before finishing.
+            complete = self._complete(self.watch.wait(self.POLL), last_change)
+
+        if self.size > start:
+            yield FollowedPart(fd, start, self.size - start, self.lock,
+                               (linear.hexdigest(), tree.digest()))
+
+    def close(self):
+        self.watch.close()
+        self.file.close()
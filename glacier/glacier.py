@@ -19,6 +19,7 @@ import json
 from prettytable import PrettyTable
 
 from GlacierWrapper import GlacierWrapper
+from shaping import choose_windows
 
 from functools import wraps
 from glacierexception import *
@@ -47,10 +48,21 @@ def output_headers(headers, output):
     if output == 'json':
         print json.dumps(headers)
 
+def result_keys(results):
+    """
+    Returns the keys of all results, in the order they first appear.
+    """
+    keys = []
+    for line in results:
+        keys += [k for k in line.keys() if k not in keys]
+
+    return keys
+
 def output_table(results, output, keys=None, sort_key=None):
     """
-    Prettyprints results. Expects a list of identical dicts.
-    Use the dict keys as headers unless keys is given; one line for each item.
+    Prettyprints results. Expects a list of dicts, usually identical.
+    Use the dict keys as headers unless keys is given; one line for each
+    item. Keys that some dicts lack are left empty in their lines.
 
     Expected format of data is a list of dicts:
     [{'key1':'data1.1', 'key2':'data1.2', ... },
@@ -67,7 +79,7 @@ def output_table(results, output, keys=None, sort_key=None):
             print 'No output!'
             return
 
-        headers = [keys[k] for k in keys.keys()] if keys else results[0].keys()
+        headers = [keys[k] for k in keys.keys()] if keys else result_keys(results)
         table = PrettyTable(headers)
         for line in results:
             table.add_row([line[k] if k in line else '' for k in (keys.keys() if keys else headers)])
@@ -79,10 +91,10 @@ def output_table(results, output, keys=None, sort_key=None):
         
     if output == 'csv':
         csvwriter = csv.writer(sys.stdout, quoting=csv.QUOTE_ALL)
-        keys = results[0].keys()
+        keys = result_keys(results)
         csvwriter.writerow(keys)
         for row in results:
-            csvwriter.writerow([row[k] for k in keys])
+            csvwriter.writerow([row.get(k, '') for k in keys])
             
     if output == 'json':
         print json.dumps(results)
@@ -145,7 +157,24 @@ def default_glacier_wrapper(args, **kwargs):
                           # config_object=args.config_object,
                           logfile=args.logfile,
                           loglevel=args.loglevel,
-                          logtostdout=args.logtostdout)
+                          logtostdout=args.logtostdout,
+                          hash_cache=not args.no_hash_cache,
+                          hash_cache_path=args.hash_cache,
+                          hash_cache_size=args.hash_cache_size,
+                          max_attempts=args.max_attempts,
+                          backoff=args.backoff,
+                          max_backoff=args.max_backoff,
+                          jitter=args.jitter,
+                          retry_on=[code.strip() for code in args.retry_on.split(',')
+                                    if code.strip()],
+                          journal_dir=args.journal_dir,
+                          dedup_dir=args.dedup_dir,
+                          archive_index=args.archive_index,
+                          spool_dir=args.spool_dir,
+                          page_cache=args.page_cache,
+                          bandwidth=args.bandwidth,
+                          bandwidth_windows=choose_windows(args.bandwidth_window,
+                                                           args.config_bandwidth_windows))
 
 def handle_errors(fn):
     """
@@ -264,11 +293,33 @@ def download(args):
     Download an archive.
     """
     glacier = default_glacier_wrapper(args)
-    response = glacier.download(args.vault, args.archive, args.partsize,
-                                out_file_name=args.outfile, overwrite=args.overwrite)
+    if args.dedup:
+        response = glacier.download_dedup(args.vault, args.archive,
+                                          out_file_name=args.outfile,
+                                          overwrite=args.overwrite)
+    else:
+        response = glacier.download(args.vault, args.archive, args.partsize,
+                                    out_file_name=args.outfile, overwrite=args.overwrite,
+                                    decompress=not args.no_decompress,
+                                    concurrency=args.concurrency,
+                                    resume=args.resume,
+                                    memory_budget=args.memory_budget)
     if args.outfile:
         output_msg(response, args.output, success=True)
 
+def dedup_result(file_name, response):
+    """
+    Returns the output of a deduplicated upload.
+    """
+    result = {"Created recipe with ID": response[0],
+              "SHA256 tree hash": response[1],
+              "Size": response[2],
+              "Uploaded new data": response[3]}
+    if file_name:
+        result["Uploaded file"] = file_name
+
+    return result
+
 @handle_errors
 def upload(args):
     """
@@ -291,12 +342,19 @@ def upload(args):
     glacier = default_glacier_wrapper(args)
     results = []
 
+    # Data from stdin is only known once it has been read.
+    if args.stdin and args.skip_existing:
+        raise InputException(
+            'Data from stdin can not be skipped; --skip-existing works on files only.',
+            code='CommandError')
+
     # If we have one or more file names, they appear in a list.
     # Iterate over these file names; do path expansion and wildcard expansion
     # just in case the shell didn't take care of that.
     # If no file name given it's an empty list, and we expect the file to
     # be read over stdin.
     if args.filename:
+        file_names = []
         for f in args.filename:
     
             # In case the shell does not expand wildcards, if any, do this here.
@@ -305,22 +363,141 @@ def upload(args):
 
             globbed = glob.glob(f)
             if globbed:
-                for g in globbed:
-                    response = glacier.upload(args.vault, g, args.description, args.region, args.stdin,
-                                              args.name, args.partsize, args.uploadid, args.resume)
-                    results.append({"Uploaded file": g,
-                                    "Created archive with ID": response[0],
-                                    "Archive SHA256 tree hash": response[1]})
+                file_names += globbed
             else:
                 raise InputException(
                     "File name given for upload can not be found: %s."% f,
                     code='CommandError')
-            
+
+        # Leave out the files that are in the vault already.
+        skipped = 0
+        if args.skip_existing:
+            skipped_size = 0
+            for g in list(file_names):
+                archive_id, tree_hash, size = glacier.find_archive(
+                    args.vault, g, args.region, jobs=args.jobs)
+                if archive_id:
+                    file_names.remove(g)
+                    skipped += 1
+                    skipped_size += size
+                    results.append({"Uploaded file": g,
+                                    "Skipped (already in vault)": archive_id,
+                                    "Archive SHA256 tree hash": tree_hash})
+
+            if skipped:
+                sys.stderr.write('Skipped %s file%s (%s) already in the vault.\n'
+                                 % (skipped, '' if skipped == 1 else 's',
+                                    size_fmt(skipped_size)))
+
+        if args.follow and (len(file_names) != 1 or args.skip_existing
+                            or args.dedup or args.pack):
+            raise InputException(
+                'Only a single file can be followed, and it can not be skipped, deduplicated or packed.',
+                code='CommandError')
+
+        if args.dedup:
+            if args.uploadid or args.resume or args.pack or args.compress:
+                raise InputException(
+                    'Deduplicated uploads can not be resumed, packed or compressed.',
+                    code='CommandError')
+
+            for g in file_names:
+                results.append(dedup_result(g, glacier.upload_dedup(
+                    args.vault, g, args.description, args.region, False,
+                    args.name, args.partsize, jobs=args.jobs,
+                    concurrency=args.concurrency, readahead=args.readahead)))
+
+        elif args.pack:
+            if args.uploadid or args.resume:
+                raise InputException(
+                    'Packed uploads can not be resumed.',
+                    code='CommandError')
+
+            if args.compress:
+                raise InputException(
+                    'Packed uploads can not be compressed.',
+                    code='CommandError')
+
+            for member, archive_id, sha256hash in glacier.upload_packed(
+                    args.vault, file_names, args.description, args.region,
+                    args.pack, args.partsize, jobs=args.jobs,
+                    concurrency=args.concurrency, readahead=args.readahead):
+                results.append({"Uploaded file": member.file_name,
+                                "Created archive with ID": archive_id,
+                                "Offset": member.offset,
+                                "Size": member.size})
+
+        elif len(file_names) == 1 and not skipped:
+            response = glacier.upload(args.vault, file_names[0], args.description, args.region, args.stdin,
+                                      args.name, args.partsize, args.uploadid, args.resume,
+                                      jobs=args.jobs, concurrency=args.concurrency,
+                                      readahead=args.readahead,
+                                      paranoid=args.paranoid,
+                                      compression=args.compress,
+                                      compression_level=args.compress_level,
+                                      follow=args.follow,
+                                      follow_timeout=args.follow_timeout,
+                                      follow_sentinel=args.follow_sentinel)
+            results.append({"Uploaded file": file_names[0],
+                            "Created archive with ID": response[0],
+                            "Archive SHA256 tree hash": response[1]})
+        else:
+            if args.uploadid:
+                raise InputException(
+                    'An UploadId can only be given for the upload of a single file.',
+                    code='CommandError')
+
+            # Upload the files side by side; one failing does not stop
+            # the others.
+            failures = []
+            for g, archive_id, sha256hash, exc_info in glacier.upload_files(
+                    args.vault, file_names, args.description, args.region,
+                    args.name, args.partsize, args.resume,
+                    jobs=args.jobs, concurrency=args.concurrency,
+                    readahead=args.readahead, paranoid=args.paranoid,
+                    memory_budget=args.memory_budget,
+                    compression=args.compress,
+                    compression_level=args.compress_level):
+                if exc_info:
+                    failures.append((g, exc_info))
+                else:
+                    results.append({"Uploaded file": g,
+                                    "Created archive with ID": archive_id,
+                                    "Archive SHA256 tree hash": sha256hash})
+
+            if results:
+                output_table(results, args.output)
+
+            for g, exc_info in failures:
+                if not isinstance(exc_info[1], GlacierException):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                sys.stderr.write('Upload of %s failed:\n'% g)
+                exc_info[1].write(indentation='||  ', stack=False, message=True)
+
+            if failures:
+                sys.exit(failures[0][1][1].exitcode)
+
+            return
+
+    elif args.stdin and args.dedup:
+        results = [dedup_result(None, glacier.upload_dedup(
+            args.vault, None, args.description, args.region, True,
+            args.name, args.partsize, jobs=args.jobs,
+            concurrency=args.concurrency, readahead=args.readahead))]
+
     elif args.stdin:
 
         # No file name; using stdin.
         response = glacier.upload(args.vault, None, args.description, args.region, args.stdin,
-                                  args.name, args.partsize, args.uploadid, args.resume)
+                                  args.name, args.partsize, args.uploadid, args.resume,
+                                  jobs=args.jobs, concurrency=args.concurrency,
+                                  readahead=args.readahead,
+                                  paranoid=args.paranoid,
+                                  compression=args.compress,
+                                  compression_level=args.compress_level,
+                                  spool=args.spool,
+                                  spool_parts=args.spool_parts)
         results = [{"Created archive with ID": response[0],
                     "Archive SHA256 tree hash": response[1]}]
 
@@ -421,7 +598,7 @@ def treehash(args):
                 for g in globbed:
                     hash_results.append(
                         {'File name': g,
-                         'SHA256 tree hash': glacier.get_tree_hash(g)})
+                         'SHA256 tree hash': glacier.get_tree_hash(g, jobs=args.jobs)})
         else:
             raise InputException(
                 'No file name given.',
@@ -628,6 +805,85 @@ def main():
                        default=default('output') if default('output') else 'print',
                        choices=['print', 'csv', 'json'],
                        help='Set how to return results: print to the screen, or as csv resp. json string.')
+    group.add_argument('--hash-cache',
+                       required=False,
+                       default=default('hash-cache') if default('hash-cache') else '~/.cache/glacier-cmd/treehash.sqlite',
+                       help='File to cache tree hashes of local files in.')
+    group.add_argument('--hash-cache-size', type=int,
+                       required=False,
+                       default=int(default('hash-cache-size')) if default('hash-cache-size') else 256,
+                       help='Maximum size of the tree hash cache in MB.')
+    group.add_argument('--no-hash-cache',
+                       required=False,
+                       default=False,
+                       action="store_true",
+                       help="Do not use the tree hash cache; always read and \
+                             hash files.")
+    group.add_argument('--max-attempts', type=int,
+                       required=False,
+                       default=int(default('max-attempts')) if default('max-attempts') else 5,
+                       help='Maximum number of attempts to upload a part.')
+    group.add_argument('--backoff', type=float,
+                       required=False,
+                       default=float(default('backoff')) if default('backoff') else 1.0,
+                       help='Seconds to wait before retrying a failed part; \
+                             doubles with every retry.')
+    group.add_argument('--max-backoff', type=float,
+                       required=False,
+                       default=float(default('max-backoff')) if default('max-backoff') else 300.0,
+                       help='Maximum number of seconds to wait between retries.')
+    group.add_argument('--jitter', type=float,
+                       required=False,
+                       default=float(default('jitter')) if default('jitter') else 0.5,
+                       help='Fraction (0-1) of the wait between retries that \
+                             is randomised.')
+    group.add_argument('--retry-on',
+                       required=False,
+                       default=default('retry-on') or \
+                           'RequestTimeoutException,ThrottlingException,ServiceUnavailableException,GlacierConnectionError',
+                       help='Comma separated list of error codes on which to \
+                             retry.')
+    group.add_argument('--journal-dir',
+                       required=False,
+                       default=default('journal-dir') or '~/.cache/glacier-cmd/journal',
+                       help='Directory for the journals of uploads, used to \
+                             resume interrupted uploads.')
+    group.add_argument('--page-cache',
+                       required=False,
+                       choices=['keep', 'drop', 'direct'],
+                       default=default('page-cache') or 'keep',
+                       help='How to read files: keep them in the page cache, \
+                             drop them from it once read, or read them \
+                             directly (O_DIRECT), bypassing it.')
+    group.add_argument('--bandwidth', type=float,
+                       required=False,
+                       default=float(default('bandwidth')) if default('bandwidth') else None,
+                       help='Maximum transfer rate in MB/s of all uploads and \
+                             downloads together; default no limit.')
+    group.add_argument('--bandwidth-window',
+                       required=False,
+                       action='append',
+                       default=None,
+                       help='Maximum transfer rate in MB/s during a time of \
+                             day, like 09:00-17:00=1; 0 is no limit. May be \
+                             given more than once; replaces the windows of \
+                             the configuration file.')
+    parser.set_defaults(config_bandwidth_windows=default('bandwidth-windows'))
+    group.add_argument('--spool-dir',
+                       required=False,
+                       default=default('spool-dir') or '~/.cache/glacier-cmd/spool',
+                       help='Directory to spool uploads from stdin to, used \
+                             by upload --spool.')
+    group.add_argument('--archive-index',
+                       required=False,
+                       default=default('archive-index') or '~/.cache/glacier-cmd/archives.sqlite',
+                       help='File name of the local index of the archives in \
+                             the vaults, used by upload --skip-existing.')
+    group.add_argument('--dedup-dir',
+                       required=False,
+                       default=default('dedup-dir') or '~/.cache/glacier-cmd/dedup',
+                       help='Directory for the index of deduplicated chunks \
+                             and the recipes of deduplicated uploads.')
 
     # SimpleDB settings
     group = parser.add_argument_group('sdb')
@@ -731,14 +987,90 @@ re-reading the data from stdin.''')
     parser_upload.add_argument('--resume', action='store_true',
         help='''\
 Attempt to resume an interrupted multi-part upload.
-Does not work in combination with --stdin, and
-requires bookkeeping to be enabled.
-(not implemented yet)''')
+With --stdin only in combination with --spool.''')
     parser_upload.add_argument('--bacula', action='store_true',
         help='''\
 The (single!) file name will be parsed using Bacula's
 style of providing multiple names on the command line.
 E.g.: /path/to/backup/vol001|vol002|vol003''')
+    parser_upload.add_argument('--jobs', type=int,
+        default=int(default('jobs')) if default('jobs') else 1,
+        help='''\
+Number of threads to use for calculating the tree
+hashes of the data. Use 0 to use all available
+CPU cores.''')
+    parser_upload.add_argument('--concurrency', type=int,
+        default=int(default('concurrency')) if default('concurrency') else 1,
+        help='''\
+Number of parts to upload at the same time, each over
+its own connection. Up to this many parts are kept in
+memory when reading from stdin.''')
+    parser_upload.add_argument('--readahead', type=int,
+        default=int(default('readahead')) if default('readahead') else 1,
+        help='''\
+Number of parts to read and hash while the current
+part is being sent. Use 0 to do one thing at a time.''')
+    parser_upload.add_argument('--paranoid', action='store_true',
+        help='''\
+When resuming, read and check all uploaded parts,
+even if the upload journal says they match.''')
+    parser_upload.add_argument('--spool', action='store_true',
+        help='''\
+Spool the data from stdin to disk, and upload the
+parts from there. Parts are uploaded at the same time
+without holding them in memory, and an interrupted
+upload can be resumed from the spool with --resume.''')
+    parser_upload.add_argument('--spool-parts', type=int,
+        default=int(default('spool-parts')) if default('spool-parts') else 0,
+        help='''\
+Maximum number of parts in the spool. Default one
+more than --concurrency plus --readahead.''')
+    parser_upload.add_argument('--follow', action='store_true',
+        help='''\
+Upload the file while it is still being written:
+every part is sent as soon as it is on disk. The file
+is complete when the writer closes it (on Linux), when
+the --follow-sentinel file appears, or when it did not
+grow for --follow-timeout seconds.''')
+    parser_upload.add_argument('--follow-timeout', type=float,
+        default=float(default('follow-timeout')) if default('follow-timeout') else 60,
+        help='''\
+Seconds a followed file must not grow before it is
+taken to be complete. Default 60.''')
+    parser_upload.add_argument('--follow-sentinel', default=None,
+        help='''\
+Name of a file that appears when the followed file
+is complete.''')
+    parser_upload.add_argument('--memory-budget', type=int,
+        default=int(default('memory-budget')) if default('memory-budget') else None,
+        help='''\
+Maximum size (in MB) of the parts in flight of all
+files together, when uploading several files.''')
+    parser_upload.add_argument('--pack', type=int, metavar='MB',
+        default=int(default('pack')) if default('pack') else None,
+        help='''\
+Pack the files into tar bundles of about this size
+(in MB), and upload every bundle as one archive.''')
+    parser_upload.add_argument('--compress', metavar='CODEC',
+        default=default('compress'),
+        help='''\
+Compress the data with this codec (gzip, bz2, or xz
+if available) while uploading. Files that do not
+compress are uploaded as they are.''')
+    parser_upload.add_argument('--compress-level', type=int,
+        default=int(default('compress-level')) if default('compress-level') else None,
+        help='''\
+Compression level; the default depends on the codec.''')
+    parser_upload.add_argument('--skip-existing', action='store_true',
+        help='''\
+Do not upload files that are in the vault already,
+with the same tree hash and size, according to the
+last inventory, earlier uploads and bookkeeping.''')
+    parser_upload.add_argument('--dedup', action='store_true',
+        help='''\
+Upload only the chunks of the data that are not
+stored in the vault yet, with a recipe to put the
+data together again.''')
     parser_upload.set_defaults(func=upload)
 
     # glacier-cmd listmultiparts <vault>
@@ -793,6 +1125,30 @@ If omitted, stdout will be used.''')
         help='''
 Overwrite an existing local file if one exists when
 downloading an archive.''')
+    parser_download.add_argument('--no-decompress', action='store_true',
+        help='''\
+Store archives that were compressed on upload as
+they are, without decompressing them.''')
+    parser_download.add_argument('--dedup', action='store_true',
+        help='''\
+The archive is the recipe of a deduplicated upload;
+put the data together from its chunks.''')
+    parser_download.add_argument('--concurrency', type=int,
+        default=int(default('download-concurrency')) if default('download-concurrency') else 1,
+        help='''\
+Number of parts to download at the same time, each
+over its own connection, and written at its place in
+the output file, or in order to stdout.''')
+    parser_download.add_argument('--resume', action='store_true',
+        help='''\
+Resume an interrupted download to --outfile: fetch
+only the parts its checkpoint does not list.''')
+    parser_download.add_argument('--memory-budget', type=int,
+        default=int(default('download-memory-budget')) if default('download-memory-budget') else None,
+        help='''\
+Maximum size (in MB) of the parts held in memory
+until they are checked and their turn, when
+downloading to stdout. Default 256.''')
     parser_download.add_argument('--partsize', type=int, default=-1,
         help='''\
 Part size to use for download (in MB). Must
@@ -864,6 +1220,10 @@ at hand.''')
         help='Calculate the tree-hash (Amazon style sha256-hash) of a file.')
     parser_describejob.add_argument('filename', nargs='*',
         help='The filename to calculate the treehash of.')
+    parser_describejob.add_argument('--jobs', type=int,
+        default=int(default('jobs')) if default('jobs') else 1,
+        help='Number of threads to use for hashing; 0 to use all \
+              available CPU cores.')
     parser_describejob.set_defaults(func=treehash)
 
     # SNS related commands are located in their own subparser 
@@ -16,21 +16,58 @@ This depends on the boto library, use version 2.6.0 or newer.
 """
 
 import urllib
+import os
 import hashlib
 import math
 import json
 import sys
 import time
+import itertools
+import multiprocessing
+import threading
+import Queue
+import random
+import socket
+import httplib
+
+from multiprocessing.pool import ThreadPool
 
 import boto.glacier.layer1
+import boto.glacier.exceptions
 
 from glacierexception import *
+from partreader import read_blocks
+from shaping import ShapedBody
 
-# Placeholder, effectively renaming the class.
 class GlacierConnection(boto.glacier.layer1.Layer1):
 
-    pass
-    
+    def __init__(self, *args, **kwargs):
+        boto.glacier.layer1.Layer1.__init__(self, *args, **kwargs)
+
+        # boto signs a request with the SHA256 of its body, which for an
+        # uploaded part means reading it all over again. The hash is
+        # already known and given in the x-amz-content-sha256 header.
+        handler = self._auth_handler
+        if hasattr(handler, 'payload'):
+            payload = handler.payload
+            def payload_from_header(http_request):
+                return http_request.headers.get('x-amz-content-sha256') or \
+                       payload(http_request)
+
+            handler.payload = payload_from_header
+
+        # boto retries requests that failed with a server error by itself,
+        # sending a streamed body on from where the failed attempt left
+        # it. Requests are signed again before every attempt; rewind then.
+        add_auth = handler.add_auth
+        def add_auth_rewind(http_request, **kwargs):
+            if hasattr(http_request.body, 'seek'):
+                http_request.body.seek(0)
+
+            return add_auth(http_request, **kwargs)
+
+        handler.add_auth = add_auth_rewind
+
 
 def chunk_hashes(data):
     """
@@ -39,7 +76,18 @@ def chunk_hashes(data):
     """
     chunk = 1024*1024
     chunk_count = int(math.ceil(len(data)/float(chunk)))
-    return [hashlib.sha256(data[i*chunk:(i+1)*chunk]).digest() for i in range(chunk_count)]
+    return [hashlib.sha256(buffer(data, i*chunk, chunk)).digest() for i in range(chunk_count)]
+
+def iter_blocks(data, size):
+    """
+    Returns an iterator over consecutive blocks of at most size bytes of
+    data, without copying. data is a string or a part object providing
+    its own blocks() method, like :py:class:`partreader.MappedPart`.
+    """
+    if hasattr(data, 'blocks'):
+        return data.blocks(size)
+
+    return (buffer(data, i, size) for i in xrange(0, len(data), size))
 
 def tree_hash(fo):
     """
@@ -47,22 +95,326 @@ def tree_hash(fo):
     together adjacent hashes until it ends up with one big one. So a
     tree of hashes.
     """
-    hashes = []
-    hashes.extend(fo)
-    while len(hashes) > 1:
-        new_hashes = []
+    hasher = TreeHasher()
+    for leaf in fo:
+        hasher.add_hash(leaf)
+
+    return hasher.digest()
+
+class TreeHasher(object):
+    """
+    Incremental SHA256 tree hash calculator.
+
+    Data is fed in through :py:meth:`update` as it arrives; every time a
+    1 MB chunk is complete its hash is pushed on a stack of sub-tree
+    hashes, and equally sized sub-trees are combined right away (like
+    the carry of a binary counter). Only one hash per tree level is
+    kept, so memory use is O(log n) and every byte is hashed once::
+
+        hasher = TreeHasher()
+        for block in iter(lambda: f.read(65536), ''):
+            hasher.update(block)
+        hasher.hexdigest()
+    """
+
+    CHUNK_SIZE = 1024*1024
+
+    def __init__(self, data=None):
+        self.size = 0
+        self._stack = []
+        self._chunk = hashlib.sha256()
+        self._chunk_fill = 0
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        """
+        Feed more data to the hasher. Accepts anything supporting the
+        buffer interface or a part object (see :py:func:`iter_blocks`);
+        no copies of the data are made.
+        """
+        if hasattr(data, 'blocks'):
+            for block in data.blocks(self.CHUNK_SIZE):
+                self.update(block)
+
+            return
+
+        offset = 0
+        length = len(data)
+        while offset < length:
+            todo = min(self.CHUNK_SIZE - self._chunk_fill, length - offset)
+            self._chunk.update(buffer(data, offset, todo))
+            self._chunk_fill += todo
+            offset += todo
+            if self._chunk_fill == self.CHUNK_SIZE:
+                self.add_hash(self._chunk.digest())
+                self._chunk = hashlib.sha256()
+                self._chunk_fill = 0
+
+        self.size += length
+
+    def add_hash(self, digest, level=0):
+        """
+        Add the hash of a complete sub-tree: a 1 MB chunk (level 0) or
+        2**level consecutive chunks. Must not be mixed with a pending
+        partial chunk from :py:meth:`update`.
+        """
+        while self._stack and self._stack[-1][0] == level:
+            digest = hashlib.sha256(self._stack.pop()[1] + digest).digest()
+            level += 1
+
+        self._stack.append((level, digest))
+
+    def digest(self):
+        """
+        Return the tree hash of all data fed so far, as binary string.
+        The hasher can still be updated afterwards.
+        """
+        stack = list(self._stack)
+        if self._chunk_fill or not stack:
+            stack.append((0, self._chunk.digest()))
+
+        digest = stack.pop()[1]
+        while stack:
+            digest = hashlib.sha256(stack.pop()[1] + digest).digest()
+
+        return digest
+
+    def hexdigest(self):
+        return bytes_to_hex(self.digest())
+
+def part_hashes(data):
+    """
+    Returns the linear SHA256 hash (as hex string) and the tree hash (as
+    binary string) of data, walking the data only once: every block is
+    fed to both hashes while it is still in the CPU cache.
+    """
+    linear = hashlib.sha256()
+    tree = TreeHasher()
+    for view in iter_blocks(data, 64 * 1024):
+        linear.update(view)
+        tree.update(view)
+
+    return linear.hexdigest(), tree.digest()
+
+def _sha256_digest(data):
+    return hashlib.sha256(data).digest()
+
+def _file_range_hashes(args):
+    """
+    Hash a range of a file in 1 MB chunks; returns the list of chunk
+    hashes. Runs in a worker of :py:class:`ParallelTreeHasher`.
+    """
+    file_name, start, stop, page_cache = args
+    return [hashlib.sha256(data).digest()
+            for data in read_blocks(file_name, start, stop,
+                                    TreeHasher.CHUNK_SIZE, page_cache)]
+
+class ParallelTreeHasher(object):
+    """
+    Tree hash engine that hashes the 1 MB leaves on a pool of worker
+    threads, and assembles the tree in leaf order. hashlib releases the
+    GIL while hashing, so the threads run on separate cores.
+
+    With jobs=1 no pool is started and all hashing is done in the
+    calling thread. page_cache says how files are read, see
+    :py:mod:`partreader`.
+    """
+
+    SEGMENT_SIZE = 64 * TreeHasher.CHUNK_SIZE # File range per task.
+
+    def __init__(self, jobs=1, page_cache='keep'):
+        self.jobs = jobs if jobs > 0 else multiprocessing.cpu_count()
+        self.page_cache = page_cache
+        self.pool = ThreadPool(self.jobs) if self.jobs > 1 else None
+
+    def _imap(self, func, iterable, chunksize=1):
+        if self.pool:
+            return self.pool.imap(func, iterable, chunksize)
+
+        return itertools.imap(func, iterable)
+
+    def _block_groups(self, data):
+        """
+        Iterates over lists of a few 1 MB blocks of data per worker, so
+        that no more of a streamed part than that is held in memory.
+        """
+        blocks = iter_blocks(data, TreeHasher.CHUNK_SIZE)
         while True:
-            if len(hashes) > 1:
-                first = hashes.pop(0)
-                second = hashes.pop(0)
-                new_hashes.append(hashlib.sha256(first + second).digest())
-            elif len(hashes) == 1:
-                only = hashes.pop(0)
-                new_hashes.append(only)
-            else:
+            group = list(itertools.islice(blocks, self.jobs * 4))
+            if not group:
                 break
-        hashes.extend(new_hashes)
-    return hashes[0]
+
+            yield group
+
+    def leaf_hashes(self, data):
+        """
+        Returns an iterator over the hashes of the 1 MB chunks of data.
+        """
+        if not self.pool:
+            return itertools.imap(_sha256_digest,
+                                  iter_blocks(data, TreeHasher.CHUNK_SIZE))
+
+        return itertools.chain.from_iterable(
+            self.pool.imap(_sha256_digest, group, 4)
+            for group in self._block_groups(data))
+
+    def file_leaf_hashes(self, file_name, start=0, stop=None):
+        """
+        Returns an iterator over the hashes of the 1 MB chunks of the
+        byte range [start, stop) of a file; stop defaults to the end
+        of the file. start must be a multiple of 1 MB.
+        """
+        if stop is None:
+            stop = os.path.getsize(file_name)
+
+        segments = ((file_name, i, min(i + self.SEGMENT_SIZE, stop), self.page_cache)
+                    for i in xrange(start, stop, self.SEGMENT_SIZE))
+        return itertools.chain.from_iterable(
+            self._imap(_file_range_hashes, segments))
+
+    def tree_hash(self, data):
+        """
+        Returns the tree hash of data, as binary string.
+        """
+        return tree_hash(self.leaf_hashes(data))
+
+    def part_hashes(self, data):
+        """
+        Like :py:func:`part_hashes`: the chunk hashes are calculated by
+        the pool while the calling thread takes the linear hash.
+        """
+        if not self.pool:
+            return part_hashes(data)
+
+        linear = hashlib.sha256()
+        tree = TreeHasher()
+        for group in self._block_groups(data):
+            leaves = self.pool.imap(_sha256_digest, group, 4)
+            for view in group:
+                linear.update(view)
+
+            for leaf in leaves:
+                tree.add_hash(leaf)
+
+        return linear.hexdigest(), tree.digest()
+
+    def file_tree_hash(self, file_name, start=0, stop=None):
+        """
+        Returns the tree hash of (a range of) a file, as binary string.
+        """
+        return tree_hash(self.file_leaf_hashes(file_name, start, stop))
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+class RetryPolicy(object):
+    """
+    Decides whether a failed request is tried again, and how long to
+    wait first. The wait doubles with every attempt, starting at backoff
+    seconds, up to max_backoff; a random part of up to jitter (a fraction
+    between 0 and 1) of it is taken off, so parallel uploads that failed
+    together do not retry in lockstep.
+
+    Errors are classified by their Glacier error code; only codes listed
+    in retry_on are retried. These must be codes known to
+    :py:attr:`GlacierException.ERRORCODE`. Network errors are classified
+    as GlacierConnectionError.
+    """
+
+    DEFAULT_MAX_ATTEMPTS = 5
+    DEFAULT_BACKOFF = 1.0 # in seconds.
+    DEFAULT_MAX_BACKOFF = 300.0
+    DEFAULT_JITTER = 0.5
+    DEFAULT_RETRY_ON = ('RequestTimeoutException',
+                        'ThrottlingException',
+                        'ServiceUnavailableException',
+                        'GlacierConnectionError')
+
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+                 jitter=DEFAULT_JITTER, retry_on=DEFAULT_RETRY_ON):
+        """
+        :param max_attempts: maximum number of attempts per request,
+            including the first one.
+        :type max_attempts: int
+        :param backoff: wait before the first retry, in seconds.
+        :type backoff: float
+        :param max_backoff: maximum wait between attempts, in seconds.
+        :type max_backoff: float
+        :param jitter: fraction of the wait that is randomised.
+        :type jitter: float
+        :param retry_on: error codes to retry on.
+        :type retry_on: list of str
+
+        :raises: :py:exc:`glacier.glacierexception.InputException`
+        """
+        unknown = [code for code in retry_on
+                   if code not in GlacierException.ERRORCODE]
+        if unknown:
+            raise InputException(
+                'Unknown error code(s) to retry on: %s.'% ', '.join(unknown),
+                cause='Valid codes are: %s.'% ', '.join(sorted(GlacierException.ERRORCODE)),
+                code='CommandError')
+
+        if max_attempts < 1 or backoff < 0 or max_backoff < 0 or not 0 <= jitter <= 1:
+            raise InputException(
+                'Invalid retry settings.',
+                cause='Attempts must be at least 1, backoff times positive and jitter between 0 and 1.',
+                code='CommandError')
+
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on = frozenset(retry_on)
+
+    def error_code(self, error):
+        """
+        Returns the Glacier error code of an exception, or None.
+        """
+        if isinstance(error, GlacierException):
+            return error.code
+
+        if isinstance(error, boto.glacier.exceptions.UnexpectedHTTPResponseError):
+            if error.code:
+                return error.code
+            if error.status == 408:
+                return 'RequestTimeoutException'
+            if error.status >= 500:
+                return 'ServiceUnavailableException'
+            return None
+
+        if isinstance(error, (socket.error, httplib.HTTPException)):
+            return 'GlacierConnectionError'
+
+        return None
+
+    def should_retry(self, error, attempt):
+        """
+        Whether to try again after attempt number attempt failed
+        with error.
+        """
+        return attempt < self.max_attempts and \
+               self.error_code(error) in self.retry_on
+
+    def delay(self, attempt):
+        """
+        Seconds to wait after attempt number attempt failed.
+        """
+        delay = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+        return delay * (1 - self.jitter * random.random())
+
+def _close_part(data):
+    """
+    Lets a part that is read from a file (see :py:mod:`partreader`) know
+    it has been sent.
+    """
+    if hasattr(data, 'close'):
+        data.close()
 
 def bytes_to_hex(str):
     return ''.join( [ "%02x" % ord( x ) for x in str] ).strip()
@@ -76,13 +428,21 @@ class GlacierWriter(object):
     
     def __init__(self, connection, vault_name,
                  description=None, part_size_in_bytes=DEFAULT_PART_SIZE*1024*1024,
-                 uploadid=None, logger=None):
+                 uploadid=None, logger=None, hasher=None, retry_policy=None,
+                 journal=None, bucket=None):
 
         self.part_size = part_size_in_bytes
         self.vault_name = vault_name
         self.connection = connection
 ##        self.location = None
         self.logger = logger
+        self.hasher = hasher
+        self.retry_policy = retry_policy
+        self.journal = journal
+        self.bucket = bucket
+        self.retries = 0
+        self.retried_parts = 0
+        self._retry_lock = threading.Lock()
 
         if uploadid:
             self.uploadid = uploadid
@@ -97,10 +457,23 @@ class GlacierWriter(object):
         self.closed = False
 ##        self.upload_url = response.getheader("location")
 
-    def write(self, data):
-        
+    def write(self, data, linear_hash=None, part_tree_hash=None):
+        """
+        Uploads data as the next part. The linear hash (hex string) and
+        tree hash (binary string) of the part may be given if they are
+        already known; otherwise they are calculated here.
+        """
+        self._check_part(data)
+        self.tree_hashes.append(
+            self._send_part(self.connection, self.uploaded_size, data,
+                            linear_hash, part_tree_hash))
+
+        self.uploaded_size += len(data)
+        _close_part(data)
+
+    def _check_part(self, data):
         if self.closed:
-            raise CommunicationError(
+            raise CommunicationException(
                 "Tried to write to a GlacierWriter that is already closed.",
                 code='InternalError')
 
@@ -108,65 +481,70 @@ class GlacierWriter(object):
             raise InputException (
                 'Block of data provided must be equal to or smaller than the set block size.',
                 code='InternalError')
-        
-        part_tree_hash = tree_hash(chunk_hashes(data))
-        self.tree_hashes.append(part_tree_hash)
-        headers = {
-                   "x-amz-glacier-version": "2012-06-01",
-                    "Content-Range": "bytes %d-%d/*" % (self.uploaded_size,
-                                                       (self.uploaded_size+len(data))-1),
-                    "Content-Length": str(len(data)),
-                    "Content-Type": "application/octet-stream",
-                    "x-amz-sha256-tree-hash": bytes_to_hex(part_tree_hash),
-                    "x-amz-content-sha256": hashlib.sha256(data).hexdigest()
-                  }
-
-        response = self.connection.upload_part(self.vault_name,
-                                    self.uploadid,
-                                    hashlib.sha256(data).hexdigest(),
-                                    bytes_to_hex(part_tree_hash),
-                                    (self.uploaded_size, self.uploaded_size+len(data)-1),
-                                    data)
-        response.read()
-
-##        retries = 0
-##        while True:
-##            response = self.connection.make_request(
-##                "PUT",
-##                self.upload_url,
-##                headers,
-##                data)
-##
-##            # Success.
-##            if response.status == 204:
-##                break
-##
-##            # Time-out recieved: sleep for 5 minutes and try again.
-##            # Do not try more than five times; after that it's over.
-##            elif response.status == 408:
-##                if retries >= 5:
-##                    resp = json.loads(response.read())
-##                    raise ResonseException(
-##                        resp['message'],
-##                        cause='Timeout',
-##                        code=resp['code'])
-##                        
-##                if self.logger:
-##                    logger.warning(resp['message'])
-##                    logger.warning('sleeping 300 seconds (5 minutes) before retrying.')
-##                    
-##                retries += 1
-##                time.sleep(300)
-##
-##            else:
-##                raise ResponseException(
-##                    "Multipart upload part expected response status 204 (got %s):\n%s"\
-##                        % (response.status, response.read()),
-##                    cause=resp['message'],
-##                    code=resp['code'])
-
-##        response.read()
-        self.uploaded_size += len(data)
+
+    def _send_part(self, connection, offset, data,
+                   linear_hash=None, part_tree_hash=None):
+        """
+        Hashes data (unless the hashes are given) and uploads it over
+        connection as the part starting at offset. Returns the tree hash
+        of the part.
+        """
+        # Take the linear hash (for the x-amz-content-sha256 header) and
+        # the tree hash in a single pass over the data.
+        if not (linear_hash and part_tree_hash):
+            if self.hasher:
+                linear_hash, part_tree_hash = self.hasher.part_hashes(data)
+            else:
+                linear_hash, part_tree_hash = part_hashes(data)
+
+        attempt = 1
+        while True:
+            # Streamed parts are sent from the start on every attempt.
+            if hasattr(data, 'seek'):
+                data.seek(0)
+
+            try:
+                response = connection.upload_part(self.vault_name,
+                                                  self.uploadid,
+                                                  linear_hash,
+                                                  bytes_to_hex(part_tree_hash),
+                                                  (offset, offset+len(data)-1),
+                                                  ShapedBody(data, self.bucket)
+                                                  if self.bucket else data)
+                response.read()
+                if self.journal:
+                    self.journal.record(offset, offset+len(data),
+                                        bytes_to_hex(part_tree_hash))
+
+                return part_tree_hash
+            except Exception as e:
+                if not self.retry_policy or \
+                        not self.retry_policy.should_retry(e, attempt):
+                    raise
+
+            # Only the failed part is sent again, after a while.
+            delay = self.retry_policy.delay(attempt)
+            with self._retry_lock:
+                self.retries += 1
+                if attempt == 1:
+                    self.retried_parts += 1
+
+            if self.logger:
+                self.logger.warning('Upload of part %s-%s failed (%s); attempt %s of %s in %.1f seconds.'
+                                    % (offset, offset+len(data)-1,
+                                       self.retry_policy.error_code(e),
+                                       attempt + 1, self.retry_policy.max_attempts,
+                                       delay))
+
+            time.sleep(delay)
+            attempt += 1
+
+    def stop(self):
+        """
+        Gives up the upload without completing it. Nothing to do here,
+        as every part is sent by :py:meth:`write`.
+        """
+        pass
 
     def close(self):
         
@@ -194,3 +572,152 @@ class GlacierWriter(object):
     def get_hash(self):
         self.close()
         return self.hash_sha256
+
+class UploadBudget(object):
+    """
+    Limits the number of parts in flight, and optionally their total
+    size in bytes, for one or more :py:class:`ConcurrentGlacierWriter`
+    objects that share it. A part is always admitted when no other part
+    is in flight, however large it is.
+    """
+
+    def __init__(self, concurrency, memory=None):
+        """
+        :param concurrency: maximum number of parts in flight.
+        :type concurrency: int
+        :param memory: maximum total size of the parts in flight, in
+            bytes; None for no limit.
+        :type memory: int
+        """
+        self.concurrency = concurrency
+        self.memory = memory
+        self.parts = 0
+        self.bytes = 0
+        self.condition = threading.Condition()
+
+    def _full(self, size):
+        return self.parts >= self.concurrency or \
+               (self.memory is not None and self.bytes + size > self.memory)
+
+    def acquire(self, size):
+        """
+        Blocks until a part of size bytes may be sent.
+        """
+        with self.condition:
+            while self.parts and self._full(size):
+                self.condition.wait()
+
+            self.parts += 1
+            self.bytes += size
+
+    def release(self, size):
+        with self.condition:
+            self.parts -= 1
+            self.bytes -= size
+            self.condition.notify_all()
+
+class ConcurrentGlacierWriter(GlacierWriter):
+    """
+    :py:class:`GlacierWriter` that keeps up to concurrency parts in
+    flight at the same time. Every worker thread hashes and uploads parts
+    over its own connection, made by connection_factory, so one slow
+    round-trip no longer holds up the whole upload.
+
+    :py:meth:`write` returns as soon as a worker is free to take the
+    part; it blocks while concurrency parts are in flight, so no more
+    than concurrency parts are held in memory. Writers uploading several
+    files at once can share one :py:class:`UploadBudget` instead, which
+    then sets the limits for all of them together. The tree hashes are
+    stored by part index, so parts may finish in any order. Errors of a
+    worker are raised by the next call to :py:meth:`write` or
+    :py:meth:`close`.
+    """
+
+    def __init__(self, connection, vault_name, concurrency=2,
+                 connection_factory=None, budget=None, **kwargs):
+        GlacierWriter.__init__(self, connection, vault_name, **kwargs)
+        self.budget = budget or UploadBudget(concurrency)
+        self.concurrency = min(concurrency, self.budget.concurrency)
+        self.connection_factory = connection_factory
+        self.queue = Queue.Queue()
+        self.errors = []
+        self.workers = []
+        for i in range(self.concurrency):
+            worker = threading.Thread(target=self._worker,
+                                      name='GlacierWriter-%s' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _worker(self):
+        connection = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+
+            index, offset, data, linear_hash, part_tree_hash = item
+            size = len(data)
+            try:
+                if not self.errors:
+                    if connection is None:
+                        connection = self.connection_factory() \
+                                     if self.connection_factory else self.connection
+
+                    self.tree_hashes[index] = self._send_part(
+                        connection, offset, data, linear_hash, part_tree_hash)
+                    if self.logger:
+                        self.logger.debug('Part %s (%s-%s) uploaded.'% (index, offset, offset+size-1))
+
+                    _close_part(data)
+
+            except Exception:
+                self.errors.append(sys.exc_info())
+            finally:
+                del item, data
+                self.budget.release(size)
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.errors:
+            self.stop()
+            exc_type, exc_value, exc_traceback = self.errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+    def stop(self):
+        """
+        Stops the worker threads, without completing the upload. Parts
+        already handed to a worker are finished first.
+        """
+        for worker in self.workers:
+            self.queue.put(None)
+
+        for worker in self.workers:
+            worker.join()
+
+        self.workers = []
+
+    def write(self, data, linear_hash=None, part_tree_hash=None):
+        self._check_part(data)
+        self._raise_error()
+        self.budget.acquire(len(data))
+        if self.errors:
+            self.budget.release(len(data))
+            self._raise_error()
+
+        # Reserve the place of the part's tree hash; the worker fills it in.
+        index = len(self.tree_hashes)
+        self.tree_hashes.append(None)
+        self.queue.put((index, self.uploaded_size, data,
+                        linear_hash, part_tree_hash))
+        self.uploaded_size += len(data)
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.queue.join()
+        self._raise_error()
+        self.stop()
+        GlacierWriter.close(self)
@@ -45,6 +45,9 @@ class GlacierException(Exception):
                  'ResourceNotFoundException': 13, # Glacier can not find the requested resource.
                  'InvalidParameterValueException': 14,  # Parameter not accepted.
                  'DownloadError': 15,         # Downloading an archive failed.
+                 'RequestTimeoutException': 16,  # Glacier timed out waiting for data.
+                 'ThrottlingException': 17,   # Request rate too high.
+                 'ServiceUnavailableException': 18,  # Glacier temporarily unavailable.
                  'SNSConnectionError': 126,   # Can not connect to SNS
                  'SNSConfigurationError': 127,  # Problem with configuration file
                  'SNSParameterError':128,     # Problem with arguments passed to SNS
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: hashcache
+   :platform: Unix
+   :synopsis: Persistent cache of file tree hashes.
+
+Computing the tree hash of a multi-hundred-GB file means reading the
+complete file. The cache remembers the tree hash of a file and the
+hashes of its 1 MB chunks, keyed on the identity of the file (device,
+inode, size and modification time), so unchanged files can be
+answered without any I/O::
+
+    cache = TreeHashCache()
+    key = cache.key(file_name)
+    entry = cache.get(key)
+    if entry is None or entry.tree_hash is None:
+        ...
+        cache.put(key, tree_hash=tree_hash, leaves=leaves)
+
+The chunk hashes allow the tree hash of any 1 MB aligned range of the
+file (like the parts of a multipart upload) to be calculated as well.
+The size of the cache is bounded; least recently used entries are
+removed first.
+"""
+
+import os
+import time
+import logging
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+import glaciercorecalls
+
+def file_identity(file_name):
+    """
+    Returns the identity of a file: (device, inode, size, modification
+    time in ns). A file that changed gets a new identity.
+    """
+    st = os.stat(file_name)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+class CacheEntry(object):
+    """
+    Cached hashes of a file: the tree hash as hex string (None if not
+    known) and the binary hashes of the first :py:attr:`chunks` 1 MB
+    chunks, one after the other in the string leaves.
+    """
+
+    def __init__(self, tree_hash, leaves):
+        self.tree_hash = tree_hash
+        self.leaves = leaves
+
+    @property
+    def chunks(self):
+        return len(self.leaves) // TreeHashCache.HASH_SIZE
+
+    def range_tree_hash(self, start, stop):
+        """
+        Returns the binary tree hash of the byte range [start, stop) of
+        the file, or None if not all chunks of it are cached. start must
+        be a multiple of 1 MB.
+        """
+        chunk = glaciercorecalls.TreeHasher.CHUNK_SIZE
+        first, last = start // chunk, (stop + chunk - 1) // chunk
+        if start % chunk or last > self.chunks or first >= last:
+            return None
+
+        size = TreeHashCache.HASH_SIZE
+        return glaciercorecalls.tree_hash(self.leaves[i*size:(i+1)*size]
+                                          for i in xrange(first, last))
+
+class TreeHashCache(object):
+    """
+    SQLite backed tree hash cache, see the module documentation.
+    """
+
+    DEFAULT_PATH = '~/.cache/glacier-cmd/treehash.sqlite'
+    DEFAULT_MAX_SIZE = 256 # in MB of chunk hashes, about 8 TB of files.
+    HASH_SIZE = 32
+    ENTRY_OVERHEAD = 128 # Accounted size of an entry without chunk hashes.
+
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE, logger=None):
+        """
+        :param path: file name of the cache database.
+        :type path: str
+        :param max_size: maximum size of the stored chunk hashes, in MB.
+        :type max_size: int
+        """
+        self.path = os.path.expanduser(path or self.DEFAULT_PATH)
+        self.max_size = max_size * 1024 * 1024
+        self.logger = logger or logging.getLogger(self.__class__.__name__)
+
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, 0700)
+
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("""\
+CREATE TABLE IF NOT EXISTS treehash (
+    dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+    tree_hash TEXT, leaves BLOB, last_used REAL,
+    PRIMARY KEY (dev, ino, size, mtime_ns))""")
+        self.db.commit()
+
+    def key(self, file_name):
+        """
+        Returns the identity of a file as used as cache key. Take the
+        key before reading the file, so that changes made while hashing
+        invalidate the entry.
+        """
+        return file_identity(file_name)
+
+    def wants_leaves(self, size):
+        """
+        Whether the chunk hashes of a file of size bytes fit in the cache.
+        """
+        chunk = glaciercorecalls.TreeHasher.CHUNK_SIZE
+        return (size + chunk - 1) // chunk * self.HASH_SIZE <= self.max_size
+
+    def get(self, key):
+        """
+        Returns the :py:class:`CacheEntry` for key, or None.
+        """
+        row = self.db.execute("""\
+SELECT tree_hash, leaves FROM treehash
+WHERE dev=? AND ino=? AND size=? AND mtime_ns=?""", key).fetchone()
+        if row is None:
+            return None
+
+        self.db.execute("""\
+UPDATE treehash SET last_used=?
+WHERE dev=? AND ino=? AND size=? AND mtime_ns=?""", (time.time(),) + key)
+        self.db.commit()
+        tree_hash, blob = row
+        entry = CacheEntry(tree_hash, str(blob) if blob else '')
+        self.logger.debug('Tree hash cache hit for %s: %s chunk hashes.' % (key, entry.chunks))
+        return entry
+
+    def put(self, key, tree_hash=None, leaves=None):
+        """
+        Stores the tree hash and/or chunk hashes of a file. leaves are
+        the binary chunk hashes one after the other, as string or
+        bytearray; a string of 32 bytes per chunk takes far less memory
+        than a list of them. Values not given are kept from an existing
+        entry; fewer chunk hashes than already stored are ignored.
+        """
+        entry = self.get(key)
+        if entry:
+            tree_hash = tree_hash or entry.tree_hash
+            if leaves is None or len(leaves) < len(entry.leaves):
+                leaves = entry.leaves
+
+        blob = leaves or ''
+        if len(blob) > self.max_size:
+            blob = ''
+
+        # Older versions of the same file will never match again.
+        self.db.execute('DELETE FROM treehash WHERE dev=? AND ino=?', key[:2])
+        self.db.execute('INSERT INTO treehash VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        key + (tree_hash, sqlite3.Binary(blob), time.time()))
+        self._evict()
+        self.db.commit()
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the chunk hashes
+        fit in max_size again.
+        """
+        total = 0
+        rows = self.db.execute(
+            'SELECT rowid, length(leaves) FROM treehash ORDER BY last_used DESC')
+        expired = []
+        for rowid, size in rows.fetchall():
+            total += (size or 0) + self.ENTRY_OVERHEAD
+            if total > self.max_size:
+                expired.append((rowid,))
+
+        if expired:
+            self.logger.debug('Evicting %s entries from the tree hash cache.' % len(expired))
+            self.db.executemany('DELETE FROM treehash WHERE rowid=?', expired)
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: journal
+   :platform: Unix
+   :synopsis: Local journal of the parts of a multipart upload.
+
+To resume an interrupted upload, the parts already uploaded have to be
+checked against the local file. Without further information that means
+reading and hashing all uploaded data again. The journal records, for
+every upload of a file, which parts have been sent and their tree
+hashes, together with the identity of the file (device, inode, size and
+modification time)::
+
+    journal = UploadJournal.create(directory, uploadid, vault_name,
+                                   region, file_name, part_size)
+    journal.record(start, stop, tree_hash)   # After every part.
+    ...
+    journal.remove()                         # Upload completed.
+
+When the file did not change since, the recorded hashes can be trusted
+and compared to the hashes Amazon Glacier lists for the parts, without
+touching the file.
+
+A journal is a file of JSON lines: a header with the upload details,
+then one line per part. Every line is synced to disk before the part is
+counted as done, and a line cut short by a crash is ignored, so the
+journal is never ahead of what is uploaded.
+"""
+
+import os
+import json
+import glob
+import threading
+
+from hashcache import file_identity
+
+class UploadJournal(object):
+    """
+    Journal of one multipart upload, see the module documentation.
+    """
+
+    DEFAULT_DIR = '~/.cache/glacier-cmd/journal'
+    VERSION = 1
+
+    def __init__(self, path, header, parts):
+        self.path = path
+        self.header = header
+        self.parts = parts
+        self.uploadid = header['UploadId']
+        self.fd = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _path(directory, uploadid):
+        return os.path.join(os.path.expanduser(directory or UploadJournal.DEFAULT_DIR),
+                            '%s.journal' % uploadid)
+
+    @classmethod
+    def create(cls, directory, uploadid, vault_name, region, file_name,
+               part_size, identity=None):
+        """
+        Starts a new, empty journal for an upload, replacing an existing
+        journal of it.
+
+        :param identity: identity of the file as taken at the start of
+            the upload; by default the current one.
+        :type identity: tuple
+
+        :returns: the journal.
+        :rtype: :py:class:`UploadJournal`
+        """
+        path = cls._path(directory, uploadid)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0700)
+
+        header = {'Version': cls.VERSION,
+                  'UploadId': uploadid,
+                  'VaultName': vault_name,
+                  'Region': region,
+                  'FileName': os.path.abspath(file_name),
+                  'Identity': list(identity or file_identity(file_name)),
+                  'PartSize': part_size}
+
+        # Write the header to a temporary file and rename it, so there is
+        # never a journal without header.
+        temp_path = path + '.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            os.write(fd, json.dumps(header) + '\n')
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.rename(temp_path, path)
+        return cls(path, header, {})
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a journal file. Returns None if it is not a valid journal.
+        """
+        try:
+            with open(path, 'rb') as f:
+                lines = f.read().split('\n')
+        except EnvironmentError:
+            return None
+
+        # The last line is empty, or was cut short by a crash.
+        try:
+            header = json.loads(lines[0])
+            if header.get('Version') != cls.VERSION:
+                return None
+        except ValueError:
+            return None
+
+        parts = {}
+        for line in lines[1:-1]:
+            try:
+                part = json.loads(line)
+                parts[(part['Start'], part['Stop'])] = part['SHA256TreeHash']
+            except (ValueError, KeyError):
+                continue
+
+        return cls(path, header, parts)
+
+    @classmethod
+    def open(cls, directory, uploadid):
+        """
+        Returns the journal of an upload, or None if there is none.
+        """
+        return cls.load(cls._path(directory, uploadid))
+
+    @classmethod
+    def find(cls, directory, vault_name, region, file_name):
+        """
+        Returns the journal of the most recent unfinished upload of the
+        file, as it is now, to the vault, or None.
+        """
+        pattern = os.path.join(os.path.expanduser(directory or cls.DEFAULT_DIR),
+                               '*.journal')
+        identity = list(file_identity(file_name))
+        found = None
+        for path in glob.glob(pattern):
+            journal = cls.load(path)
+            if journal and journal.header['VaultName'] == vault_name \
+                    and journal.header['Region'] == region \
+                    and journal.header['Identity'] == identity:
+                if not found or os.path.getmtime(path) > os.path.getmtime(found.path):
+                    found = journal
+
+        return found
+
+    def matches(self, file_name):
+        """
+        Whether file_name is still the file the journal was made for.
+        """
+        return self.header['Identity'] == list(file_identity(file_name))
+
+    def tree_hash(self, start, stop):
+        """
+        Returns the recorded tree hash (hex string) of the part with the
+        byte range [start, stop), or None.
+        """
+        return self.parts.get((start, stop))
+
+    def record(self, start, stop, tree_hash):
+        """
+        Records that the part with the byte range [start, stop) and
+        tree hash (hex string) has been uploaded. Returns when the
+        record is on disk.
+        """
+        self.record_parts([(start, stop, tree_hash)])
+
+    def record_parts(self, parts):
+        """
+        Records a list of (start, stop, tree_hash) of uploaded parts at
+        once, see :py:meth:`record`.
+        """
+        if not parts:
+            return
+
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+        # A single write on an O_APPEND descriptor, so records written by
+        # parallel upload threads do not get mixed.
+        os.write(self.fd, ''.join(json.dumps({'Start': start,
+                                              'Stop': stop,
+                                              'SHA256TreeHash': tree_hash}) + '\n'
+                                  for start, stop, tree_hash in parts))
+        os.fsync(self.fd)
+        for start, stop, tree_hash in parts:
+            self.parts[(start, stop)] = tree_hash
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def remove(self):
+        """
+        Removes the journal, once the upload is completed.
+        """
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
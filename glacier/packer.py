@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: packer
+   :platform: Unix, Windows
+   :synopsis: Pack small files into tar bundles for upload.
+
+Every archive costs a request to initiate the upload, one per part and
+one to complete it, and an entry in the vault inventory. For many small
+files that overhead is most of the work. :py:func:`bundles` groups files
+into tar bundles of about a target size, and every
+:py:class:`TarBundle` reads as the tar data of its files, made on the fly
+from the files themselves, so the bundles are uploaded without temporary
+files::
+
+    for bundle in bundles(file_names, 1024 * 1024 * 1024):
+        archive_id, sha256hash = glacier.upload(..., reader=bundle)
+        for member in bundle.members:
+            print member.name, member.offset, member.size
+
+The offset and size of every member within the bundle are known before
+the bundle is read, so a single member can later be fetched with a
+ranged retrieval of the bundle.
+"""
+
+import os
+import stat
+import tarfile
+
+from glaciercorecalls import TreeHasher
+from glacierexception import *
+
+class TarMember(object):
+    """
+    A file in a :py:class:`TarBundle`. offset is the position of the data
+    of the file in the bundle, and size its length in bytes. tree_hash,
+    the SHA256 tree hash of the data, is set once the member has been
+    read.
+    """
+
+    def __init__(self, file_name, name, offset, size):
+        self.file_name = file_name
+        self.name = name
+        self.offset = offset
+        self.size = size
+        self.tree_hash = None
+
+class TarBundle(object):
+    """
+    File-like object that reads as a tar archive of a list of files. The
+    headers are made, and the size of the bundle is known, up front; the
+    data of the files is read while the bundle is read.
+    """
+
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, files):
+        """
+        :param files: list of (file name, os.stat result) of the files
+            to bundle.
+        :type files: list
+        """
+        self.members = []
+        self.headers = []
+        offset = 0
+        for file_name, st in files:
+            info = tarfile.TarInfo(member_name(file_name))
+            info.size = st.st_size
+            info.mtime = int(st.st_mtime)
+            info.mode = stat.S_IMODE(st.st_mode)
+            info.uid = st.st_uid
+            info.gid = st.st_gid
+            header = info.tobuf(tarfile.GNU_FORMAT)
+            self.headers.append(header)
+            offset += len(header)
+            self.members.append(TarMember(file_name, info.name, offset, st.st_size))
+            offset += _padded(st.st_size)
+
+        # The archive ends with two empty blocks, padded to a full record
+        # as tar writes it.
+        self.end = tarfile.RECORDSIZE - offset % tarfile.RECORDSIZE
+        if self.end < 2 * tarfile.BLOCKSIZE:
+            self.end += tarfile.RECORDSIZE
+
+        self.size = offset + self.end
+        self.chunks = self._chunks()
+        self.buffer = ''
+
+    def _chunks(self):
+        for header, member in zip(self.headers, self.members):
+            yield header
+            hasher = TreeHasher()
+            left = member.size
+            try:
+                with open(member.file_name, 'rb') as f:
+                    while left:
+                        data = f.read(min(left, self.READ_SIZE))
+                        if not data:
+                            break
+
+                        hasher.update(data)
+                        left -= len(data)
+                        yield data
+
+            except IOError as e:
+                raise InputException(
+                    "Could not read file: %s." % member.file_name,
+                    cause=e,
+                    code='FileError')
+
+            # The size in the header can not be changed any more.
+            if left:
+                raise InputException(
+                    "File changed while being packed: %s." % member.file_name,
+                    cause='File is %s bytes shorter than when the bundle was started.' % left,
+                    code='FileError')
+
+            member.tree_hash = hasher.hexdigest()
+            yield '\0' * (_padded(member.size) - member.size)
+
+        yield '\0' * self.end
+
+    def read(self, size=-1):
+        """
+        Reads up to size bytes of the bundle; all of it if size is
+        negative. Returns '' at the end.
+        """
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+
+            chunks.append(chunk)
+            length += len(chunk)
+
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+
+        self.buffer = data[size:]
+        return data[:size]
+
+def _padded(size):
+    """
+    Returns size rounded up to a whole number of tar blocks.
+    """
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+def member_name(file_name):
+    """
+    Returns the name of a file in a bundle: the path as given, without
+    leading slashes, like tar does.
+    """
+    return os.path.normpath(file_name).replace(os.sep, '/').lstrip('/')
+
+def bundles(file_names, bundle_size):
+    """
+    Groups files into :py:class:`TarBundle` objects, in the order given.
+    A bundle is closed as soon as it reaches bundle_size bytes, so a file
+    larger than that closes the bundle it is added to, together with the
+    files before it.
+
+    :param file_names: names of the files to pack.
+    :type file_names: list of str
+    :param bundle_size: target size of a bundle in bytes.
+    :type bundle_size: int
+
+    :returns: iterator over the bundles.
+    :rtype: iterator
+    :raises: :py:exc:`glacier.glacierexception.InputException`
+    """
+
+    files = []
+    size = 0
+    for file_name in file_names:
+        try:
+            st = os.stat(file_name)
+        except OSError as e:
+            raise InputException(
+                "Could not access file: %s." % file_name,
+                cause=e,
+                code='FileError')
+
+        if not stat.S_ISREG(st.st_mode):
+            raise InputException(
+                "Only regular files can be packed: %s." % file_name,
+                code='FileError')
+
+        files.append((file_name, st))
+        size += tarfile.BLOCKSIZE + _padded(st.st_size)
+        if size >= bundle_size:
+            yield TarBundle(files)
+            files = []
+            size = 0
+
+    if files:
+        yield TarBundle(files)
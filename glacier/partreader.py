@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: partreader
+   :platform: Unix, Windows
+   :synopsis: Zero-copy access to the parts of a file that is uploaded.
+
+Uploading a part used to mean reading it into a string of up to 4 GB.
+:py:class:`MappedFile` memory maps the file instead, and hands out
+:py:class:`MappedPart` objects for byte ranges. A part is only touched
+when it is hashed or sent, and then through small windows of the map
+which are unmapped again as soon as they are done with, so memory use
+does not depend on the part size::
+
+    mapped_file = map_file(open(file_name, 'rb'))
+    part = mapped_file[start:stop]
+    for block in part.blocks(65536):   # buffer objects, no copies.
+        hasher.update(block)
+    connection.upload_part(..., part)  # Sent as file-like object.
+
+Files that can not be mapped are read on demand in small blocks,
+using :py:class:`UnmappedFile` and :py:class:`FileSegment`.
+
+Reading terabytes through the page cache pushes out the data other
+programs on the machine need. With page_cache 'drop' the kernel is told
+to read ahead of the data being read (POSIX_FADV_WILLNEED) and to drop
+the data once it is done with (POSIX_FADV_DONTNEED); with 'direct' the
+data is read with O_DIRECT, into page aligned buffers, bypassing the
+page cache altogether. 'keep' leaves the page cache to the kernel.
+"""
+
+import os
+import mmap
+import ctypes
+import ctypes.util
+import threading
+
+# Python 3.3 and up; Python 2 reads segments with lseek and read.
+_pread = getattr(os, 'pread', None)
+
+PAGE_CACHE_MODES = ('keep', 'drop', 'direct')
+
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+# How far ahead of the data being read the kernel is asked to read.
+READAHEAD = 8 * 1024 * 1024
+
+# posix_fadvise and pread into a buffer, from the C library, where
+# available.
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fadvise = getattr(_libc, 'posix_fadvise64', None) or _libc.posix_fadvise
+    _fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    _pread_into = getattr(_libc, 'pread64', None) or _libc.pread
+    _pread_into.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64]
+    _pread_into.restype = ctypes.c_ssize_t
+except (OSError, AttributeError, TypeError):
+    _fadvise = _pread_into = None
+
+_O_DIRECT = getattr(os, 'O_DIRECT', 0)
+
+def fadvise(fd, offset, length, advice):
+    """
+    Tells the kernel how the byte range [offset, offset+length) of the
+    open file fd is going to be used. Does nothing where posix_fadvise
+    is not available.
+    """
+    if _fadvise and length > 0:
+        _fadvise(fd, offset, length, advice)
+
+class DirectReader(object):
+    """
+    Reads a file with O_DIRECT, bypassing the page cache, through a page
+    aligned buffer of buffer_size bytes. Opening the file raises OSError
+    where O_DIRECT is not supported.
+    """
+
+    ALIGNMENT = 4096
+
+    def __init__(self, file_name, buffer_size=1024 * 1024):
+        if not (_O_DIRECT and _pread_into):
+            raise OSError('O_DIRECT is not available.')
+
+        self.fd = os.open(file_name, os.O_RDONLY | _O_DIRECT)
+        self.size = os.fstat(self.fd).st_size
+        self.lock = threading.Lock()
+
+        # Anonymous maps are page aligned.
+        self.buffer_size = -(-buffer_size // self.ALIGNMENT) * self.ALIGNMENT
+        self.buffer = mmap.mmap(-1, self.buffer_size)
+        self.address = ctypes.addressof(ctypes.c_char.from_buffer(self.buffer))
+
+        # The byte range of the file in the buffer, so that small reads
+        # that follow each other do not read the same pages again.
+        self.buffered = (0, 0)
+
+    def read_at(self, offset, size):
+        """
+        Reads up to size bytes at offset; less at the end of the file.
+        """
+        data = []
+        stop = min(offset + size, self.size)
+        with self.lock:
+            while offset < stop:
+                aligned, count = self.buffered
+                if not aligned <= offset < aligned + count:
+                    aligned = offset - offset % self.ALIGNMENT
+                    count = _pread_into(self.fd, self.address, self.buffer_size, aligned)
+                    if count < 0:
+                        error = ctypes.get_errno()
+                        raise IOError(error, os.strerror(error))
+
+                    self.buffered = (aligned, count)
+                    if count <= offset - aligned:
+                        break
+
+                end = min(count, stop - aligned)
+                data.append(self.buffer[offset - aligned:end])
+                offset = aligned + end
+
+        return ''.join(data)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def read_blocks(file_name, start, stop, size, page_cache='keep'):
+    """
+    Iterates over the byte range [start, stop) of a file in blocks of
+    size bytes, handling the page cache as page_cache says (see the
+    module documentation). 'direct' falls back to 'drop' where the file
+    system does not support O_DIRECT.
+    """
+    if page_cache == 'direct':
+        try:
+            reader = DirectReader(file_name, size)
+        except (OSError, IOError):
+            page_cache = 'drop'
+        else:
+            try:
+                while start < stop:
+                    data = reader.read_at(start, min(size, stop - start))
+                    if not data:
+                        break
+
+                    start += len(data)
+                    yield data
+            finally:
+                reader.close()
+
+            return
+
+    with open(file_name, 'rb') as f:
+        fd = f.fileno()
+        f.seek(start)
+        first = start
+        if page_cache == 'drop':
+            fadvise(fd, start, min(READAHEAD, stop - start), POSIX_FADV_WILLNEED)
+
+        try:
+            while start < stop:
+                data = f.read(min(size, stop - start))
+                if not data:
+                    break
+
+                # Keep READAHEAD bytes ahead of the position asked for,
+                # and drop what has been read.
+                if page_cache == 'drop':
+                    ahead = start + READAHEAD
+                    fadvise(fd, ahead, min(len(data), stop - ahead), POSIX_FADV_WILLNEED)
+                    fadvise(fd, start, len(data), POSIX_FADV_DONTNEED)
+
+                start += len(data)
+                yield data
+
+        finally:
+            # Pages still being read ahead when they were dropped are
+            # left in the cache; drop them now.
+            if page_cache == 'drop':
+                fadvise(fd, first, start - first, POSIX_FADV_DONTNEED)
+
+class BlockReader(object):
+    """
+    File-like object that reads the byte range [start, stop) of a file
+    front to back through :py:func:`read_blocks`, so the page cache is
+    handled as page_cache says. For consumers that read a stream, like
+    the compressor, rather than parts.
+    """
+
+    def __init__(self, file_name, start, stop, size, page_cache='keep'):
+        self.blocks = read_blocks(file_name, start, stop, size, page_cache)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            data = next(self.blocks, None)
+            if data is None:
+                break
+
+            chunks.append(data)
+            length += len(data)
+
+        data = ''.join(chunks) if len(chunks) > 1 else chunks[0]
+        if size < 0:
+            size = len(data)
+
+        self.buffer = data[size:]
+        return data[:size] if size < len(data) else data
+
+    def close(self):
+        """
+        Stops reading; drops what is left in the page cache with 'drop'.
+        """
+        self.blocks.close()
+        self.buffer = ''
+
+class MappedPart(object):
+    """
+    A byte range of a :py:class:`MappedFile`. Behaves as a read-only
+    file-like object (read, seek, tell and len) so it can be passed as
+    request body, and provides :py:meth:`blocks` for zero-copy hashing.
+    """
+
+    def __init__(self, mapped_file, start, stop):
+        self.mapped_file = mapped_file
+        self.start = start
+        self.stop = stop
+        self.position = 0
+        self._window = None
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __nonzero__(self):
+        return self.stop > self.start
+
+    def blocks(self, size):
+        """
+        Iterates over the part in blocks of at most size bytes. The
+        blocks are buffer objects pointing into the map; a window of the
+        map stays mapped only as long as blocks of it are referenced.
+        """
+        window_size = max(self.mapped_file.WINDOW_SIZE // size, 1) * size
+        for window_start in xrange(self.start, self.stop, window_size):
+            length = min(window_size, self.stop - window_start)
+            window, delta = self.mapped_file.window(window_start, length)
+            for offset in xrange(0, length, size):
+                yield buffer(window, delta + offset, min(size, length - offset))
+
+            del window
+
+    def prefetch(self):
+        """
+        Reads the part from disk into the page cache, by touching every
+        page of it, so that hashing and sending it later does not have
+        to wait for the disk.
+        """
+        window_size = self.mapped_file.WINDOW_SIZE
+        for window_start in xrange(self.start, self.stop, window_size):
+            length = min(window_size, self.stop - window_start)
+            window, delta = self.mapped_file.window(window_start, length)
+            for offset in xrange(delta, delta + length, mmap.PAGESIZE):
+                window[offset]
+
+            del window
+
+    def read(self, size=-1):
+        remaining = len(self) - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+
+        data = []
+        while size > 0:
+            offset = self.start + self.position
+            if not self._window or not \
+                    self._window[0] <= offset < self._window[0] + self._window[1]:
+                length = min(self.mapped_file.WINDOW_SIZE, self.stop - offset)
+                window, delta = self.mapped_file.window(offset, length)
+                self._window = (offset, length, window, delta)
+
+            window_start, length, window, delta = self._window
+            begin = delta + offset - window_start
+            end = begin + min(size, window_start + length - offset)
+            data.append(window[begin:end])
+            self.position += end - begin
+            size -= end - begin
+
+        return ''.join(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += len(self)
+
+        self.position = min(max(offset, 0), len(self))
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        """
+        Called when the part has been sent.
+        """
+        self._window = None
+        if self.mapped_file.drop_cache:
+            fadvise(self.mapped_file.file.fileno(), self.start, len(self),
+                    POSIX_FADV_DONTNEED)
+
+class MappedFile(object):
+    """
+    Read-only memory map of a file. Slicing returns a
+    :py:class:`MappedPart`, not a string. With drop_cache the pages of
+    a part are dropped from the page cache when the part is closed.
+    """
+
+    WINDOW_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, file, drop_cache=False):
+        self.file = file
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.drop_cache = drop_cache
+
+        # Fail early if the file can not be mapped at all.
+        self.window(0, min(self.size, mmap.ALLOCATIONGRANULARITY))
+
+    def __getitem__(self, key):
+        start = key.start or 0
+        stop = self.size if key.stop is None else min(key.stop, self.size)
+        return MappedPart(self, start, max(start, stop))
+
+    def window(self, offset, length):
+        """
+        Maps length bytes of the file starting at offset. Returns the map
+        and the position of offset in it.
+        """
+        delta = offset % mmap.ALLOCATIONGRANULARITY
+        window = mmap.mmap(self.file.fileno(), length + delta,
+                           access=mmap.ACCESS_READ, offset=offset - delta)
+        if hasattr(window, 'madvise'):
+            window.madvise(mmap.MADV_SEQUENTIAL)
+
+        return window, delta
+
+class FileSegment(object):
+    """
+    A byte range of an open file, given by file descriptor, offset and
+    length, that is read on demand. Behaves like :py:class:`MappedPart`
+    (blocks, read, seek, tell and len), but reads with pread (or seek
+    and read under lock, where pread is not available), so no more than
+    one block of it is in memory at a time. With drop_cache the segment
+    is dropped from the page cache when it is closed.
+    """
+
+    def __init__(self, fd, offset, length, lock=None, drop_cache=False):
+        self.fd = fd
+        self.offset = offset
+        self.length = length
+        self.position = 0
+        self.lock = lock or threading.Lock()
+        self.drop_cache = drop_cache
+
+    def __len__(self):
+        return self.length
+
+    def __nonzero__(self):
+        return self.length > 0
+
+    def _read_at(self, position, size):
+        """
+        Reads size bytes at position of the segment, without moving
+        the file position of other segments of the same file.
+        """
+        if _pread:
+            data = _pread(self.fd, size, self.offset + position)
+        else:
+            with self.lock:
+                os.lseek(self.fd, self.offset + position, os.SEEK_SET)
+                data = os.read(self.fd, size)
+
+        if len(data) < size:
+            raise IOError('Unexpected end of file at offset %s; file truncated while uploading?'
+                          % (self.offset + position + len(data)))
+
+        return data
+
+    def blocks(self, size):
+        """
+        Iterates over the segment in blocks of at most size bytes.
+        """
+        for position in xrange(0, self.length, size):
+            yield self._read_at(position, min(size, self.length - position))
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+
+        if not size:
+            return ''
+
+        data = self._read_at(self.position, size)
+        self.position += size
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+
+        self.position = min(max(offset, 0), self.length)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        """
+        Called when the segment has been sent.
+        """
+        if self.drop_cache:
+            fadvise(self.fd, self.offset, self.length, POSIX_FADV_DONTNEED)
+
+class UnmappedFile(object):
+    """
+    Substitute for :py:class:`MappedFile` for files that can not be
+    memory mapped. Slicing returns a :py:class:`FileSegment`, so parts
+    are streamed from the file instead of read into memory.
+    """
+    def __init__(self, file, drop_cache=False):
+        self.file = file
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.lock = threading.Lock()
+        self.drop_cache = drop_cache
+
+    def __getitem__(self, key):
+        start = key.start or 0
+        stop = self.size if key.stop is None else min(key.stop, self.size)
+        return FileSegment(self.file.fileno(), start, max(stop - start, 0),
+                           self.lock, self.drop_cache)
+
+class DirectSegment(FileSegment):
+    """
+    A byte range of a file that is read on demand with O_DIRECT, through
+    a :py:class:`DirectReader`. Behaves like :py:class:`FileSegment`; no
+    more than one block of it is in memory at a time.
+    """
+
+    def __init__(self, reader, offset, length):
+        FileSegment.__init__(self, reader.fd, offset, length)
+        self.reader = reader
+
+    def _read_at(self, position, size):
+        data = self.reader.read_at(self.offset + position, size)
+        if len(data) < size:
+            raise IOError('Unexpected end of file at offset %s; file truncated while uploading?'
+                          % (self.offset + position + len(data)))
+
+        return data
+
+class DirectFile(object):
+    """
+    Substitute for :py:class:`MappedFile` that reads with O_DIRECT.
+    Slicing returns a :py:class:`DirectSegment`, which is read in
+    blocks, bypassing the page cache, when it is hashed and sent.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.reader = DirectReader(file.name)
+        self.size = self.reader.size
+
+    def __getitem__(self, key):
+        start = key.start or 0
+        stop = self.size if key.stop is None else min(key.stop, self.size)
+        return DirectSegment(self.reader, start, max(stop - start, 0))
+
+    def close(self):
+        self.reader.close()
+
+def map_file(file, page_cache='keep'):
+    """
+    Returns a :py:class:`MappedFile` for file, or an
+    :py:class:`UnmappedFile` if the file can not be memory mapped
+    (empty files, pipes, some network file systems). With page_cache
+    'direct' a :py:class:`DirectFile` is returned instead, where the
+    file system supports O_DIRECT.
+    """
+    if page_cache == 'direct':
+        try:
+            return DirectFile(file)
+        except EnvironmentError:
+            page_cache = 'drop'
+
+    try:
+        return MappedFile(file, page_cache == 'drop')
+    except (mmap.error, ValueError, EnvironmentError):
+        return UnmappedFile(file, page_cache == 'drop')
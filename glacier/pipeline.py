@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: pipeline
+   :platform: Unix, Windows
+   :synopsis: Overlap reading, hashing and sending of upload parts.
+
+Uploading a part takes three steps: reading it from disk or stdin,
+hashing it, and sending it to Amazon Glacier. Done one after the other
+the disk and CPU are idle while a part is on the wire, and the network
+is idle while the next part is read and hashed. :py:class:`UploadPipeline`
+runs each step in its own thread, connected by bounded queues, so part
+N+1 is read and hashed while part N is sent::
+
+    pipeline = UploadPipeline(parts, writer, hasher, readahead=1)
+    for size in pipeline:      # After every part sent.
+        print pipeline.report()
+
+Every stage keeps track of how much of the time it is busy; the stage
+that is busy nearly all the time is the bottleneck.
+"""
+
+import sys
+import time
+import threading
+import Queue
+
+import glaciercorecalls
+
+class Stage(object):
+    """
+    Occupancy counter of a pipeline stage: the number of parts handled,
+    and the time spent working on them, as opposed to waiting for a part
+    to work on or for room in the pipeline.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.parts = 0
+        self.busy = 0.0
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+
+    def done(self):
+        self.busy += time.time() - self.started
+        self.started = None
+        self.parts += 1
+
+    def busy_time(self, now=None):
+        """
+        Time spent working on parts, including the current one.
+        """
+        started = self.started
+        if started is None:
+            return self.busy
+
+        return self.busy + (now or time.time()) - started
+
+class UploadPipeline(object):
+    """
+    Reads parts from the iterable parts in a reader thread, hashes them
+    in a hasher thread, and writes them with their hashes to writer (a
+    :py:class:`glaciercorecalls.GlacierWriter`) in the calling thread.
+    Iterating over the pipeline runs it; the size of every part written
+    is yielded.
+
+    readahead is the number of parts that may be read and hashed ahead of
+    the part being sent, so at most readahead + 1 parts are held by the
+    pipeline. With readahead=0 the stages take turns, as a plain loop.
+    Errors in the reader or hasher thread are raised in the caller.
+    """
+
+    def __init__(self, parts, writer, hasher=None, readahead=1):
+        self.parts = parts
+        self.writer = writer
+        self.hasher = hasher
+        self.readahead = readahead
+        self.slots = threading.Semaphore(readahead + 1)
+
+        # Queues have room for all parts in the pipeline plus the end
+        # marker, so putting never blocks; the slots bound the queues.
+        self.read_queue = Queue.Queue(readahead + 2)
+        self.hash_queue = Queue.Queue(readahead + 2)
+        self.stages = [Stage('read'), Stage('hash'), Stage('send')]
+        self.stopped = False
+        self.start_time = None
+
+    def _read(self):
+        stage = self.stages[0]
+        parts = iter(self.parts)
+        try:
+            while True:
+                self.slots.acquire()
+                if self.stopped:
+                    break
+
+                stage.start()
+                data = next(parts, None)
+                if not data:
+                    stage.started = None
+                    break
+
+                # Parts of mapped files are read lazily; fault their pages
+                # in now, not while hashing.
+                if hasattr(data, 'prefetch'):
+                    data.prefetch()
+
+                stage.done()
+                self.read_queue.put((data, None))
+                del data
+
+        except Exception:
+            stage.started = None
+            self.read_queue.put((None, sys.exc_info()))
+
+        self.read_queue.put(None)
+
+    def _hash(self):
+        stage = self.stages[1]
+        while True:
+            item = self.read_queue.get()
+            if item is None:
+                break
+
+            data, exc_info = item
+            del item
+            if exc_info or self.stopped:
+                self.hash_queue.put((None, None, None, exc_info))
+                continue
+
+            stage.start()
+            try:
+                # Parts may come with their hashes already taken.
+                if getattr(data, 'hashes', None):
+                    linear_hash, tree_hash = data.hashes
+                elif self.hasher:
+                    linear_hash, tree_hash = self.hasher.part_hashes(data)
+                else:
+                    linear_hash, tree_hash = glaciercorecalls.part_hashes(data)
+            except Exception:
+                stage.started = None
+                self.hash_queue.put((None, None, None, sys.exc_info()))
+                continue
+
+            stage.done()
+            self.hash_queue.put((data, linear_hash, tree_hash, None))
+            del data
+
+        self.hash_queue.put(None)
+
+    def __iter__(self):
+        self.start_time = time.time()
+        threads = [threading.Thread(target=self._read, name='UploadPipeline-read'),
+                   threading.Thread(target=self._hash, name='UploadPipeline-hash')]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        stage = self.stages[2]
+        try:
+            while True:
+                item = self.hash_queue.get()
+                if item is None:
+                    break
+
+                data, linear_hash, tree_hash, exc_info = item
+                del item
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                stage.start()
+                self.writer.write(data, linear_hash, tree_hash)
+                stage.done()
+                size = len(data)
+                del data
+                self.slots.release()
+                yield size
+
+            for thread in threads:
+                thread.join()
+
+        finally:
+            # Let the reader and hasher run out if we stop early.
+            self.stopped = True
+            self.slots.release()
+
+    def occupancy(self):
+        """
+        Returns a list of (stage name, fraction of the time busy, number
+        of parts handled) for the read, hash and send stages.
+        """
+        now = time.time()
+        elapsed = now - self.start_time if self.start_time else 0
+        return [(stage.name,
+                 stage.busy_time(now) / elapsed if elapsed > 0 else 0.0,
+                 stage.parts)
+                for stage in self.stages]
+
+    def queue_sizes(self):
+        """
+        Returns the number of parts waiting to be hashed and to be sent.
+        """
+        return self.read_queue.qsize(), self.hash_queue.qsize()
+
+    def bottleneck(self):
+        """
+        Returns the name of the busiest stage.
+        """
+        return max(self.occupancy(), key=lambda stage: stage[1])[0]
+
+    def report(self):
+        """
+        Returns a one line summary of the stage occupancy, like
+        'read 12%, hash 31%, send 97%; waiting to hash 0, to send 1.'
+        """
+        stages = ', '.join('%s %d%%' % (name, round(100 * busy))
+                           for name, busy, parts in self.occupancy())
+        return '%s; waiting to hash %s, to send %s.' % ((stages,) + self.queue_sizes())
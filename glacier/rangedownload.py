@@ -0,0 +1,595 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: rangedownload
+   :platform: Unix, Windows
+   :synopsis: Download an archive in byte ranges, several at a time.
+
+Fetching the output of a retrieval job one range after another leaves
+the download bound by the latency of a single stream.
+:py:class:`RangedDownload` fetches up to concurrency ranges at the same
+time, each over its own connection, and writes every range at its own
+offset in the output file, which is allocated up front::
+
+    download = RangedDownload(connection_factory, vault_name, job_id,
+                              size, part_size, concurrency=4)
+    tree_hash = download.download(fd, progress)
+
+The ranges are part_size bytes, a power of two megabytes, so every
+range is a complete sub-tree of the tree hash of the archive, and the
+tree hash is put together from the tree hashes of the ranges. Every
+range is checked against the tree hash Amazon Glacier sends with it as
+soon as it is in; a corrupted range is fetched again, on its own. Ranges
+are handed out in order and their hashes are combined as soon as all
+ranges before them are done, so only the hashes of the ranges still in
+flight are held, whatever the size of the archive. The data of a
+range is not held either: it is written and hashed a block at a time,
+as it comes in.
+
+Data that goes to a pipe, like stdout, has to be written in order.
+:py:meth:`RangedDownload.stream` hands the data out in order, through a
+:py:class:`ReorderBuffer` that holds the ranges that come in ahead of
+their turn, up to a memory budget::
+
+    for data in download.stream(memory_budget):
+        sys.stdout.write(data)
+    download.tree_hash
+
+A range is held until it is complete and checked, as long as the memory
+budget allows; a range part of which had to be handed out already can
+not be fetched again, and then fails the download when it is corrupted.
+"""
+
+import os
+import sys
+import math
+import time
+import errno
+import binascii
+import Queue
+import collections
+import threading
+import ctypes
+import ctypes.util
+
+from glaciercorecalls import TreeHasher, bytes_to_hex
+from shaping import iter_shaped
+from glacierexception import *
+
+# Python 3.3 and up; Python 2 takes pwrite and posix_fallocate from the
+# C library, where available.
+_pwrite = getattr(os, 'pwrite', None)
+_fallocate = getattr(os, 'posix_fallocate', None)
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _pwrite_from = getattr(_libc, 'pwrite64', None) or _libc.pwrite
+    _pwrite_from.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int64]
+    _pwrite_from.restype = ctypes.c_ssize_t
+    _fallocate_c = getattr(_libc, 'posix_fallocate64', None) or _libc.posix_fallocate
+    _fallocate_c.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError, TypeError):
+    _pwrite_from = _fallocate_c = None
+
+# fsync also writes the metadata, where fdatasync is not available.
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+_seek_lock = threading.Lock()
+
+def pwrite(fd, data, offset):
+    """
+    Writes all of the string data at offset in the open file fd,
+    without moving the file position, so threads can write to the same
+    file at once.
+    """
+    while data:
+        if _pwrite:
+            count = _pwrite(fd, data, offset)
+        elif _pwrite_from:
+            count = _pwrite_from(fd, data, len(data), offset)
+            if count < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+
+                raise IOError(error, os.strerror(error))
+        else:
+            with _seek_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                count = os.write(fd, data)
+
+        data = data[count:]
+        offset += count
+
+def preallocate(fd, size):
+    """
+    Sets the size of the open file fd to size bytes, allocating the
+    disk space up front where the file system supports it, so writing
+    does not fail half way for lack of space and the file is not
+    fragmented.
+
+    :raises: IOError when the disk is full.
+    """
+    os.ftruncate(fd, size)
+    if not size:
+        return
+
+    if _fallocate:
+        try:
+            _fallocate(fd, 0, size)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise IOError(e.errno, e.strerror)
+    elif _fallocate_c:
+        error = _fallocate_c(fd, 0, size)
+        if error == errno.ENOSPC:
+            raise IOError(error, os.strerror(error))
+
+def aligned_part_size(part_size):
+    """
+    Returns part_size in bytes rounded up to a power of two megabytes.
+    Ranges of that size, starting at a multiple of it, are tree hash
+    aligned: Amazon Glacier sends their tree hash along, and the tree
+    hash of the archive can be put together from theirs.
+    """
+    size = TreeHasher.CHUNK_SIZE
+    while size < part_size:
+        size *= 2
+
+    return size
+
+def archive_description(response):
+    """
+    Returns the archive description Amazon Glacier sent with a response
+    to get_job_output, or None.
+    """
+    http_response = getattr(response, 'http_response', None)
+    if http_response:
+        return http_response.getheader('x-amz-archive-description')
+
+    return None
+
+class RangeHashes(object):
+    """
+    Puts together the tree hash of an archive from the tree hashes of
+    its ranges, which may come in any order. Every range but the last is
+    part_size bytes, a power of two megabytes.
+    """
+
+    def __init__(self, part_size):
+        self.level = int(round(math.log(part_size // TreeHasher.CHUNK_SIZE, 2)))
+        self.hasher = TreeHasher()
+        self.next = 0
+        self.pending = {}
+
+    def add(self, index, digest):
+        """
+        Adds the tree hash (binary string) of range number index.
+        """
+        self.pending[index] = digest
+        while self.next in self.pending:
+            self.hasher.add_hash(self.pending.pop(self.next), self.level)
+            self.next += 1
+
+    def digest(self):
+        return self.hasher.digest()
+
+    def hexdigest(self):
+        return bytes_to_hex(self.digest())
+
+class RangedDownload(object):
+    """
+    Download of the output of a retrieval job in ranges, see the module
+    documentation.
+    """
+
+    BLOCK_SIZE = TreeHasher.CHUNK_SIZE # Read at a time from a response.
+    MEMORY_BUDGET = 256 * 1024 * 1024 # Of ranges ahead, in stream().
+    MAX_ATTEMPTS = 3 # For bad data, without retry policy.
+
+    def __init__(self, connection_factory, vault_name, job_id, size,
+                 part_size, concurrency=2, bucket=None, retry_policy=None,
+                 logger=None, checkpoint=None):
+        """
+        :param connection_factory: function that opens a connection to
+            Amazon Glacier; called once by every worker thread.
+        :type connection_factory: function
+        :param size: size of the archive in bytes.
+        :type size: int
+        :param part_size: size of the ranges in bytes; rounded up to a
+            power of two megabytes, see :py:func:`aligned_part_size`.
+        :type part_size: int
+        :param concurrency: number of ranges to fetch at the same time.
+        :type concurrency: int
+        :param bucket: token bucket to read the data through, see
+            :py:mod:`shaping`; None for no limit.
+        :type bucket: :py:class:`shaping.TokenBucket`
+        :param retry_policy: when to fetch a failed range again.
+        :type retry_policy: :py:class:`glaciercorecalls.RetryPolicy`
+        :param checkpoint: checkpoint to skip the ranges on disk
+            already, and to record the ranges written in.
+        :type checkpoint: :py:class:`checkpoint.DownloadCheckpoint`
+        """
+        self.connection_factory = connection_factory
+        self.vault_name = vault_name
+        self.job_id = job_id
+        self.size = size
+        self.part_size = aligned_part_size(part_size)
+        self.concurrency = max(1, concurrency)
+        self.bucket = bucket
+        self.retry_policy = retry_policy
+        self.logger = logger
+        self.checkpoint = checkpoint
+        self.retries = 0
+
+        # The archive description Amazon Glacier sends with the data.
+        self.description = checkpoint.description if checkpoint else None
+        self._retry_lock = threading.Lock()
+
+    def ranges(self):
+        """
+        Iterates over the ranges of the archive as (index, start, stop).
+        """
+        for index, start in enumerate(xrange(0, self.size, self.part_size)):
+            yield index, start, min(start + self.part_size, self.size)
+
+    def fetch(self, connection, target, index, start, stop):
+        """
+        Fetches range number index, the byte range [start, stop) of the
+        job output, over connection, and hands it to target (a
+        :py:class:`FileTarget` or :py:class:`ReorderBuffer`) block by
+        block as it comes in. The data is checked against the tree hash
+        Amazon Glacier sends with the range.
+
+        A range that comes in short or corrupted is fetched again, up to
+        the maximum number of attempts of the retry policy; other errors
+        are tried again as the retry policy says. Returns the response
+        and the tree hash of the range.
+        """
+        attempt = 1
+        while True:
+            try:
+                response = connection.get_job_output(self.vault_name,
+                                                     self.job_id,
+                                                     byte_range=(start, stop-1))
+                if index == 0:
+                    self.description = archive_description(response)
+
+                hasher = TreeHasher()
+                offset = start
+                for data in iter_shaped(response, self.bucket, self.BLOCK_SIZE):
+                    hasher.update(data)
+                    target.write(index, offset, data)
+                    offset += len(data)
+
+                if offset != stop:
+                    raise CommunicationException(
+                        "Received %s bytes instead of %s." % (offset - start, stop - start),
+                        code="DownloadError")
+
+                # Sent for tree hash aligned ranges only.
+                expected = response.get('TreeHash') if hasattr(response, 'get') else None
+                if expected and expected != hasher.hexdigest():
+                    raise CommunicationException(
+                        "Range %s-%s does not match its tree hash." % (start, stop-1),
+                        cause='Received %s, expected %s.' % (hasher.hexdigest(), expected),
+                        code="DownloadError")
+
+                return response, hasher.digest()
+            except (InputException, Cancelled):
+                raise
+            except Exception as e:
+                if not self._should_retry(e, attempt) or \
+                        not target.restart(index):
+                    raise
+
+            delay = self.retry_policy.delay(attempt) if self.retry_policy else 0
+            with self._retry_lock:
+                self.retries += 1
+
+            if self.logger:
+                self.logger.warning('Download of range %s-%s failed (%s); attempt %s of %s in %.1f seconds.'
+                                    % (start, stop-1,
+                                       getattr(e, 'code', None) or e.__class__.__name__,
+                                       attempt + 1, self._max_attempts(),
+                                       delay))
+
+            time.sleep(delay)
+            attempt += 1
+
+    def _max_attempts(self):
+        if self.retry_policy:
+            return self.retry_policy.max_attempts
+
+        return self.MAX_ATTEMPTS
+
+    def _should_retry(self, error, attempt):
+        # Bad data is always fetched again, whatever the policy.
+        if isinstance(error, CommunicationException) and \
+                error.code == 'DownloadError':
+            return attempt < self._max_attempts()
+
+        return bool(self.retry_policy) and \
+               self.retry_policy.should_retry(error, attempt)
+
+    def _worker(self, ranges, target, stopped):
+        connection = None
+        while not stopped.is_set():
+            try:
+                index, start, stop = ranges.get_nowait()
+            except Queue.Empty:
+                break
+
+            try:
+                if connection is None:
+                    connection = self.connection_factory()
+
+                response, digest = self.fetch(connection, target, index, start, stop)
+                if self.checkpoint:
+                    target.sync()
+                    self.checkpoint.record(start, stop, bytes_to_hex(digest),
+                                           self.description if index == 0 else None)
+
+                target.done(index, stop - start, digest)
+            except Cancelled:
+                break
+            except Exception:
+                target.failed(sys.exc_info())
+                break
+
+    def _start(self, ranges, target, stopped):
+        workers = []
+        for i in range(min(self.concurrency, ranges.qsize())):
+            worker = threading.Thread(target=self._worker,
+                                      args=(ranges, target, stopped),
+                                      name='RangedDownload-%s' % i)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        return workers
+
+    def download(self, fd, progress=None):
+        """
+        Fetches all ranges and writes them to the open file fd, which is
+        set to the size of the archive first. progress, if given, is
+        called with the number of bytes done after every range. Ranges
+        the checkpoint lists are skipped; their recorded tree hashes go
+        into the tree hash of the archive.
+
+        :returns: the tree hash of the data as hex string.
+        :rtype: str
+        """
+        try:
+            preallocate(fd, self.size)
+        except (IOError, OSError) as e:
+            raise InputException(
+                "Cannot allocate %s bytes for the output file." % self.size,
+                cause=e,
+                code='FileError')
+
+        # Only the ranges that are not on disk already are fetched.
+        hashes = RangeHashes(self.part_size)
+        done = count = 0
+        ranges = Queue.Queue()
+        for index, start, stop in self.ranges():
+            tree_hash = self.checkpoint and self.checkpoint.tree_hash(start, stop)
+            if tree_hash:
+                hashes.add(index, binascii.unhexlify(tree_hash))
+                done += stop - start
+            else:
+                ranges.put((index, start, stop))
+
+            count += 1
+
+        results = Queue.Queue()
+        stopped = threading.Event()
+        workers = self._start(ranges, FileTarget(fd, results), stopped)
+        try:
+            while hashes.next < count:
+                index, size, digest, error = results.get()
+                if error:
+                    raise error[0], error[1], error[2]
+
+                hashes.add(index, digest)
+                done += size
+                if self.logger:
+                    self.logger.debug('Range %s (%s bytes) downloaded.' % (index, size))
+
+                if progress:
+                    progress(done)
+        finally:
+            stopped.set()
+            for worker in workers:
+                worker.join()
+
+        return hashes.hexdigest()
+
+    def stream(self, memory_budget=None, progress=None):
+        """
+        Fetches all ranges, up to concurrency at a time, and iterates
+        over the data in order, in blocks of up to :py:attr:`BLOCK_SIZE`
+        bytes, through a :py:class:`ReorderBuffer` of memory_budget
+        bytes (default :py:attr:`MEMORY_BUDGET`). progress, if given, is
+        called with the number of bytes handed out after every range.
+        The tree hash of the data is in :py:attr:`tree_hash` at the end.
+        """
+        ranges = Queue.Queue()
+        for item in self.ranges():
+            ranges.put(item)
+
+        count = ranges.qsize()
+        hashes = RangeHashes(self.part_size)
+        buffer = ReorderBuffer(memory_budget or self.MEMORY_BUDGET)
+        stopped = threading.Event()
+        workers = self._start(ranges, buffer, stopped)
+        done = 0
+        try:
+            while hashes.next < count:
+                index, data, digest = buffer.get()
+                if data is not None:
+                    done += len(data)
+                    yield data
+                    continue
+
+                hashes.add(index, digest)
+                if self.logger:
+                    self.logger.debug('Range %s downloaded.' % index)
+
+                if progress:
+                    progress(done)
+        finally:
+            stopped.set()
+            buffer.close()
+            for worker in workers:
+                worker.join()
+
+        self.tree_hash = hashes.hexdigest()
+
+class Cancelled(Exception):
+    """
+    Raised in a worker that hands data to a :py:class:`ReorderBuffer`
+    that was closed, to stop it.
+    """
+
+class FileTarget(object):
+    """
+    Where :py:meth:`RangedDownload.download` has its workers put the
+    data: at its place in the open file fd. Done ranges and errors go
+    to the results queue.
+    """
+
+    def __init__(self, fd, results):
+        self.fd = fd
+        self.results = results
+
+    def write(self, index, offset, data):
+        try:
+            pwrite(self.fd, data, offset)
+        except (IOError, OSError) as e:
+            raise InputException(
+                "Cannot write data to the specified file.",
+                cause=e,
+                code='FileError')
+
+    def restart(self, index):
+        # Written again over the same place.
+        return True
+
+    def sync(self):
+        _fdatasync(self.fd)
+
+    def done(self, index, size, digest):
+        self.results.put((index, size, digest, None))
+
+    def failed(self, error):
+        self.results.put((None, 0, None, error))
+
+class ReorderBuffer(object):
+    """
+    Hands out the data of ranges that are fetched at the same time, in
+    order. Ranges are held, up to budget bytes in all, until it is their
+    turn and they are complete and checked, so a corrupted range can be
+    fetched again. A worker with a block that does not fit waits, so a
+    slow consumer slows down the download instead of filling memory;
+    while a worker waits, the blocks of the range whose turn it is go
+    through as they come in. That range may always hold one block, so
+    the buffer never locks up, whatever the budget.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.next = 0
+        self.blocks = {}
+        self.complete = {}
+        self.error = None
+        self.closed = False
+        self.waiting = 0
+
+        # Ranges part of which was handed out; they can not start over.
+        self.started = set()
+        self.condition = threading.Condition()
+
+    def write(self, index, offset, data):
+        """
+        Adds a block of data of range number index; waits while the
+        buffer is full.
+        """
+        with self.condition:
+            while not self.closed and self.size + len(data) > self.budget and \
+                    (index != self.next or self.blocks.get(index)):
+                self.waiting += 1
+                self.condition.notify_all()
+                self.condition.wait()
+                self.waiting -= 1
+
+            if self.closed:
+                raise Cancelled()
+
+            self.blocks.setdefault(index, collections.deque()).append(data)
+            self.size += len(data)
+            self.condition.notify_all()
+
+    def restart(self, index):
+        """
+        Drops the data of range index, to fetch it again. Returns False
+        when that is not possible anymore, as part of it was handed out.
+        """
+        with self.condition:
+            if index in self.started:
+                return False
+
+            self.size -= sum(len(data) for data in self.blocks.pop(index, ()))
+            self.condition.notify_all()
+            return True
+
+    def sync(self):
+        pass
+
+    def done(self, index, size, digest):
+        with self.condition:
+            self.complete[index] = digest
+            self.condition.notify_all()
+
+    def failed(self, error):
+        with self.condition:
+            self.error = self.error or error
+            self.condition.notify_all()
+
+    def get(self):
+        """
+        Returns (index, data, None) with the next block of data in
+        order, or (index, None, tree hash) when range number index is
+        complete. Waits until it is there; raises the error of a worker.
+        """
+        with self.condition:
+            while True:
+                if self.error:
+                    raise self.error[0], self.error[1], self.error[2]
+
+                index = self.next
+                blocks = self.blocks.get(index)
+                if blocks and (index in self.complete or self.waiting):
+                    data = blocks.popleft()
+                    self.size -= len(data)
+                    self.started.add(index)
+                    self.condition.notify_all()
+                    return index, data, None
+
+                if index in self.complete:
+                    self.blocks.pop(index, None)
+                    self.started.discard(index)
+                    self.next += 1
+                    self.condition.notify_all()
+                    return index, None, self.complete.pop(index)
+
+                self.condition.wait()
+
+    def close(self):
+        """
+        Drops all data, and stops the workers.
+        """
+        with self.condition:
+            self.closed = True
+            self.blocks = {}
+            self.size = 0
+            self.condition.notify_all()
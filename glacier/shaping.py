@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: shaping
+   :platform: Unix, Windows
+   :synopsis: Bandwidth shaping for uploads and downloads.
+
+When the uplink is shared with other traffic, glacier-cmd should not take
+all of it. A :py:class:`TokenBucket` limits the rate at which all parts
+in the process together send or receive data, to the rate a
+:py:class:`BandwidthSchedule` gives for the time of day::
+
+    schedule = BandwidthSchedule(20 * 1024 * 1024,
+                                 parse_windows(['01:00-06:00=0']))
+    bucket = TokenBucket(schedule)
+    connection.upload_part(..., ShapedBody(part, bucket))
+    for block in iter_shaped(response, bucket):
+        out_file.write(block)
+
+A rate of None or 0 means no limit. Windows are in local time, and may
+cross midnight (22:00-06:00).
+"""
+
+import re
+import time
+import threading
+import cStringIO
+from datetime import datetime
+
+from glacierexception import *
+
+MB = 1024 * 1024
+
+WINDOW = re.compile(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(\d+(?:\.\d*)?)\s*$')
+
+def parse_rate(rate):
+    """
+    Returns a rate given in MB/s as bytes per second, or None for 0 or
+    no rate, meaning no limit.
+    """
+    rate = float(rate or 0)
+    return int(rate * MB) if rate > 0 else None
+
+def parse_windows(windows):
+    """
+    Parses time window rules like '01:00-06:00=0': from 01:00 to 06:00
+    local time no limit; the rate is in MB/s. Hours are 00 to 23; a
+    window may end at 24:00. Returns a list of (start minute, end
+    minute, bytes per second or None).
+
+    :raises: :py:exc:`glacier.glacierexception.InputException`
+    """
+    rules = []
+    for window in windows:
+        match = WINDOW.match(window)
+        if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59 \
+                or int(match.group(4)) > 59 or int(match.group(3)) > 24 \
+                or (int(match.group(3)) == 24 and int(match.group(4)) > 0):
+            raise InputException(
+                'Invalid bandwidth window: %s. Use HH:MM-HH:MM=MB/s, e.g. 01:00-06:00=0.' % window,
+                code='CommandError')
+
+        start = int(match.group(1)) * 60 + int(match.group(2))
+        end = int(match.group(3)) * 60 + int(match.group(4))
+        rules.append((start, end, parse_rate(match.group(5))))
+
+    return rules
+
+def choose_windows(given, configured):
+    """
+    Returns the windows given on the command line or, if none were
+    given, those of the configuration file. Windows on the command line
+    replace the configured ones; as the first matching window counts,
+    adding them after the configured ones would hide any that overlap.
+
+    :param given: windows from the command line, or None.
+    :type given: list
+    :param configured: comma separated windows from the configuration
+        file, or None.
+    :type configured: str
+    """
+    if given:
+        return given
+
+    return [window.strip() for window in (configured or '').split(',')
+            if window.strip()]
+
+class BandwidthSchedule(object):
+    """
+    The bandwidth cap by time of day: the rate of the first window that
+    contains the time, or the default rate outside all windows.
+    """
+
+    def __init__(self, rate=None, windows=()):
+        """
+        :param rate: default rate in bytes per second; None for no limit.
+        :type rate: int
+        :param windows: list of (start minute, end minute, rate), see
+            :py:func:`parse_windows`.
+        :type windows: list
+        """
+        self.default_rate = rate
+        self.windows = list(windows)
+
+    def _minute_rate(self, minute):
+        for start, end, rate in self.windows:
+            if start <= minute < end or \
+                    (end < start and (minute >= start or minute < end)):
+                return rate
+
+        return self.default_rate
+
+    def rate(self, now=None):
+        """
+        Returns the cap in bytes per second at time now (seconds since the
+        epoch, default the current time), or None for no limit.
+        """
+        moment = datetime.fromtimestamp(now if now is not None else time.time())
+        return self._minute_rate(moment.hour * 60 + moment.minute)
+
+    def limited(self):
+        """
+        Whether there is a limit at any time of day.
+        """
+        return self.default_rate is not None or \
+               any(rate is not None for start, end, rate in self.windows)
+
+    def transfer_time(self, size, rate, now=None):
+        """
+        Estimates the seconds needed to transfer size bytes from time now
+        on, when unshaped the transfer goes at rate bytes per second. In
+        every window the slower of the cap and rate is taken.
+        """
+        if rate <= 0:
+            return None
+
+        now = now if now is not None else time.time()
+        boundaries = sorted(set(minute % (24 * 60) * 60
+                                for start, end, cap in self.windows
+                                for minute in (start, end)))
+        elapsed = 0.0
+        while size > 0:
+            # The cap holds until the next start or end of a window.
+            moment = datetime.fromtimestamp(now + elapsed)
+            second = moment.hour * 3600 + moment.minute * 60 + \
+                     moment.second + moment.microsecond / 1e6
+            later = [b for b in boundaries if b > second]
+            if later:
+                span = later[0] - second
+            elif boundaries:
+                span = boundaries[0] + 24 * 3600 - second
+            else:
+                span = None
+
+            cap = self._minute_rate(moment.hour * 60 + moment.minute)
+            speed = min(cap, rate) if cap else rate
+            if span is None or speed * span >= size:
+                return elapsed + size / float(speed)
+
+            size -= speed * span
+            elapsed += span
+
+        return elapsed
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter, shared by all threads that transfer data.
+    Tokens, one per byte, come in at the rate of the schedule, and up to
+    BURST seconds worth of them are saved up while idle. Every transfer
+    takes its tokens up front and, if there were not enough, waits until
+    they would have come in.
+    """
+
+    BURST = 0.25
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.tokens = 0.0
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """
+        Takes size tokens; blocks as long as needed to stay within the
+        rate.
+        """
+        with self.lock:
+            now = time.time()
+            rate = self.schedule.rate(now)
+            if rate is None:
+                self.tokens = 0.0
+                self.updated = now
+                return
+
+            self.tokens = min(rate * self.BURST,
+                              self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= size
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+class ShapedBody(object):
+    """
+    Request body that reads as data (a string or file-like part object),
+    at the pace allowed by the bucket.
+    """
+
+    def __init__(self, data, bucket):
+        self.length = len(data)
+        self.data = data if hasattr(data, 'read') else cStringIO.StringIO(data)
+        self.bucket = bucket
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        data = self.data.read(size)
+        self.bucket.consume(len(data))
+        return data
+
+    def seek(self, offset, whence=0):
+        self.data.seek(offset, whence)
+
+    def tell(self):
+        return self.data.tell()
+
+def iter_shaped(response, bucket, block_size=64 * 1024):
+    """
+    Iterates over the data of an HTTP response in blocks of up to
+    block_size bytes, at the pace allowed by the bucket, which may be
+    None for no limit.
+    """
+    while True:
+        block = response.read(block_size)
+        if not block:
+            break
+
+        if bucket:
+            bucket.consume(len(block))
+
+        yield block
+
+def read_shaped(response, bucket, block_size=64 * 1024):
+    """
+    Reads all of an HTTP response, at the pace allowed by the bucket,
+    which may be None for no limit.
+    """
+    if not bucket:
+        return response.read()
+
+    return ''.join(iter_shaped(response, bucket, block_size))
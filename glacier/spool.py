@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+.. module:: spool
+   :platform: Unix
+   :synopsis: Spool data from stdin to disk while it is uploaded.
+
+Data piped in over stdin can be read only once. Uploading it means
+holding every part in memory until it is sent, and an interrupted upload
+can only be resumed by feeding the exact same stream again.
+:py:class:`UploadSpool` writes every part read from stdin to a file of
+its own before it is uploaded, and removes the file as soon as Amazon
+Glacier has acknowledged the part::
+
+    spool = UploadSpool.create(directory, uploadid, vault_name, region,
+                               part_size, max_parts=4)
+    writer.journal = spool          # Calls spool.record() per part.
+    for part in spool.spool(sys.stdin):
+        writer.write(part)          # Sent from the part file.
+    ...
+    spool.remove()                  # Upload completed.
+
+The parts are sent from their files, so several can be uploaded at the
+same time without holding them in memory. At most max_parts part files
+are kept; reading from stdin waits until a part is acknowledged.
+
+After a crash the spool holds the parts that were read but not yet
+acknowledged. The upload is resumed by sending those again, and, if the
+end of the data had not been reached, the rest of the data from stdin,
+starting at :py:attr:`UploadSpool.size`.
+"""
+
+import os
+import json
+import glob
+import shutil
+import threading
+
+from partreader import FileSegment
+from glacierexception import *
+
+class UploadSpool(object):
+    """
+    Spool of one multipart upload from stdin, see the module
+    documentation.
+    """
+
+    DEFAULT_DIR = '~/.cache/glacier-cmd/spool'
+    VERSION = 1
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, path, header, max_parts=1):
+        self.path = path
+        self.header = header
+        self.uploadid = header['UploadId']
+        self.max_parts = max(max_parts, 1)
+        self.fds = {}
+        self.condition = threading.Condition()
+
+        # The byte ranges of the parts in the spool.
+        self.parts = set()
+        for part_path in glob.glob(os.path.join(path, '*.part')):
+            start, stop = os.path.basename(part_path)[:-5].split('-')
+            self.parts.add((int(start), int(stop)))
+
+    @staticmethod
+    def _path(directory, uploadid):
+        return os.path.join(os.path.expanduser(directory or UploadSpool.DEFAULT_DIR),
+                            uploadid)
+
+    def _part_path(self, start, stop):
+        return os.path.join(self.path, '%020d-%020d.part' % (start, stop))
+
+    def _write_header(self):
+        # Write the header to a temporary file and rename it, so there is
+        # always a complete header.
+        header_path = os.path.join(self.path, 'header.json')
+        fd = os.open(header_path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            os.write(fd, json.dumps(self.header))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.rename(header_path + '.tmp', header_path)
+
+    @classmethod
+    def create(cls, directory, uploadid, vault_name, region, part_size,
+               compression=None, size=0, max_parts=1):
+        """
+        Starts a new, empty spool for an upload.
+
+        :param compression: codec the data is compressed with before it
+            is spooled, if any.
+        :type compression: str
+        :param size: number of bytes uploaded already; the first part
+            spooled starts there.
+        :type size: int
+        :param max_parts: maximum number of part files in the spool.
+        :type max_parts: int
+
+        :returns: the spool.
+        :rtype: :py:class:`UploadSpool`
+        """
+        path = cls._path(directory, uploadid)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+        os.makedirs(path, 0700)
+        spool = cls(path, {'Version': cls.VERSION,
+                           'UploadId': uploadid,
+                           'VaultName': vault_name,
+                           'Region': region,
+                           'PartSize': part_size,
+                           'Compression': compression,
+                           'Size': size,
+                           'Complete': False}, max_parts)
+        spool._write_header()
+        return spool
+
+    @classmethod
+    def load(cls, path, max_parts=1):
+        """
+        Reads a spool directory. Returns None if it is not a valid spool.
+        """
+        try:
+            with open(os.path.join(path, 'header.json'), 'rb') as f:
+                header = json.load(f)
+        except (EnvironmentError, ValueError):
+            return None
+
+        if header.get('Version') != cls.VERSION:
+            return None
+
+        return cls(path, header, max_parts)
+
+    @classmethod
+    def open(cls, directory, uploadid, max_parts=1):
+        """
+        Returns the spool of an upload, or None if there is none.
+        """
+        return cls.load(cls._path(directory, uploadid), max_parts)
+
+    @classmethod
+    def find(cls, directory, vault_name, region, max_parts=1):
+        """
+        Returns the spool of the most recent unfinished upload to the
+        vault, or None.
+        """
+        pattern = os.path.join(os.path.expanduser(directory or cls.DEFAULT_DIR),
+                               '*', 'header.json')
+        found = None
+        for header_path in glob.glob(pattern):
+            spool = cls.load(os.path.dirname(header_path), max_parts)
+            if spool and spool.header['VaultName'] == vault_name \
+                    and spool.header['Region'] == region:
+                if not found or os.path.getmtime(header_path) > \
+                        os.path.getmtime(os.path.join(found.path, 'header.json')):
+                    found = spool
+
+        return found
+
+    @property
+    def size(self):
+        """
+        Number of bytes of data spooled, or uploaded, so far.
+        """
+        return self.header['Size']
+
+    @property
+    def complete(self):
+        """
+        Whether the end of the data was reached.
+        """
+        return self.header['Complete']
+
+    def part(self, start, stop):
+        """
+        Returns the spooled part with the byte range [start, stop), as a
+        file-like :py:class:`partreader.FileSegment`.
+        """
+        fd = os.open(self._part_path(start, stop), os.O_RDONLY)
+        with self.condition:
+            self.fds[(start, stop)] = fd
+
+        return FileSegment(fd, 0, stop - start)
+
+    def spool(self, source):
+        """
+        Reads the data from the file-like object source, in parts of
+        PartSize bytes, and iterates over the parts as spooled on disk.
+        The first part starts at :py:attr:`size`.
+
+        :raises: :py:exc:`glacier.glacierexception.InputException`
+        """
+        part_size = self.header['PartSize']
+        while True:
+
+            # Wait for room in the spool.
+            with self.condition:
+                while len(self.parts) >= self.max_parts:
+                    self.condition.wait()
+
+            start = self.size
+            temp_path = os.path.join(self.path, 'part.tmp')
+            try:
+                with open(temp_path, 'wb') as f:
+                    length = 0
+                    while length < part_size:
+                        data = source.read(min(self.READ_SIZE, part_size - length))
+                        if not data:
+                            break
+
+                        f.write(data)
+                        length += len(data)
+
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                if not length:
+                    os.remove(temp_path)
+                    self.header['Complete'] = True
+                    self._write_header()
+                    break
+
+                os.rename(temp_path, self._part_path(start, start + length))
+                with self.condition:
+                    self.parts.add((start, start + length))
+
+                self.header['Size'] = start + length
+                self._write_header()
+            except EnvironmentError as e:
+                raise InputException(
+                    "Could not write to the spool: %s." % self.path,
+                    cause=e,
+                    code='FileError')
+
+            yield self.part(start, start + length)
+            if length < part_size:
+                self.header['Complete'] = True
+                self._write_header()
+                break
+
+    def record(self, start, stop, tree_hash):
+        """
+        Removes the part with the byte range [start, stop) from the
+        spool, once it has been uploaded.
+        """
+        with self.condition:
+            fd = self.fds.pop((start, stop), None)
+            self.parts.discard((start, stop))
+            self.condition.notify_all()
+
+        if fd is not None:
+            os.close(fd)
+
+        try:
+            os.remove(self._part_path(start, stop))
+        except OSError:
+            pass
+
+    def close(self):
+        with self.condition:
+            fds, self.fds = self.fds.values(), {}
+
+        for fd in fds:
+            os.close(fd)
+
+    def remove(self):
+        """
+        Removes the spool, once the upload is completed.
+        """
+        self.close()
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,96 @@
+import unittest
+
+import sys
+import time
+import StringIO
+from datetime import datetime
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+from shaping import BandwidthSchedule, TokenBucket, ShapedBody, \
+                    parse_rate, parse_windows, read_shaped, \
+                    choose_windows, MB
+from glacierexception import InputException
+
+
+def at(hour, minute=0):
+    return time.mktime(datetime(2013, 1, 1, hour, minute).timetuple())
+
+
+class TestBandwidthSchedule(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(parse_rate(None), None)
+        self.assertEqual(parse_rate(0), None)
+        self.assertEqual(parse_rate('1.5'), 3 * MB / 2)
+        self.assertEqual(parse_windows(['01:00-06:30=2', '22:00-06:00=0']),
+                         [(60, 390, 2 * MB), (1320, 360, None)])
+        self.assertEqual(parse_windows(['18:00-24:00=1']), [(1080, 1440, MB)])
+        for window in ['1-6=2', '25:00-06:00=1', '01:00-06:00', '24:00-06:00=1',
+                       '22:00-24:59=1', '22:00-25:00=1', '01:60-06:00=1',
+                       '01:00-06:60=1']:
+            self.assertRaises(InputException, parse_windows, [window])
+
+    def test_choose(self):
+        configured = '09:00-17:00=1, 22:00-06:00=0'
+        self.assertEqual(choose_windows(None, configured),
+                         ['09:00-17:00=1', '22:00-06:00=0'])
+        self.assertEqual(choose_windows(['10:00-12:00=5'], configured),
+                         ['10:00-12:00=5'])
+        self.assertEqual(choose_windows(None, None), [])
+        # The command-line window counts where it overlaps a configured one.
+        schedule = BandwidthSchedule(None, parse_windows(
+            choose_windows(['10:00-12:00=5'], configured)))
+        self.assertEqual(schedule.rate(at(11)), 5 * MB)
+
+    def test_rate(self):
+        schedule = BandwidthSchedule(MB, parse_windows(['09:00-17:00=2',
+                                                        '22:00-06:00=0']))
+        self.assertTrue(schedule.limited())
+        self.assertEqual(schedule.rate(at(8, 59)), MB)
+        self.assertEqual(schedule.rate(at(9)), 2 * MB)
+        self.assertEqual(schedule.rate(at(17)), MB)
+        self.assertEqual(schedule.rate(at(23)), None)
+        self.assertEqual(schedule.rate(at(3)), None)
+        self.assertFalse(BandwidthSchedule().limited())
+
+    def test_transfer_time(self):
+        schedule = BandwidthSchedule(MB, parse_windows(['22:00-06:00=0']))
+        self.assertEqual(schedule.transfer_time(60 * MB, 10 * MB, at(12)), 60)
+
+        # 1 MB/s until 22:00, after that at the full 10 MB/s.
+        self.assertEqual(schedule.transfer_time(3600 * MB + 36000 * MB,
+                                                10 * MB, at(21)), 7200)
+        self.assertEqual(BandwidthSchedule().transfer_time(MB, MB / 2), 2)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_rate(self):
+        bucket = TokenBucket(BandwidthSchedule(4 * MB))
+        started = time.time()
+        for i in range(5):
+            bucket.consume(MB / 2)
+
+        # 2.5 MB at 4 MB/s, less the burst.
+        self.assertTrue(0.3 < time.time() - started < 0.7)
+
+    def test_unlimited(self):
+        bucket = TokenBucket(BandwidthSchedule())
+        started = time.time()
+        bucket.consume(1000 * MB)
+        self.assertTrue(time.time() - started < 0.1)
+
+    def test_shaped_body(self):
+        bucket = TokenBucket(BandwidthSchedule(100 * MB))
+        body = ShapedBody('abcdef', bucket)
+        self.assertEqual(len(body), 6)
+        self.assertEqual(body.read(4), 'abcd')
+        self.assertEqual(body.tell(), 4)
+        body.seek(0)
+        self.assertEqual(body.read(), 'abcdef')
+        self.assertEqual(read_shaped(StringIO.StringIO('x' * 100000), bucket),
+                         'x' * 100000)
+        self.assertEqual(read_shaped(StringIO.StringIO('abc'), None), 'abc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+
+import os
+import sys
+import gzip
+import StringIO
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+import compression
+from compression import CompressedReader, Decompressor, sample_ratio, \
+     file_samples, tag_description, parse_description
+from glacierexception import InputException
+
+
+class TestCompressedReader(unittest.TestCase):
+    def setUp(self):
+        self.data = ''.join('line %d of some log file\n' % i for i in range(500000))
+
+    def read_all(self, reader, size=100000):
+        out = []
+        while True:
+            chunk = reader.read(size)
+            if not chunk:
+                break
+            out.append(chunk)
+
+        reader.close()
+        return ''.join(out)
+
+    def test_roundtrip(self):
+        for codec in compression.CODECS:
+            for jobs in (1, 3):
+                reader = CompressedReader(StringIO.StringIO(self.data), codec, jobs=jobs)
+                packed = self.read_all(reader)
+                self.assertTrue(len(packed) < len(self.data) / 4)
+                self.assertEqual(reader.size_in, len(self.data))
+
+                # Feed the decompressor in pieces that cut through the
+                # stream boundaries.
+                decompressor = Decompressor(codec)
+                out = ''.join(decompressor.decompress(packed[i:i+7777])
+                              for i in range(0, len(packed), 7777))
+                self.assertEqual(out, self.data)
+
+    def test_gzip_tools(self):
+        packed = self.read_all(CompressedReader(StringIO.StringIO(self.data), 'gzip'))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(packed)).read(), self.data)
+
+    def test_pass_through(self):
+        source = StringIO.StringIO(self.data)
+        head = source.read(1000)
+        self.assertEqual(self.read_all(CompressedReader(source, None, head=head)), self.data)
+
+    def test_unknown_codec(self):
+        self.assertRaises(InputException, CompressedReader, StringIO.StringIO(''), 'zip')
+
+
+class TestSampling(unittest.TestCase):
+    def test_ratio(self):
+        self.assertTrue(sample_ratio(['abc' * 10000]) < 0.1)
+        self.assertTrue(sample_ratio([os.urandom(65536)]) > compression.MAX_RATIO)
+        self.assertEqual(sample_ratio([]), 1.0)
+
+    def test_file_samples(self):
+        data = os.urandom(5 * 1024 * 1024)
+        f = StringIO.StringIO(data)
+        samples = file_samples(f, len(data))
+        self.assertEqual(len(samples), compression.SAMPLES)
+        self.assertEqual(samples[-1], data[-compression.SAMPLE_SIZE:])
+        self.assertEqual(f.tell(), 0)
+
+    def test_description(self):
+        self.assertEqual(parse_description(tag_description('backup', 'bz2', 1234)), ('bz2', 1234))
+        self.assertEqual(parse_description(tag_description('backup', 'gzip')), ('gzip', None))
+        self.assertEqual(parse_description('backup'), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+
+import os
+import sys
+import shutil
+import tempfile
+import StringIO
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+from dedup import Chunker, DedupReader, DedupStore, parse_recipe
+from glaciercorecalls import TreeHasher
+from glacierexception import InputException
+
+MB = 1024 * 1024
+
+
+class TestChunker(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(24 * MB)
+
+    def chunks(self, data):
+        return list(Chunker().chunks(StringIO.StringIO(data)))
+
+    def test_sizes(self):
+        chunks = self.chunks(self.data)
+        self.assertEqual(''.join(chunks), self.data)
+        for chunk in chunks[:-1]:
+            self.assertTrue(Chunker.MIN_SIZE <= len(chunk) <= Chunker.MAX_SIZE)
+
+    def test_insert(self):
+        # An insert only changes the chunks around it.
+        before = set(self.chunks(self.data))
+        after = self.chunks(self.data[:5 * MB] + 'inserted' + self.data[5 * MB:])
+        self.assertTrue(len([chunk for chunk in after if chunk not in before]) <= 2)
+
+    def test_uniform_data(self):
+        chunks = self.chunks('\0' * (20 * MB))
+        self.assertEqual(sum(len(chunk) for chunk in chunks), 20 * MB)
+
+
+class TestDedupReader(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = DedupStore(self.dir)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def upload(self, data, archive_id):
+        reader = DedupReader(StringIO.StringIO(data), self.store.lookup('vault', 'region'))
+        pack = reader.read() if reader.has_data() else ''
+        self.store.add('vault', 'region', archive_id, reader.new_chunks)
+        return pack, reader.recipe(archive_id, 'name')
+
+    def restore(self, recipe, archives):
+        return ''.join(archives[archive_id][offset:offset + size]
+                       for archive_id, offset, size, digest in recipe['Chunks'])
+
+    def test_dedup(self):
+        first = os.urandom(12 * MB)
+        second = first[:3 * MB] + os.urandom(1000) + first[4 * MB:]
+        archives = {}
+        archives['a'], recipe1 = self.upload(first, 'a')
+        archives['b'], recipe2 = self.upload(second, 'b')
+        self.assertEqual(len(archives['a']), len(first))
+        self.assertTrue(len(archives['b']) < 4 * MB)
+        self.assertEqual(self.restore(recipe2, archives), second)
+        self.assertEqual(recipe2['SHA256TreeHash'], TreeHasher(second).hexdigest())
+
+        # Nothing new the second time.
+        pack, recipe3 = self.upload(second, None)
+        self.assertEqual(pack, '')
+        self.assertEqual(self.restore(recipe3, archives), second)
+
+    def test_forget(self):
+        data = os.urandom(2 * MB)
+        self.upload(data, 'a')
+        self.store.forget('a')
+        pack, recipe = self.upload(data, 'b')
+        self.assertEqual(pack, data)
+
+    def test_recipe(self):
+        pack, recipe = self.upload(os.urandom(MB), 'a')
+        self.store.save_recipe('r', recipe)
+        self.assertEqual(self.store.load_recipe('r'), recipe)
+        self.assertEqual(self.store.load_recipe('missing'), None)
+        self.assertRaises(InputException, parse_recipe, 'not json')
+
+
+if __name__ == '__main__':
+    unittest.main()
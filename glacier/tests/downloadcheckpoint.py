@@ -0,0 +1,94 @@
+import unittest
+
+import os
+import sys
+import shutil
+import tempfile
+import StringIO
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+from checkpoint import DownloadCheckpoint
+from glaciercorecalls import TreeHasher
+from rangedownload import RangedDownload
+
+MB = 1024 * 1024
+
+
+class FakeConnection(object):
+    def __init__(self, data):
+        self.data = data
+        self.fetched = []
+
+    def get_job_output(self, vault_name, job_id, byte_range=None):
+        start, end = byte_range
+        self.fetched.append(start)
+        return StringIO.StringIO(self.data[start:end + 1])
+
+
+class TestDownloadCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'archive')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create(self, size=2050):
+        return DownloadCheckpoint.create(self.file_name, 'vault', 'archive',
+                                         size, 'ff', 1024)
+
+    def test_record(self):
+        checkpoint = self.create()
+        checkpoint.record(0, 1024, 'aa', 'description')
+        checkpoint.record(2048, 2050, 'cc')
+        checkpoint.close()
+        checkpoint = DownloadCheckpoint.open(self.file_name)
+        self.assertEqual(checkpoint.tree_hash(0, 1024), 'aa')
+        self.assertEqual(checkpoint.tree_hash(1024, 2048), None)
+        self.assertEqual(checkpoint.size_done, 1026)
+        self.assertEqual(checkpoint.part_size, 1024)
+        self.assertEqual(checkpoint.description, 'description')
+        self.assertTrue(checkpoint.matches('archive', 2050, 'ff'))
+        self.assertFalse(checkpoint.matches('archive', 2050, 'ee'))
+
+        checkpoint.remove()
+        self.assertEqual(DownloadCheckpoint.open(self.file_name), None)
+
+    def test_crash(self):
+        checkpoint = self.create()
+        checkpoint.record(0, 1024, 'aa')
+        checkpoint.close()
+
+        # A record cut short is ignored.
+        with open(checkpoint.path, 'ab') as f:
+            f.write('{"Start": 1024, "Stop": 20')
+
+        checkpoint = DownloadCheckpoint.open(self.file_name)
+        self.assertEqual(checkpoint.parts, {(0, 1024): 'aa'})
+
+    def test_resume(self):
+        data = os.urandom(5 * MB + 100)
+        checkpoint = DownloadCheckpoint.create(self.file_name, 'vault',
+                                               'archive', len(data), 'ff', MB)
+        with open(self.file_name, 'wb') as f:
+            f.write(data[:2 * MB])
+
+        # The recorded hashes are used; the data on disk is not read.
+        checkpoint.record(0, MB, TreeHasher(data[:MB]).hexdigest())
+        checkpoint.record(MB, 2 * MB, TreeHasher(data[MB:2 * MB]).hexdigest())
+        connection = FakeConnection(data)
+        download = RangedDownload(lambda: connection, 'vault', 'job',
+                                  len(data), MB, concurrency=2,
+                                  checkpoint=checkpoint)
+        with open(self.file_name, 'r+b') as f:
+            tree_hash = download.download(f.fileno())
+
+        self.assertEqual(tree_hash, TreeHasher(data).hexdigest())
+        self.assertEqual(sorted(connection.fetched), [2 * MB, 3 * MB, 4 * MB, 5 * MB])
+        self.assertEqual(open(self.file_name, 'rb').read(), data)
+        self.assertEqual(len(DownloadCheckpoint.open(self.file_name).parts), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
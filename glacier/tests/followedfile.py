@@ -0,0 +1,56 @@
+import unittest
+
+import os
+import sys
+import hashlib
+import tempfile
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+from follow import FollowedFile
+from glaciercorecalls import TreeHasher
+from glacierexception import InputException
+
+
+class TestFollowedFile(unittest.TestCase):
+    def setUp(self):
+        fd, self.file_name = tempfile.mkstemp()
+        self.data = os.urandom(2500000)
+        os.write(fd, self.data)
+        os.close(fd)
+        self.sentinel = self.file_name + '.done'
+
+    def tearDown(self):
+        for file_name in (self.file_name, self.sentinel):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def test_parts(self):
+        open(self.sentinel, 'w').close()
+        followed = FollowedFile(self.file_name, timeout=60, sentinel=self.sentinel)
+        parts = list(followed.parts(1024 * 1024))
+        self.assertEqual([len(part) for part in parts], [1048576, 1048576, 402848])
+        for part in parts:
+            data = part.read()
+            self.assertEqual(part.hashes, (hashlib.sha256(data).hexdigest(),
+                                           TreeHasher(data).digest()))
+
+        followed.close()
+
+    def test_timeout(self):
+        followed = FollowedFile(self.file_name, timeout=0)
+        self.assertEqual(sum(len(part) for part in followed.parts(4 * 1024 * 1024)),
+                         len(self.data))
+        followed.close()
+
+    def test_shrunk(self):
+        followed = FollowedFile(self.file_name, timeout=60)
+        parts = followed.parts(1024 * 1024)
+        next(parts)
+        open(self.file_name, 'wb').close()
+        self.assertRaises(InputException, list, parts)
+        followed.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
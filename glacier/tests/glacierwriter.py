@@ -0,0 +1,202 @@
+import unittest
+
+import os
+import sys
+import time
+import random
+import threading
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+from glaciercorecalls import GlacierWriter, ConcurrentGlacierWriter, TreeHasher, \
+     RetryPolicy, UploadBudget
+from glacierexception import InputException, ResponseException
+
+MB = 1024 * 1024
+
+
+class Response(dict):
+    def read(self):
+        return ''
+
+
+class FakeConnection(object):
+    """
+    Stands in for GlacierConnection; parts take a random time to upload,
+    so they complete out of order.
+    """
+    def __init__(self, fail_at=None, failures=1, error=IOError):
+        self.parts = {}
+        self.fail_at = fail_at
+        self.failures = failures
+        self.error = error
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def initiate_multipart_upload(self, vault_name, part_size, description):
+        return Response(UploadId='upload')
+
+    def upload_part(self, vault_name, uploadid, linear_hash, tree_hash,
+                    byte_range, data):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        time.sleep(random.random() * 0.05)
+        with self.lock:
+            self.in_flight -= 1
+
+        if byte_range[0] == self.fail_at and self.failures:
+            self.failures -= 1
+            raise self.error('Upload failed.')
+
+        self.parts[byte_range[0]] = str(data)
+        return Response()
+
+    def complete_multipart_upload(self, vault_name, uploadid, tree_hash, size):
+        self.completed = (tree_hash, size)
+        return Response(ArchiveId='archive', Location='location')
+
+
+class TestConcurrentGlacierWriter(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(9 * MB + 12345)
+
+    def upload(self, writer):
+        for i in range(0, len(self.data), MB):
+            writer.write(self.data[i:i+MB])
+
+        writer.close()
+
+    def test_same_hash(self):
+        connection = FakeConnection()
+        writer = ConcurrentGlacierWriter(connection, 'vault', concurrency=4,
+                                         part_size_in_bytes=MB)
+        self.upload(writer)
+        expected = TreeHasher(self.data).hexdigest()
+        self.assertEqual(writer.get_hash(), expected)
+        self.assertEqual(connection.completed, (expected, len(self.data)))
+        self.assertEqual(''.join(connection.parts[k] for k in sorted(connection.parts)),
+                         self.data)
+        self.assertTrue(1 < connection.max_in_flight <= 4)
+
+    def test_connection_factory(self):
+        connections = []
+        def factory():
+            connections.append(FakeConnection())
+            return connections[-1]
+
+        writer = ConcurrentGlacierWriter(FakeConnection(), 'vault', concurrency=3,
+                                         connection_factory=factory,
+                                         part_size_in_bytes=MB)
+        self.upload(writer)
+        self.assertTrue(len(connections) <= 3)
+        self.assertEqual(sum(len(c.parts) for c in connections), 10)
+
+    def test_error(self):
+        writer = ConcurrentGlacierWriter(FakeConnection(fail_at=2 * MB), 'vault',
+                                         concurrency=2, part_size_in_bytes=MB)
+        self.assertRaises(IOError, self.upload, writer)
+        self.assertFalse(writer.closed)
+
+    def test_sequential_writer(self):
+        connection = FakeConnection()
+        writer = GlacierWriter(connection, 'vault', part_size_in_bytes=MB)
+        self.upload(writer)
+        self.assertEqual(writer.get_hash(), TreeHasher(self.data).hexdigest())
+        self.assertEqual(connection.max_in_flight, 1)
+
+
+class TestUploadBudget(unittest.TestCase):
+    def test_shared_budget(self):
+        connection = FakeConnection()
+        budget = UploadBudget(3, memory=2 * MB)
+        writers = [ConcurrentGlacierWriter(connection, 'vault', concurrency=3,
+                                           budget=budget, part_size_in_bytes=MB)
+                   for i in range(3)]
+        data = os.urandom(4 * MB)
+        threads = [threading.Thread(target=lambda w=w: [w.write(data[i:i+MB])
+                                                         for i in range(0, len(data), MB)])
+                   for w in writers]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        for writer in writers:
+            writer.close()
+            self.assertEqual(writer.get_hash(), TreeHasher(data).hexdigest())
+
+        self.assertTrue(connection.max_in_flight <= 2)
+        self.assertEqual((budget.parts, budget.bytes), (0, 0))
+
+    def test_large_part(self):
+        budget = UploadBudget(2, memory=MB)
+        budget.acquire(3 * MB)
+        budget.release(3 * MB)
+        self.assertEqual((budget.parts, budget.bytes), (0, 0))
+
+
+class Timeout(ResponseException):
+    def __init__(self, message):
+        ResponseException.__init__(self, message, code='RequestTimeoutException')
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_classification(self):
+        policy = RetryPolicy(max_attempts=3)
+        self.assertTrue(policy.should_retry(Timeout('slow'), 1))
+        self.assertTrue(policy.should_retry(Timeout('slow'), 2))
+        self.assertFalse(policy.should_retry(Timeout('slow'), 3))
+        self.assertFalse(policy.should_retry(ValueError('bug'), 1))
+        self.assertFalse(RetryPolicy(retry_on=[]).should_retry(Timeout('slow'), 1))
+
+    def test_delay(self):
+        policy = RetryPolicy(backoff=2, max_backoff=10, jitter=0.5)
+        for attempt, delay in ((1, 2), (2, 4), (3, 8), (4, 10), (8, 10)):
+            self.assertTrue(delay / 2.0 <= policy.delay(attempt) <= delay)
+
+        self.assertEqual(RetryPolicy(backoff=2, jitter=0).delay(3), 8)
+
+    def test_unknown_code(self):
+        self.assertRaises(InputException, RetryPolicy, retry_on=['NoSuchError'])
+
+
+class TestRetries(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(3 * MB + 5)
+        self.policy = RetryPolicy(backoff=0.001)
+
+    def upload(self, writer):
+        for i in range(0, len(self.data), MB):
+            writer.write(self.data[i:i+MB])
+
+        writer.close()
+
+    def test_retry_part(self):
+        connection = FakeConnection(fail_at=MB, failures=2, error=Timeout)
+        writer = GlacierWriter(connection, 'vault', part_size_in_bytes=MB,
+                               retry_policy=self.policy)
+        self.upload(writer)
+        self.assertEqual(writer.get_hash(), TreeHasher(self.data).hexdigest())
+        self.assertEqual((writer.retried_parts, writer.retries), (1, 2))
+
+    def test_give_up(self):
+        connection = FakeConnection(fail_at=MB, failures=5, error=Timeout)
+        writer = GlacierWriter(connection, 'vault', part_size_in_bytes=MB,
+                               retry_policy=RetryPolicy(max_attempts=3, backoff=0.001))
+        self.assertRaises(Timeout, self.upload, writer)
+        self.assertEqual(writer.retries, 2)
+
+    def test_not_retryable(self):
+        connection = FakeConnection(fail_at=MB, failures=1, error=IOError)
+        writer = GlacierWriter(connection, 'vault', part_size_in_bytes=MB,
+                               retry_policy=self.policy)
+        self.assertRaises(IOError, self.upload, writer)
+        self.assertEqual(writer.retries, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+
+import os
+import sys
+import tempfile
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+import glaciercorecalls
+from partreader import map_file, read_blocks, MappedFile, UnmappedFile, \
+                       FileSegment, DirectFile, BlockReader
+
+MB = 1024 * 1024
+
+
+class TestMappedFile(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(3 * MB + 4321)
+        fd, self.file_name = tempfile.mkstemp()
+        os.write(fd, self.data)
+        os.close(fd)
+        self.file = open(self.file_name, 'rb')
+
+    def tearDown(self):
+        self.file.close()
+        os.remove(self.file_name)
+
+    def test_part(self):
+        mapped_file = map_file(self.file)
+        mapped_file.WINDOW_SIZE = MB
+        self.assertTrue(isinstance(mapped_file, MappedFile))
+        part = mapped_file[MB + 17:3 * MB + 4000]
+        expected = self.data[MB + 17:3 * MB + 4000]
+        self.assertEqual(len(part), len(expected))
+        self.assertEqual(''.join(str(b) for b in part.blocks(65536)), expected)
+        self.assertEqual(part.read(10), expected[:10])
+        self.assertEqual(part.read(), expected[10:])
+        self.assertEqual(part.read(), '')
+        part.seek(MB - 5)
+        self.assertEqual(part.read(10), expected[MB - 5:MB + 5])
+        self.assertEqual(glaciercorecalls.part_hashes(part),
+                         glaciercorecalls.part_hashes(expected))
+
+    def test_end_of_file(self):
+        mapped_file = map_file(self.file)
+        self.assertEqual(len(mapped_file[3 * MB:]), 4321)
+        self.assertFalse(mapped_file[len(self.data):len(self.data) + MB])
+
+    def test_file_segment(self):
+        part = UnmappedFile(self.file)[MB + 17:3 * MB + 4000]
+        expected = self.data[MB + 17:3 * MB + 4000]
+        self.assertTrue(isinstance(part, FileSegment))
+        self.assertEqual(len(part), len(expected))
+        self.assertEqual(max(len(b) for b in part.blocks(65536)), 65536)
+        self.assertEqual(''.join(part.blocks(65536)), expected)
+        self.assertEqual(part.read(10), expected[:10])
+        self.assertEqual(part.read(), expected[10:])
+        part.seek(-10, os.SEEK_END)
+        self.assertEqual(part.read(), expected[-10:])
+        self.assertEqual(glaciercorecalls.part_hashes(part),
+                         glaciercorecalls.part_hashes(expected))
+        hasher = glaciercorecalls.ParallelTreeHasher(3)
+        self.assertEqual(hasher.part_hashes(part),
+                         glaciercorecalls.part_hashes(expected))
+        hasher.close()
+
+    def test_truncated_file(self):
+        part = FileSegment(self.file.fileno(), 3 * MB, 2 * MB)
+        self.assertRaises(IOError, part.read)
+
+    def test_empty_file(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertTrue(isinstance(map_file(f), UnmappedFile))
+
+    def test_page_cache(self):
+        for page_cache in ('keep', 'drop', 'direct'):
+            blocks = list(read_blocks(self.file_name, 1000, len(self.data), MB, page_cache))
+            self.assertEqual([len(block) for block in blocks], [MB, MB, MB, 4321 - 1000])
+            self.assertEqual(''.join(blocks), self.data[1000:])
+
+            # Parts are read with O_DIRECT, or dropped from the page cache
+            # once sent, where the system supports it.
+            mapped_file = map_file(self.file, page_cache)
+            part = mapped_file[MB + 10:3 * MB + 20]
+            self.assertEqual(glaciercorecalls.part_hashes(part),
+                             glaciercorecalls.part_hashes(self.data[MB + 10:3 * MB + 20]))
+            if hasattr(part, 'close'):
+                part.close()
+
+            if hasattr(mapped_file, 'close'):
+                mapped_file.close()
+
+            # Streams, like the compressor reads, go the same way.
+            reader = BlockReader(self.file_name, 10, len(self.data), MB, page_cache)
+            self.assertEqual(reader.read(100), self.data[10:110])
+            self.assertEqual(reader.read(2 * MB), self.data[110:2 * MB + 110])
+            self.assertEqual(reader.read(), self.data[2 * MB + 110:])
+            self.assertEqual(reader.read(10), '')
+            reader.close()
+
+    def test_direct(self):
+        mapped_file = map_file(self.file, 'direct')
+        if not isinstance(mapped_file, DirectFile):
+            self.skipTest('O_DIRECT is not supported here.')
+
+        # Parts are read in blocks when used, not up front.
+        part = mapped_file[MB + 17:3 * MB + 4000]
+        expected = self.data[MB + 17:3 * MB + 4000]
+        self.assertEqual(len(part), len(expected))
+        blocks = list(part.blocks(65536))
+        self.assertEqual(max(len(block) for block in blocks), 65536)
+        self.assertEqual(''.join(blocks), expected)
+        self.assertEqual(part.read(8192), expected[:8192])
+        part.seek(MB - 5)
+        self.assertEqual(part.read(10), expected[MB - 5:MB + 5])
+        part.seek(0)
+        self.assertEqual(part.read(), expected)
+        mapped_file.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+import unittest
+
+import os
+import sys
+import random
+import tempfile
+import threading
+import StringIO
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+from glaciercorecalls import TreeHasher
+from rangedownload import RangeHashes, RangedDownload, ReorderBuffer, \
+                          pwrite, preallocate
+from glacierexception import CommunicationException
+
+MB = 1024 * 1024
+
+
+class FakeConnection(object):
+    def __init__(self, data):
+        self.data = data
+        self.failed = set()
+
+    def get_job_output(self, vault_name, job_id, byte_range=None):
+        start, end = byte_range
+        if start == 2 * MB and start not in self.failed:
+            self.failed.add(start)
+            raise IOError('Connection reset')
+
+        return StringIO.StringIO(self.data[start:end + 1])
+
+
+class Response(dict):
+    def __init__(self, data, tree_hash):
+        dict.__init__(self, TreeHash=tree_hash)
+        self.body = StringIO.StringIO(data)
+
+    def read(self, size=-1):
+        return self.body.read(size)
+
+
+class CorruptingConnection(FakeConnection):
+    def __init__(self, data, corrupt):
+        FakeConnection.__init__(self, data)
+        self.corrupt = corrupt
+        self.fetched = []
+
+    def get_job_output(self, vault_name, job_id, byte_range=None):
+        start, end = byte_range
+        self.fetched.append(start)
+        data = self.data[start:end + 1]
+        tree_hash = TreeHasher(data).hexdigest()
+        if start in self.corrupt:
+            self.corrupt[start] -= 1
+            if not self.corrupt[start]:
+                del self.corrupt[start]
+
+            data = data[:100] + 'x' + data[101:]
+
+        return Response(data, tree_hash)
+
+
+class RetryOnce(object):
+    max_attempts = 2
+
+    def should_retry(self, error, attempt):
+        return attempt < self.max_attempts
+
+    def delay(self, attempt):
+        return 0
+
+    def error_code(self, error):
+        return 'IOError'
+
+
+class TestRangedDownload(unittest.TestCase):
+    def setUp(self):
+        self.fd, self.file_name = tempfile.mkstemp()
+
+    def tearDown(self):
+        os.close(self.fd)
+        os.remove(self.file_name)
+
+    def test_range_hashes(self):
+        data = os.urandom(5 * MB + 1000)
+        for part_size in (MB, 2 * MB, 8 * MB):
+            ranges = [(i, data[start:start + part_size])
+                      for i, start in enumerate(range(0, len(data), part_size))]
+            random.shuffle(ranges)
+            hashes = RangeHashes(part_size)
+            for index, part in ranges:
+                hashes.add(index, TreeHasher(part).digest())
+
+            self.assertEqual(hashes.hexdigest(), TreeHasher(data).hexdigest())
+            self.assertEqual(hashes.pending, {})
+
+    def test_pwrite(self):
+        preallocate(self.fd, 10)
+        pwrite(self.fd, 'world', 5)
+        pwrite(self.fd, 'hello', 0)
+        self.assertEqual(os.fstat(self.fd).st_size, 10)
+        self.assertEqual(open(self.file_name, 'rb').read(), 'helloworld')
+
+    def test_download(self):
+        data = os.urandom(7 * MB + 123)
+        connection = FakeConnection(data)
+        download = RangedDownload(lambda: connection, 'vault', 'job',
+                                  len(data), MB, concurrency=3,
+                                  retry_policy=RetryOnce())
+        progress = []
+        tree_hash = download.download(self.fd, progress.append)
+        self.assertEqual(tree_hash, TreeHasher(data).hexdigest())
+        self.assertEqual(open(self.file_name, 'rb').read(), data)
+        self.assertEqual(progress[-1], len(data))
+        self.assertEqual(download.retries, 1)
+
+    def test_truncated(self):
+        connection = FakeConnection(os.urandom(MB))
+        connection.get_job_output = lambda vault_name, job_id, byte_range: \
+                                    StringIO.StringIO('x' * 1000)
+        download = RangedDownload(lambda: connection, 'vault', 'job',
+                                  MB, MB, concurrency=1)
+        self.assertRaises(CommunicationException, download.download, self.fd)
+
+    def test_corrupted(self):
+        data = os.urandom(4 * MB)
+        connection = CorruptingConnection(data, {MB: 1})
+        download = RangedDownload(lambda: connection, 'vault', 'job',
+                                  len(data), MB, concurrency=2)
+        tree_hash = download.download(self.fd)
+        self.assertEqual(tree_hash, TreeHasher(data).hexdigest())
+        self.assertEqual(open(self.file_name, 'rb').read(), data)
+
+        # Only the corrupted range was fetched again.
+        self.assertEqual(sorted(connection.fetched), [0, MB, MB, 2 * MB, 3 * MB])
+        self.assertEqual(download.retries, 1)
+
+        connection = CorruptingConnection(data, {2 * MB: 3})
+        download = RangedDownload(lambda: connection, 'vault', 'job',
+                                  len(data), MB, concurrency=2)
+        self.assertRaises(CommunicationException, download.download, self.fd)
+
+    def test_error(self):
+        connection = FakeConnection(os.urandom(4 * MB))
+        download = RangedDownload(lambda: connection, 'vault', 'job',
+                                  4 * MB, MB, concurrency=2)
+        self.assertRaises(IOError, download.download, self.fd)
+
+
+class TestReorderBuffer(unittest.TestCase):
+    def test_order(self):
+        buffer = ReorderBuffer(100)
+        buffer.write(1, 10, 'c')
+        buffer.done(1, 1, 'hash1')
+        buffer.write(0, 0, 'a')
+        buffer.write(0, 1, 'b')
+        buffer.done(0, 2, 'hash0')
+        self.assertEqual([buffer.get() for i in range(5)],
+                         [(0, 'a', None), (0, 'b', None), (0, None, 'hash0'),
+                          (1, 'c', None), (1, None, 'hash1')])
+        self.assertEqual(buffer.size, 0)
+
+    def test_budget(self):
+        buffer = ReorderBuffer(10)
+        buffer.write(1, 0, 'x' * 10)
+
+        # Range 1 is full; its next block waits.
+        written = threading.Event()
+        def write():
+            buffer.write(1, 10, 'y' * 10)
+            written.set()
+        threading.Thread(target=write).start()
+        self.assertFalse(written.wait(0.2))
+
+        # Range 0, whose turn it is, always gets a block in.
+        buffer.write(0, 0, 'a' * 20)
+        buffer.done(0, 20, 'hash0')
+        self.assertEqual(buffer.get(), (0, 'a' * 20, None))
+        self.assertEqual(buffer.get(), (0, None, 'hash0'))
+
+        # Range 1 goes through as it comes in, as its writer waits.
+        self.assertEqual(buffer.get(), (1, 'x' * 10, None))
+        self.assertTrue(written.wait(1))
+        buffer.done(1, 20, 'hash1')
+        self.assertEqual(buffer.get(), (1, 'y' * 10, None))
+
+    def test_restart(self):
+        buffer = ReorderBuffer(100)
+        buffer.write(0, 0, 'a')
+        buffer.write(1, 0, 'b')
+        self.assertTrue(buffer.restart(1))
+
+        # Held until complete, so it can start over.
+        self.assertTrue(buffer.restart(0))
+        self.assertEqual(buffer.size, 0)
+        buffer.write(0, 0, 'c')
+        buffer.done(0, 1, 'hash0')
+        self.assertEqual(buffer.get(), (0, 'c', None))
+        self.assertFalse(buffer.restart(0))
+
+    def test_stream(self):
+        data = os.urandom(7 * MB + 123)
+        connection = CorruptingConnection(data, {MB: 1})
+
+        # Range 0 comes in last, after range 1 was fetched again.
+        get_job_output = connection.get_job_output
+        refetched = threading.Event()
+        def delayed(vault_name, job_id, byte_range=None):
+            if byte_range[0] == 0:
+                refetched.wait(5)
+            elif connection.fetched.count(MB) == 1 and byte_range[0] == MB:
+                refetched.set()
+            return get_job_output(vault_name, job_id, byte_range)
+        connection.get_job_output = delayed
+
+        download = RangedDownload(lambda: connection, 'vault', 'job',
+                                  len(data), MB, concurrency=3)
+        progress = []
+        blocks = list(download.stream(4 * MB, progress.append))
+        self.assertEqual(''.join(blocks), data)
+        self.assertTrue(max(len(block) for block in blocks) <= MB)
+        self.assertEqual(download.tree_hash, TreeHasher(data).hexdigest())
+        self.assertEqual(progress[-1], len(data))
+        self.assertEqual(download.retries, 1)
+
+    def test_stream_sequential(self):
+        # The range whose turn it is is held until checked, so it can
+        # still be fetched again.
+        data = os.urandom(3 * MB)
+        connection = CorruptingConnection(data, {MB: 1})
+        download = RangedDownload(lambda: connection, 'vault', 'job',
+                                  len(data), MB, concurrency=1)
+        self.assertEqual(''.join(download.stream(2 * MB)), data)
+        self.assertEqual(connection.fetched, [0, MB, MB, 2 * MB])
+
+    def test_stream_error(self):
+        connection = FakeConnection(os.urandom(4 * MB))
+        download = RangedDownload(lambda: connection, 'vault', 'job',
+                                  4 * MB, MB, concurrency=2)
+        self.assertRaises(IOError, list, download.stream())
+
+
+if __name__ == '__main__':
+    unittest.main()
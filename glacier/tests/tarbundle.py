@@ -0,0 +1,63 @@
+import unittest
+
+import os
+import sys
+import shutil
+import tarfile
+import tempfile
+import StringIO
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+from packer import bundles
+from glaciercorecalls import TreeHasher
+from glacierexception import InputException
+
+
+class TestTarBundle(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.files = {}
+        for i, size in enumerate([0, 1, 511, 512, 5000, 300000]):
+            name = os.path.join(self.dir, 'file%s' % i)
+            self.files[name] = os.urandom(size)
+            with open(name, 'wb') as f:
+                f.write(self.files[name])
+
+        self.names = sorted(self.files)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_tar(self):
+        bundle, = bundles(self.names, 1024 * 1024)
+        data = ''
+        while True:
+            chunk = bundle.read(7777)
+            if not chunk:
+                break
+            data += chunk
+
+        self.assertEqual(len(data), bundle.size)
+        tar = tarfile.open(fileobj=StringIO.StringIO(data))
+        self.assertEqual(tar.getnames(), [member.name for member in bundle.members])
+        for member in bundle.members:
+            content = self.files[member.file_name]
+            self.assertEqual(tar.extractfile(member.name).read(), content)
+            self.assertEqual(data[member.offset:member.offset + member.size], content)
+            self.assertEqual(member.tree_hash, TreeHasher(content).hexdigest())
+
+    def test_bundle_size(self):
+        packed = list(bundles(self.names, 4096))
+        self.assertEqual([len(bundle.members) for bundle in packed], [5, 1])
+        self.assertEqual(len(packed[1].read()), packed[1].size)
+
+    def test_truncated_file(self):
+        bundle, = bundles(self.names, 1024 * 1024)
+        with open(self.names[-1], 'wb') as f:
+            f.write('short')
+        self.assertRaises(InputException, bundle.read)
+
+
+if __name__ == '__main__':
+    unittest.main()
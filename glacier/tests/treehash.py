@@ -0,0 +1,95 @@
+import unittest
+
+import hashlib
+import os
+import sys
+import tempfile
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+import glaciercorecalls
+from glaciercorecalls import TreeHasher, ParallelTreeHasher
+
+MB = 1024 * 1024
+
+
+def reference_tree_hash(data):
+    """
+    Straightforward tree hash as described in the Amazon Glacier docs.
+    """
+    hashes = [hashlib.sha256(data[i:i+MB]).digest()
+              for i in range(0, len(data), MB)] or [hashlib.sha256('').digest()]
+    while len(hashes) > 1:
+        pairs = [hashes[i:i+2] for i in range(0, len(hashes), 2)]
+        hashes = [hashlib.sha256(''.join(p)).digest() if len(p) == 2 else p[0]
+                  for p in pairs]
+
+    return hashes[0]
+
+
+class TestTreeHasher(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(9 * MB + 12345)
+
+    def test_sizes(self):
+        for size in (0, 1, MB - 1, MB, MB + 1, 2 * MB, 3 * MB + 5,
+                     4 * MB, 5 * MB, 7 * MB + 1, 9 * MB + 12345):
+            data = self.data[:size]
+            self.assertEqual(TreeHasher(data).digest(),
+                             reference_tree_hash(data), 'size %s' % size)
+
+    def test_incremental_update(self):
+        hasher = TreeHasher()
+        for i in range(0, len(self.data), 65537):
+            hasher.update(self.data[i:i+65537])
+
+        self.assertEqual(hasher.size, len(self.data))
+        self.assertEqual(hasher.digest(), reference_tree_hash(self.data))
+
+    def test_tree_hash_of_parts(self):
+        part_hashes = [TreeHasher(self.data[i:i+4*MB]).digest()
+                       for i in range(0, len(self.data), 4 * MB)]
+        self.assertEqual(glaciercorecalls.tree_hash(part_hashes),
+                         reference_tree_hash(self.data))
+
+    def test_chunk_hashes(self):
+        self.assertEqual(
+            glaciercorecalls.tree_hash(glaciercorecalls.chunk_hashes(self.data)),
+            reference_tree_hash(self.data))
+
+    def test_part_hashes(self):
+        linear, tree = glaciercorecalls.part_hashes(self.data)
+        self.assertEqual(linear, hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(tree, reference_tree_hash(self.data))
+
+class TestParallelTreeHasher(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(9 * MB + 12345)
+        fd, self.file_name = tempfile.mkstemp()
+        os.write(fd, self.data)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.file_name)
+
+    def test_data(self):
+        for jobs in (1, 4):
+            hasher = ParallelTreeHasher(jobs)
+            self.assertEqual(hasher.tree_hash(self.data),
+                             reference_tree_hash(self.data))
+            self.assertEqual(hasher.part_hashes(self.data),
+                             (hashlib.sha256(self.data).hexdigest(),
+                              reference_tree_hash(self.data)))
+            hasher.close()
+
+    def test_file(self):
+        hasher = ParallelTreeHasher(4)
+        hasher.SEGMENT_SIZE = 2 * MB
+        self.assertEqual(hasher.file_tree_hash(self.file_name),
+                         reference_tree_hash(self.data))
+        self.assertEqual(hasher.file_tree_hash(self.file_name, 4 * MB, 8 * MB),
+                         reference_tree_hash(self.data[4 * MB:8 * MB]))
+        hasher.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+import glaciercorecalls
+from hashcache import TreeHashCache
+
+MB = 1024 * 1024
+
+
+class TestTreeHashCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = TreeHashCache(os.path.join(self.tmpdir, 'cache.sqlite'))
+        self.data = os.urandom(6 * MB + 1)
+        self.file_name = os.path.join(self.tmpdir, 'data')
+        with open(self.file_name, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_range_tree_hash(self):
+        key = self.cache.key(self.file_name)
+        leaves = glaciercorecalls.chunk_hashes(self.data)
+        self.cache.put(key, leaves=bytearray(''.join(leaves)))
+        entry = self.cache.get(key)
+        self.assertEqual(entry.tree_hash, None)
+        self.assertEqual(entry.range_tree_hash(2 * MB, 4 * MB),
+                         glaciercorecalls.TreeHasher(self.data[2 * MB:4 * MB]).digest())
+        self.assertEqual(entry.range_tree_hash(4 * MB, 6 * MB + 1),
+                         glaciercorecalls.TreeHasher(self.data[4 * MB:]).digest())
+        self.assertEqual(entry.range_tree_hash(MB + 1, 2 * MB), None)
+
+        # A tree hash added later keeps the chunk hashes.
+        self.cache.put(key, tree_hash='abc')
+        entry = self.cache.get(key)
+        self.assertEqual(entry.tree_hash, 'abc')
+        self.assertEqual(entry.chunks, len(leaves))
+        self.assertEqual(entry.leaves, ''.join(leaves))
+
+    def test_changed_file(self):
+        key = self.cache.key(self.file_name)
+        self.cache.put(key, tree_hash='abc')
+        os.utime(self.file_name, (0, 0))
+        self.assertEqual(self.cache.get(self.cache.key(self.file_name)), None)
+
+    def test_eviction(self):
+        self.cache.max_size = 1024
+        self.cache.put((1, 1, 1, 1), leaves='x' * 32 * 20)
+        self.cache.put((1, 2, 1, 1), leaves='y' * 32 * 20)
+        self.assertEqual(self.cache.get((1, 1, 1, 1)), None)
+        self.assertEqual(self.cache.get((1, 2, 1, 1)).chunks, 20)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+from journal import UploadJournal
+
+
+class TestUploadJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        fd, self.file_name = tempfile.mkstemp()
+        os.write(fd, 'some data')
+        os.close(fd)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        os.remove(self.file_name)
+
+    def create(self, uploadid='upload'):
+        return UploadJournal.create(self.directory, uploadid, 'vault',
+                                    'us-east-1', self.file_name, 1024)
+
+    def test_record(self):
+        journal = self.create()
+        journal.record(0, 1024, 'aa')
+        journal.record_parts([(1024, 2048, 'bb'), (2048, 2050, 'cc')])
+        journal.close()
+        journal = UploadJournal.open(self.directory, 'upload')
+        self.assertEqual(journal.uploadid, 'upload')
+        self.assertEqual(journal.tree_hash(1024, 2048), 'bb')
+        self.assertEqual(journal.tree_hash(0, 2048), None)
+        self.assertEqual(len(journal.parts), 3)
+        self.assertTrue(journal.matches(self.file_name))
+
+    def test_crash(self):
+        journal = self.create()
+        journal.record(0, 1024, 'aa')
+        journal.close()
+
+        # A record cut short is ignored.
+        with open(journal.path, 'ab') as f:
+            f.write('{"Start": 1024, "Stop": 20')
+
+        journal = UploadJournal.open(self.directory, 'upload')
+        self.assertEqual(journal.parts, {(0, 1024): 'aa'})
+
+    def test_find(self):
+        self.create('first')
+        self.create('second')
+        os.utime(os.path.join(self.directory, 'first.journal'), (0, 0))
+        journal = UploadJournal.find(self.directory, 'vault', 'us-east-1', self.file_name)
+        self.assertEqual(journal.uploadid, 'second')
+        self.assertEqual(UploadJournal.find(self.directory, 'other', 'us-east-1',
+                                            self.file_name), None)
+
+        # A changed file does not match any more.
+        with open(self.file_name, 'ab') as f:
+            f.write('more data')
+
+        self.assertFalse(journal.matches(self.file_name))
+        self.assertEqual(UploadJournal.find(self.directory, 'vault', 'us-east-1',
+                                            self.file_name), None)
+
+    def test_remove(self):
+        journal = self.create()
+        journal.record(0, 1024, 'aa')
+        journal.remove()
+        self.assertEqual(UploadJournal.open(self.directory, 'upload'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
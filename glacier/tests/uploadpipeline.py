@@ -0,0 +1,82 @@
+import unittest
+
+import os
+import sys
+import time
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+from glaciercorecalls import part_hashes
+from pipeline import UploadPipeline
+
+MB = 1024 * 1024
+
+
+class FakeWriter(object):
+    """
+    Records the parts and hashes written; sending a part takes a while.
+    """
+    def __init__(self, delay=0.0, fail_at=None):
+        self.written = []
+        self.delay = delay
+        self.fail_at = fail_at
+
+    def write(self, data, linear_hash=None, part_tree_hash=None):
+        if len(self.written) == self.fail_at:
+            raise IOError('Upload failed.')
+
+        time.sleep(self.delay)
+        self.written.append((data, linear_hash, part_tree_hash))
+
+
+class TestUploadPipeline(unittest.TestCase):
+    def setUp(self):
+        self.parts = [os.urandom(MB + i) for i in range(5)]
+
+    def test_order_and_hashes(self):
+        for readahead in (0, 1, 3):
+            writer = FakeWriter()
+            pipeline = UploadPipeline(iter(self.parts), writer, readahead=readahead)
+            sizes = list(pipeline)
+            self.assertEqual(sizes, [len(p) for p in self.parts])
+            self.assertEqual([w[0] for w in writer.written], self.parts)
+            for data, linear_hash, tree_hash in writer.written:
+                self.assertEqual((linear_hash, tree_hash), part_hashes(data))
+
+    def test_readahead_bound(self):
+        read = []
+        def parts():
+            for part in self.parts:
+                read.append(part)
+                yield part
+
+        writer = FakeWriter(delay=0.05)
+        pipeline = UploadPipeline(parts(), writer, readahead=2)
+        for size in pipeline:
+            # Parts read, but not yet written: the one being sent
+            # and at most readahead more.
+            self.assertTrue(len(read) - len(writer.written) <= 2)
+
+    def test_occupancy(self):
+        writer = FakeWriter(delay=0.05)
+        pipeline = UploadPipeline(iter(self.parts), writer)
+        list(pipeline)
+        stages = pipeline.occupancy()
+        self.assertEqual([name for name, busy, parts in stages],
+                         ['read', 'hash', 'send'])
+        self.assertEqual([parts for name, busy, parts in stages], [5, 5, 5])
+        self.assertEqual(pipeline.bottleneck(), 'send')
+        self.assertTrue(pipeline.report().startswith('read '))
+
+    def test_errors(self):
+        def parts():
+            yield self.parts[0]
+            raise ValueError('Read failed.')
+
+        self.assertRaises(ValueError, list, UploadPipeline(parts(), FakeWriter()))
+        self.assertRaises(IOError, list,
+                          UploadPipeline(iter(self.parts), FakeWriter(fail_at=2)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import StringIO
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+from spool import UploadSpool
+
+
+class TestUploadSpool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = os.urandom(2500)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create(self, max_parts=10):
+        return UploadSpool.create(self.directory, 'upload', 'vault',
+                                  'us-east-1', 1000, max_parts=max_parts)
+
+    def test_spool(self):
+        spool = self.create()
+        parts = list(spool.spool(StringIO.StringIO(self.data)))
+        self.assertEqual([len(part) for part in parts], [1000, 1000, 500])
+        self.assertEqual(''.join(part.read() for part in parts), self.data)
+        self.assertEqual(spool.size, 2500)
+        self.assertTrue(spool.complete)
+
+        spool.record(0, 1000, 'aa')
+        spool.close()
+        spool = UploadSpool.find(self.directory, 'vault', 'us-east-1')
+        self.assertEqual(spool.uploadid, 'upload')
+        self.assertEqual(sorted(spool.parts), [(1000, 2000), (2000, 2500)])
+        self.assertEqual(spool.part(2000, 2500).read(), self.data[2000:])
+        self.assertEqual(UploadSpool.find(self.directory, 'vault', 'eu-west-1'), None)
+
+        spool.remove()
+        self.assertEqual(UploadSpool.open(self.directory, 'upload'), None)
+
+    def test_interrupted(self):
+        spool = self.create()
+        parts = spool.spool(StringIO.StringIO(self.data))
+        next(parts)
+        spool.close()
+        spool = UploadSpool.open(self.directory, 'upload', max_parts=10)
+        self.assertEqual(spool.size, 1000)
+        self.assertFalse(spool.complete)
+
+        # The rest of the data continues after the spooled data.
+        parts = list(spool.spool(StringIO.StringIO(self.data[1000:])))
+        self.assertEqual([len(part) for part in parts], [1000, 500])
+        self.assertEqual(sorted(spool.parts), [(0, 1000), (1000, 2000), (2000, 2500)])
+        self.assertTrue(spool.complete)
+
+    def test_full(self):
+        spool = self.create(max_parts=1)
+        parts = spool.spool(StringIO.StringIO(self.data))
+        next(parts)
+        timer = threading.Timer(0.2, spool.record, (0, 1000, 'aa'))
+        timer.start()
+
+        # Waits until the first part is acknowledged.
+        part = next(parts)
+        self.assertEqual(sorted(spool.parts), [(1000, 2000)])
+        self.assertEqual(part.read(), self.data[1000:2000])
+        timer.join()
+
+    def test_resume_full(self):
+        data = os.urandom(3500)
+        spool = self.create(max_parts=3)
+        parts = spool.spool(StringIO.StringIO(data))
+        for i in range(3):
+            next(parts)
+        spool.close()
+
+        # The spool is full; the parts sent again must leave it before
+        # the rest of the data fits.
+        spool = UploadSpool.open(self.directory, 'upload', max_parts=3)
+        self.assertEqual(len(spool.parts), 3)
+        for start, stop in sorted(spool.parts):
+            self.assertEqual(spool.part(start, stop).read(), data[start:stop])
+            spool.record(start, stop, 'aa')
+
+        self.assertEqual(spool.fds, {})
+        self.assertEqual(os.listdir(spool.path), ['header.json'])
+        parts = list(spool.spool(StringIO.StringIO(data[3000:])))
+        self.assertEqual([part.read() for part in parts], [data[3000:]])
+        self.assertTrue(spool.complete)
+
+
+if __name__ == '__main__':
+    unittest.main()
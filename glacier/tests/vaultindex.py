@@ -0,0 +1,112 @@
+import unittest
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import StringIO
+
+sys.path.append("/".join(sys.path[0].split("/")[:-1]))
+
+import glacier
+import glaciercorecalls
+from archiveindex import ArchiveIndex
+from GlacierWrapper import GlacierWrapper
+
+
+def item(archive_id, tree_hash, size, date='2012-10-01T12:00:00Z'):
+    return {'ArchiveId': archive_id,
+            'SHA256TreeHash': tree_hash,
+            'Size': size,
+            'ArchiveDescription': 'description',
+            'CreationDate': date}
+
+
+class TestArchiveIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = ArchiveIndex(os.path.join(self.dir, 'archives.sqlite'))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.dir)
+
+    def test_find(self):
+        self.index.add('region', 'vault', 'a', 'hash', 10)
+        self.assertEqual(self.index.find('region', 'vault', 'hash', 10), 'a')
+        self.assertEqual(self.index.find('region', 'vault', 'hash', 11), None)
+        self.assertEqual(self.index.find('region', 'other', 'hash', 10), None)
+        self.index.forget('a')
+        self.assertEqual(self.index.find('region', 'vault', 'hash', 10), None)
+
+    def test_inventory(self):
+        self.index.update_inventory('region', 'vault', {
+            'InventoryDate': '2012-10-02T00:00:00Z',
+            'ArchiveList': [item('a', 'hash-a', 1), item('b', 'hash-b', 2)]})
+        self.assertEqual(self.index.find('region', 'vault', 'hash-b', 2), 'b')
+
+        # Archives gone from a newer inventory are dropped, archives
+        # uploaded after it was taken are kept.
+        self.index.add('region', 'vault', 'c', 'hash-c', 3)
+        self.index.update_inventory('region', 'vault', {
+            'InventoryDate': '2012-10-03T00:00:00Z',
+            'ArchiveList': [item('a', 'hash-a', 1)]})
+        self.assertEqual(self.index.find('region', 'vault', 'hash-a', 1), 'a')
+        self.assertEqual(self.index.find('region', 'vault', 'hash-b', 2), None)
+        self.assertEqual(self.index.find('region', 'vault', 'hash-c', 3), 'c')
+
+
+class TestSkipExisting(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.dir, 'data')
+        with open(self.file_name, 'wb') as f:
+            f.write('x' * 3000)
+
+        self.wrapper = GlacierWrapper('key', 'secret', 'us-east-1',
+                                      logtostdout=True, loglevel='ERROR',
+                                      hash_cache=False,
+                                      archive_index=os.path.join(self.dir, 'archives.sqlite'))
+        # Nothing may be sent to Glacier.
+        self.wrapper.glacierconn = object()
+
+    def tearDown(self):
+        self.wrapper.archive_index.close()
+        shutil.rmtree(self.dir)
+
+    def test_skip(self):
+        tree_hash = glaciercorecalls.TreeHasher('x' * 3000).hexdigest()
+        self.wrapper._get_archive_index().update_inventory('us-east-1', 'vault', {
+            'InventoryDate': '2012-10-02T00:00:00Z',
+            'ArchiveList': [item('a', tree_hash, 3000)]})
+
+        args = argparse.Namespace(
+            bacula=False, filename=[self.file_name], stdin=False,
+            skip_existing=True, vault='vault', region='us-east-1', jobs=1,
+            follow=False, dedup=False, pack=None, uploadid=None,
+            resume=False, description=None, name=None, partsize=None,
+            concurrency=1, readahead=1, paranoid=False, memory_budget=None,
+            compress=None, compress_level=None, output='json')
+
+        default_glacier_wrapper = glacier.default_glacier_wrapper
+        stdout, stderr = sys.stdout, sys.stderr
+        glacier.default_glacier_wrapper = lambda args: self.wrapper
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+        try:
+            glacier.upload(args)
+            output, errors = sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            glacier.default_glacier_wrapper = default_glacier_wrapper
+            sys.stdout, sys.stderr = stdout, stderr
+
+        self.assertEqual(json.loads(output),
+                         [{'Uploaded file': self.file_name,
+                           'Skipped (already in vault)': 'a',
+                           'Archive SHA256 tree hash': tree_hash}])
+        self.assertEqual(errors, 'Skipped 1 file (2.9 KB) already in the vault.\n')
+
+
+if __name__ == '__main__':
+    unittest.main()